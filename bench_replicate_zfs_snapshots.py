@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+"""Usage: bench_replicate_zfs_snapshots.py [-h | --help] [--scenario=<name>]... [--scale=<factor>] [--repeat=<n>] [--baseline=<file>] [--save-baseline] [--tolerance=<ratio>] [--keep=<dir>]
+
+-h --help              Show this.
+--scenario=<name>      Run only this scenario (may be given more than once).
+--scale=<factor>       Multiply the number of datasets in every scenario
+                       by this, e.g. 0.1 for a quick run [default: 1].
+--repeat=<n>           Run each scenario this many times, and report the
+                       fastest [default: 3].
+--baseline=<file>      Compare against (or, with --save-baseline, write)
+                       this file, rather than bench_baseline.json next
+                       to this script.
+--save-baseline        Record this run's timings as the new baseline.
+--tolerance=<ratio>    Count a scenario as a regression if it took more
+                       than this many times its baseline [default: 1.25].
+--keep=<dir>           Build the simulated hosts in DIR and leave them
+                       there, instead of in a temporary directory.
+
+Times replicate_snapshots_recursively end to end against simulated
+hosts (see fake_zfs.py), so the cost of listing, planning, destroying
+and orchestrating transfers can be measured on any Linux box, without
+pools. Each scenario builds a source tree 'tank/data' on host 'src'
+and a replica 'backup/data' on host 'dest' (both reached through the
+fake ssh), runs better_replicate_zfs_snapshots.py once, and records
+the wall-clock time and the time it spent in each phase (from
+--metrics-json).
+
+Send streams are mostly padding, and the fake zfs is a Python script
+started for every command, so the figures are the script's own
+overhead plus a fixed cost per zfs command: good for comparing one
+version of the script with another on the same machine, not for
+predicting real transfer times. Absolute times depend on the machine;
+regenerate the baseline (--save-baseline) when moving to another one.
+
+Exits 1 if any scenario regressed beyond --tolerance.
+
+Example:
+  bench_replicate_zfs_snapshots.py --scale=0.1 --repeat=1
+  bench_replicate_zfs_snapshots.py --scenario=up-to-date --save-baseline"""
+
+import sys, os, json, time, tempfile, shutil, subprocess, collections
+
+from docopt import docopt
+
+import fake_zfs, better_replicate_zfs_snapshots
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "better_replicate_zfs_snapshots.py")
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+Scenario = collections.namedtuple('Scenario', 'name children snapshots missing seed settings args')
+# CHILDREN datasets under the root, each with SNAPSHOTS snapshots on the
+# source; the destination lacks the newest MISSING of them, or (if SEED)
+# has the same datasets but no snapshots, so each is seeded. SETTINGS are fake_zfs host settings for
+# both hosts; ARGS are extra arguments for the script. As after an
+# earlier run, the source has the script's bookmark of the last
+# snapshot the destination has.
+
+SCENARIOS = [
+    Scenario('up-to-date', 1000, 100, 0, False, {}, []),
+    Scenario('incremental', 200, 100, 2, False, {}, ['--jobs=8']),
+    Scenario('recursive-stream', 200, 100, 2, False, {}, ['--recursive-stream']),
+    Scenario('prune', 1000, 100, 0, False, {}, ['--retain=backup/*:daily=2']),
+    Scenario('seed', 50, 10, 0, True, {}, ['--jobs=4']),
+    Scenario('slow-listing', 100, 100, 1, False, {'list_latency': 0.5}, ['--jobs=8']),
+]
+
+SNAPSHOT_SIZE = 64 << 10
+FIRST_CREATION = 1500000000
+
+def build_hosts(state_dir, scenario, scale):
+    """Create the simulated 'src' and 'dest' hosts for SCENARIO in STATE_DIR."""
+    children = max(1, int(scenario.children * scale))
+    src = fake_zfs.FakeHost(state_dir, 'src')
+    dest = fake_zfs.FakeHost(state_dir, 'dest')
+    txg = 100
+    src.save(fake_zfs.make_dataset('tank', txg))
+    dest.save(fake_zfs.make_dataset('backup', txg))
+    names = ['data'] + ['data/child-{:05}'.format(child) for child in range(children)]
+    tag = better_replicate_zfs_snapshots.bookmark_tag('dest', 'backup/data')
+    for name in names:
+        snapshots = []
+        for index in range(scenario.snapshots):
+            txg += 1
+            snapshots.append(('zfs-auto-snap_hourly-{:05}'.format(index), txg * 7919, txg,
+                              FIRST_CREATION + 3600 * index, SNAPSHOT_SIZE))
+        dataset = fake_zfs.make_dataset('tank/' + name, txg - len(snapshots), snapshots)
+        if not scenario.seed:
+            (snapshot, guid, createtxg, creation, _) = snapshots[len(snapshots) - scenario.missing - 1]
+            dataset['bookmarks'].append([snapshot + tag, guid, createtxg, creation, 0])
+        src.save(dataset)
+        if scenario.seed:
+            dest.save(fake_zfs.make_dataset('backup/' + name, txg - len(snapshots) + 1, guid=txg * 7919 + 1))
+        else:
+            dest.save(fake_zfs.make_dataset('backup/' + name, txg - len(snapshots) + 1,
+                                            snapshots[:len(snapshots) - scenario.missing],
+                                            guid=txg * 7919 + 1))
+    for host in (src, dest):
+        settings = host.settings()
+        settings.update(scenario.settings)
+        settings['txg'] = txg + 1000
+        host.save_settings(settings)
+    return len(names)
+
+def run_scenario(scenario, scale, state_dir):
+    """Run SCENARIO once; return (wall-clock seconds, phase seconds, datasets)."""
+    if os.path.isdir(state_dir):
+        shutil.rmtree(state_dir)
+    datasets = build_hosts(state_dir, scenario, scale)
+    bin_dir = os.path.join(state_dir, "bin")
+    fake_zfs.make_bin_dir(bin_dir)
+    metrics_path = os.path.join(state_dir, "metrics.json")
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    env['FAKE_ZFS_STATE'] = state_dir
+    cmd = [sys.executable, SCRIPT, 'src', 'tank/data', 'dest', 'backup/data', '--quiet',
+           '--progress=0', '--timeout=0', '--metrics-json=' + metrics_path] + scenario.args
+    with open(os.path.join(state_dir, "output.txt"), 'w') as output:
+        started = time.time()
+        status = subprocess.call(cmd, env=env, stdout=output, stderr=subprocess.STDOUT)
+        seconds = time.time() - started
+    if status != 0:
+        raise RuntimeError("scenario '{}' failed (exit status {}); see {}".format(
+            scenario.name, status, os.path.join(state_dir, "output.txt")))
+    with open(metrics_path) as f:
+        phase_seconds = json.load(f)['phase_seconds']
+    return (seconds, phase_seconds, datasets)
+
+def load_baseline(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+def main(arguments):
+    scale = float(arguments['--scale'])
+    repeat = int(arguments['--repeat'])
+    tolerance = float(arguments['--tolerance'])
+    baseline_path = arguments['--baseline'] or BASELINE
+    names = arguments['--scenario'] or [scenario.name for scenario in SCENARIOS]
+    unknown = set(names) - set(scenario.name for scenario in SCENARIOS)
+    if unknown:
+        print >> sys.stderr, "Unknown scenario(s): {}".format(", ".join(sorted(unknown)))
+        sys.exit(2)
+    baseline = load_baseline(baseline_path)
+    work_dir = arguments['--keep'] or tempfile.mkdtemp(prefix="bench-zfs-")
+    results = {}
+    regressions = []
+    print "{:<18} {:>8} {:>9} {:>9} {:>7}  {}".format("scenario", "datasets", "seconds", "baseline", "ratio",
+                                                      "phases (listing/planning/transfer/destroy)")
+    try:
+        for scenario in SCENARIOS:
+            if scenario.name not in names:
+                continue
+            runs = [run_scenario(scenario, scale, os.path.join(work_dir, scenario.name)) for _ in range(repeat)]
+            (seconds, phase_seconds, datasets) = min(runs)
+            results[scenario.name] = {'seconds': round(seconds, 3), 'datasets': datasets, 'scale': scale,
+                                      'phase_seconds': dict((phase, round(value, 3))
+                                                            for (phase, value) in phase_seconds.iteritems())}
+            previous = baseline.get(scenario.name)
+            if previous is not None and previous.get('scale') == scale:
+                ratio = seconds / previous['seconds']
+                (before, ratio_text) = ("{:.2f}".format(previous['seconds']), "{:.2f}".format(ratio))
+                if ratio > tolerance:
+                    regressions.append(scenario.name)
+                    ratio_text += "!"
+            else:
+                (before, ratio_text) = ("-", "-")
+            print "{:<18} {:>8} {:>9.2f} {:>9} {:>7}  {}".format(
+                scenario.name, datasets, seconds, before, ratio_text,
+                "/".join("{:.2f}".format(phase_seconds.get(phase, 0.0))
+                         for phase in ('listing', 'planning', 'transfer', 'destroy')))
+            sys.stdout.flush()
+    finally:
+        if not arguments['--keep']:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if arguments['--save-baseline']:
+        baseline.update(results)
+        with open(baseline_path, 'w') as f:
+            f.write(json.dumps(baseline, indent=2, sort_keys=True, separators=(",", ": ")) + "\n")
+        print "Saved baseline to {}".format(baseline_path)
+    if regressions:
+        print "Slower than baseline by more than {}x: {}".format(tolerance, ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -1,11 +1,80 @@
 #!/usr/bin/env python
-"""Usage: replicate_zfs_snapshots.py <src-host> <src-filesystem> <dest-host> <dest-filesystem> [-h | --help] [-v | --verbose | -q | --quiet] [-n | --dry-run] [--delete]
+"""Usage: replicate_zfs_snapshots.py <src-host> <src-filesystem> <dest-host> <dest-filesystem> [-h | --help] [-v | --verbose | -q | --quiet] [-n | --dry-run] [--plan-json=<file>] [--also-to=<host:filesystem>]... [--split-after=<seconds>] [--delete] [--retain=<rule>]... [--recursive-stream] [--jobs=<n>] [--max-per-src-host=<n>] [--max-per-dest-pool=<n>] [--buffer-size=<mib>] [--compress=<codec>] [--progress=<seconds>] [--timeout=<seconds>] [--metrics-json=<file>] [--prometheus-textfile=<file>] [--catalog-cache=<file>] [--lock-wait=<seconds>] [--lock-dir=<dir>] [--no-bookmarks] [--no-send-flags] [--daemon [--interval=<seconds>] [--settle=<seconds>]]
+       replicate_zfs_snapshots.py --config=<file> [-h | --help] [-v | --verbose | -q | --quiet] [-n | --dry-run] [--split-after=<seconds>] [--jobs=<n>] [--max-per-src-host=<n>] [--max-per-dest-pool=<n>] [--buffer-size=<mib>] [--compress=<codec>] [--progress=<seconds>] [--timeout=<seconds>] [--metrics-json=<file>] [--prometheus-textfile=<file>] [--catalog-cache=<file>] [--lock-wait=<seconds>] [--lock-dir=<dir>] [--no-bookmarks] [--no-send-flags]
+       replicate_zfs_snapshots.py audit <src-host> <src-filesystem> <dest-host> <dest-filesystem> [-h | --help] [-v | --verbose | -q | --quiet] [--max-lag=<seconds>] [--audit-json=<file>] [--timeout=<seconds>]
 
 -n --dry-run
---delete        Delete snapshots not in source filesystem.
--h --help       Show this.
--v --verbose    Log more than default.
--q --quiet      Log less than default.
+--plan-json=<file>        Write the plan (what will be sent, with estimated
+                          sizes, and pruned, dataset by dataset) to FILE
+                          as JSON before carrying it out. Not with
+                          --also-to.
+--also-to=<host:filesystem>
+                          Replicate to this destination as well. May be
+                          given more than once.
+--split-after=<seconds>   With --also-to, stop holding the others back for
+                          a destination that has kept them waiting this
+                          long, and finish it on its own [default: 60].
+--delete                  Delete snapshots not in source filesystem.
+--retain=<rule>           Prune destination auto-snapshots in datasets
+                          matching a pattern, e.g.
+                          'backup/*:hourly=24,daily=7,weekly=4,monthly=12'.
+                          May be given more than once; the first rule
+                          matching a dataset applies.
+-h --help                 Show this.
+-v --verbose              Log more than default.
+-q --quiet                Log less than default.
+--recursive-stream        Send the whole tree in one 'zfs send -R' stream
+                          where possible.
+-j <n> --jobs=<n>         Replicate up to N child filesystems at once; with
+                          a config file, run up to N of its jobs at once
+                          [default: 1].
+--max-per-src-host=<n>    At most N concurrent replications reading from any
+                          one source host (0 means no limit) [default: 0].
+--max-per-dest-pool=<n>   At most N concurrent replications writing to any
+                          one destination pool (0 means no limit) [default: 0].
+--buffer-size=<mib>       Memory buffer between zfs send and zfs receive,
+                          in MiB [default: 256].
+--compress=<codec>        How to compress streams between hosts: ssh, none,
+                          lz4, zstd[:level], zstdmt[:level] or auto
+                          [default: ssh].
+--progress=<seconds>      Print progress of each transfer this often
+                          (0 for never) [default: 60].
+--timeout=<seconds>       Give up on a zfs or ssh command that runs longer
+                          than this, or a transfer that moves no data for
+                          this long (0 for never). Listing a big pool can
+                          take a long time, and one that times out fails
+                          the run [default: 0].
+--metrics-json=<file>     Write a JSON summary of the run (bytes, rates,
+                          time per phase and dataset) to FILE.
+--prometheus-textfile=<file>
+                          Write the same figures to FILE for the
+                          Prometheus node_exporter textfile collector.
+--catalog-cache=<file>    Remember the destination's snapshots in this
+                          SQLite file between runs (e.g.
+                          /var/lib/replicate_zfs_snapshots/catalog.sqlite).
+--lock-wait=<seconds>     Wait this long for another run writing to the same
+                          destination datasets to finish, rather than
+                          giving up at once [default: 0].
+--lock-dir=<dir>          Keep the locks on destination datasets here
+                          [default: /tmp/replicate_zfs_snapshots.locks].
+--no-bookmarks            Don't bookmark replicated snapshots on the source.
+--no-send-flags           Send plain streams, without the 'zfs send' flags
+                          both hosts support (-L, -c, -e, -w).
+--config=<file>           Run every replication job listed in FILE (YAML; see
+                          replication_config.py) in this one process.
+--max-lag=<seconds>       With audit, count a dataset as a problem if its
+                          newest source snapshot was taken more than this
+                          long after the newest one on the destination
+                          [default: 0].
+--audit-json=<file>       With audit, also write the findings, dataset by
+                          dataset, to FILE as JSON.
+--daemon                  Keep running, replicating new snapshots as they
+                          appear.
+--interval=<seconds>      With --daemon, check the source for new
+                          snapshots this often [default: 60].
+--settle=<seconds>        With --daemon, wait this long after noticing new
+                          snapshots before sending them, so a burst of
+                          them goes in one transfer [default: 10].
 
 Example:
   replicate_zfs_snapshots.py sydney tank-microserver-0-mirror-2tb/share/kapsia localhost tank/sydney-tank-replica/share/kapsia
@@ -19,20 +88,175 @@ filesystem will be copied to destination filesystem. If '--delete'
 flag is passed, automatic ('zfs-auto-snap') snapshots not on source
 filesystem will be removed from destination filesystem .
 
+'--retain' rules prune automatic snapshots on the destination down to
+N hourly, daily, weekly and monthly ones (by creation time; see
+retention_policy.py), whether or not they are still on the source.
+Manual snapshots, the newest snapshot and the last one in common with
+the source are never pruned. Pruning happens after replication, for
+the whole tree at once: adjacent snapshots are destroyed as one
+'first%last' range and the rest listed with commas, with the commands
+for many datasets run in one shell on the destination.
+
+Transfers are received in resumable mode ('zfs receive -s'). If one
+is interrupted (e.g. the network drops), the next run carries on from
+where it stopped ('zfs send -t') instead of starting the whole stream
+again.
+
 The script looks for the most recent snapshot in common, and does an
 incremental send/receive from that to the most recent source snapshot.
 
+After replicating a dataset, the script bookmarks that snapshot on the
+source ('zfs bookmark fs@snap fs#snap_replicated_<tag>', where the tag
+stands for the destination tree). If the source later destroys it
+(e.g. its own retention runs before the next replication), the next
+incremental is sent from the bookmark instead, so the destination
+doesn't need a full send. Once a newer one has been made, the script
+destroys the older bookmarks it made for the same destination; other
+bookmarks are left alone. '--no-bookmarks' turns this off.
+
 If there is no snapshot in common between the two filesystems, the
 script transfers the oldest snapshot from the destination filesystem,
 and then recurses (to transfer an incremental snapshot from the that
 snapshot to most recent source snapshots.)
 
+Before replicating a tree, the script plans it: what each dataset
+needs sent (a seed and then an incremental, or just an incremental)
+and what will be pruned afterwards, and then carries the plan out. A
+dry run prints the plan instead, with the size of each send estimated
+by 'zfs send -nvP' (and with '--verbose', the sends themselves), and
+'--plan-json' writes it to a file. With '--jobs', the sends are sized
+up front and the children with the most to send below them start
+first, so a big dataset doesn't start last and hold up the end of the
+run.
+
 If the source filesystems has child filesystems, they will also be
 replicated to any corresponding children on the destination
 filesystems. If a child filesystem exists on the source, but not the
 destination, it will not be replicated, and a warning will be printed
 to stderr.
 
+With '--recursive-stream', the tree is first brought up to date with
+a single 'zfs send -R -I' from the top filesystem's last common
+snapshot to its newest one, which also carries properties and creates
+children made on the source since then. A child that has diverged
+(its newest destination snapshot is not that common snapshot, it is
+missing either snapshot, or it has an interrupted receive), or that
+needs other send flags than the top (an encrypted one sent raw, say),
+is left out with 'zfs send -X' and then replicated on its own as
+usual, as is everything if the stream fails. If a child would have to
+be left out but the source's zfs is older than OpenZFS 2.1, which has
+no '-X', no recursive stream is sent. The stream is received without
+'-F', so destination snapshots the source no longer has are kept.
+This option has no effect with '--daemon'.
+
+With '--also-to host:filesystem' (as many times as needed), the tree
+is replicated to several destinations. Where destinations share the
+same last common snapshot, the new snapshots are read and sent once
+and teed to all of them, each through a buffer of its own. A
+destination that holds the others back for more than '--split-after'
+seconds is dropped from the shared stream, and then resumed on its
+own, as is anything the shared streams didn't cover. A summary line
+per destination says how it went.
+
+With '--config FILE', the script runs all the jobs in a config file
+(each one a source tree and its destinations, with its own '--delete',
+'--retain', '--recursive-stream' and '--jobs' settings) in a single
+process, rather than starting once per tree from cron: every pool
+involved is listed once for all the jobs, ssh connections are shared,
+'--jobs N' jobs run at once, and '--max-per-src-host' and
+'--max-per-dest-pool' limit them all together. A summary line per
+job says how it went.
+
+'audit' checks a replica instead of updating it: both trees are
+listed once, at the same time, and compared dataset by dataset (see
+replication_audit.py). Source snapshots not yet replicated, destination
+snapshots the source no longer has, snapshots whose names match but
+guids don't, and how far each replica lags behind (in time and in
+source txgs) are printed for every dataset that isn't in sync. It
+exits 1 if any dataset is missing on the destination, has nothing in
+common with the source, has mismatched snapshots or lags by more than
+'--max-lag' seconds, and 2 if either tree couldn't be listed, so it
+can be run from monitoring. Nothing is changed on either host.
+
+With '--jobs N', up to N child filesystems are replicated at once. A
+child is never started before its parent has finished, and a failure
+replicating one child does not stop the others.
+
+Each 'zfs send' is connected to its 'zfs receive' through a relay
+with a large memory buffer (see '--buffer-size'), so that neither side
+has to wait for the other on every burst. When both are on localhost,
+they are run directly, without a shell, and on Linux the stream is
+moved from one's pipe to the other's with splice(2) instead, never
+copied through this script; the two pipes are then the buffer, each
+enlarged to half of '--buffer-size' (or, unless run as root, to at
+most /proc/sys/fs/pipe-max-size).
+
+By default streams between hosts are compressed by ssh (zlib), which
+is slow on fast links. '--compress' picks another codec, run next to
+'zfs send' and 'zfs receive' (so it must be installed on both hosts).
+'--compress auto' uses multi-threaded zstd and adjusts its level from
+stream to stream. Local-to-local transfers are never compressed.
+
+Streams are sent with whichever of 'zfs send -L' (large blocks), '-c'
+(blocks as they are compressed on disk), '-e' (embedded blocks) and,
+for encrypted datasets, '-w' (raw, still encrypted) both ends can
+take, worked out from 'zfs version' and the feature flags of each
+host's pools, which are asked for once per run (see send_features.py).
+The flags chosen for each pair of pools are printed with the reasons
+for any left out. '-L' is only turned on for a dataset the destination
+doesn't have yet, or one it received with '-L' before (marked with the
+user property replicate_zfs_snapshots:large_blocks when seeded), never
+partway through an existing chain of incrementals. When sizes are
+estimated (for progress or the plan) and the run isn't '--quiet', so
+is how much less is sent than in plain streams, which is printed at
+the end and saved with the metrics. '--no-send-flags' sends plain
+streams.
+
+The size of each transfer is estimated beforehand ('zfs send -nvP'),
+and progress with an ETA is printed every '--progress' seconds. Bytes
+sent, transfer rates and the time spent listing, planning, transferring
+and destroying can be saved at the end of the run with
+'--metrics-json' and '--prometheus-textfile'.
+
+With '--catalog-cache', the destination's snapshots are saved after
+each run, and the next run only lists them again if a cheap check
+(each destination dataset's guid and snapshots_changed property, which
+needs OpenZFS 2.2 or later) shows they have changed. This assumes the
+destination is only changed by this script. On a destination with
+older zfs, which can't report snapshots_changed, the cache is not
+used.
+
+With '--daemon', the script does not exit after replicating but keeps
+its catalogs in memory and checks the source every '--interval'
+seconds, using the same cheap snapshots_changed check (with zfs older
+than OpenZFS 2.2 the source is listed in full each time instead).
+Datasets with new snapshots are queued and replicated '--settle'
+seconds later, so a burst of snapshots goes in a single incremental
+send. The metrics files, if asked for, are rewritten after every
+check. SIGTERM stops the daemon once running transfers have finished.
+
+Each run locks the destination trees it writes to (see
+dataset_locks.py) for as long as it runs, '--daemon' included. A run
+whose tree is inside, or contains, one that another run has locked
+waits up to '--lock-wait' seconds for it and then gives up; runs
+writing to unrelated trees go ahead side by side. A run (or a config
+job) that gives up, or that fails to replicate any dataset, makes the
+script exit with status 1. Dry runs and audits
+take no locks.
+
+Commands run in process groups of their own: one that outlives
+'--timeout' (or a transfer that stops moving data for that long) is
+killed along with everything it started, and reported as failed. The
+source and destination are listed at the same time. If either
+listing fails or is cut short, nothing in that tree is sent or
+pruned: the run gives up on it (with exit status 1) rather than take
+what the listing missed for gone. SIGTERM (without
+'--daemon') kills every running command, so the run fails quickly.
+
+All commands for a remote host share a single multiplexed ssh
+connection (an OpenSSH control master), which is shut down when the
+script exits.
+
 If you run this script from the crontab, you may want to use cronic:
 (http://habilis.net/cronic/) to monitor the output.
 
@@ -40,35 +264,19 @@ Script assumes that:
 * passwordless ssh is set up between host running this script
   and the remote host.
 * the user the ssh connection logs in to on the remote host is allowed
-  password-less sudo on read-only commands (see /etc/sudoers.d/zfs).
+  password-less sudo on read-only commands (see /etc/sudoers.d/zfs),
+  and on 'zfs bookmark' and 'zfs destroy' of bookmarks unless
+  '--no-bookmarks' is given.
 * The user running this script is allowed to use destructive ZFS
   commands: destroy, zfs receive, etc.
 
 This seems to work for me, but it could be improved/extended. Ideas:
 
-* Another script to check that the two filesystems are actually
-  synchronised correctly. Basically: compare/diff the sets of
-  snapshots available on two different filesystems.
-
-* Another script to trim auto-snapshots on destination.
-
-  We no longer remove automatic snapshots from destination unless
-  specifically asked to. This means we can delete a large snapshot on
-  source without it being removed from destination ('backup').
-
-  This will mean that automatic snapshots will tend to pile up on
-  destination. Would be good to remove zfs-auto-snapshots where we
-  have too many of them (e.g. > 8 weekly, etc).
-
 * Another script to perfectly replicate the set of snapshots between
   two filesystems. This script just finds the last common snapshot and
   replicates snapshots after that one. We could make something that
   replicates all snapshots.
 
-* Should investigate using the -R option to "zfs send" to transfer
-  snapshots recursively instead of doing a non-recursive send/receive
-  for each child of the source filesystem.
-
 * This script should probably have an option to specify whether or not
   to attempt replication of any children of the source filesystem.
 
@@ -76,10 +284,32 @@ This seems to work for me, but it could be improved/extended. Ideas:
 
 from docopt import docopt
 
-import subprocess, sys, fcntl
+import subprocess, sys, threading, Queue, atexit, os, shutil, tempfile, signal, pipes, shlex, time, hashlib
+
+import transfer_relay, stream_compression, replication_metrics, snapshot_catalog, catalog_cache, retention_policy
+import command_executor, replication_plan, replication_config, replication_audit, dataset_locks, send_features
 
 verbose = False
 quiet = False
+buffer_size = transfer_relay.DEFAULT_BUFFER_SIZE
+compression = stream_compression.parse_codec('ssh')
+progress_interval = 60
+split_after = 60
+send_estimates = {}
+# (src_host, send_cmd) -> estimated bytes, worked out while planning and
+# used up by the transfer itself rather than asking 'zfs send -nvP' twice.
+metrics = replication_metrics.RunMetrics()
+saved_catalogs = None
+locks = dataset_locks.DatasetLocks()
+make_bookmarks = True
+hosts_without_bookmarks = set()
+use_send_flags = True
+host_features = {}
+# host -> [lock, send_features.HostFeatures or None], probed once per run (see features_of).
+host_features_lock = threading.Lock()
+logged_send_flags = set()
+lock_wait = 0
+# Seconds to wait for another run (or job) to release a destination tree.
 
 class ZfsReplicationNoRemoteSnapshots(Exception):
     pass
@@ -87,35 +317,222 @@ class ZfsReplicationNoRemoteSnapshots(Exception):
 class ZfsReplicationNoSnapshotsInCommon(Exception):
     pass
 
+class ZfsReplicationSnapshotMismatch(Exception):
+    pass
+
+class ZfsReplicationListingFailed(Exception):
+    """A 'zfs list' failed or timed out, so what it listed can't be trusted to be complete.
+
+    Arguments: what was being listed, and why the listing stopped."""
+    pass
+
+class SshSessions(object):
+    """One multiplexed ssh connection per remote host, shared by every command.
+
+    The first command for a host opens an OpenSSH control master for it
+    (compressed if COMPRESSION). Every later ssh (queries, destroys,
+    send/receive) runs over that connection, which skips the TCP, key
+    exchange and auth round trips.
+
+    Commands use 'ControlMaster=auto', so if the master connection
+    drops, the next command just opens a new one. close() (run at exit)
+    shuts the masters down and removes their sockets."""
+
+    def __init__(self, persist_seconds=600, compression=True):
+        self.persist_seconds = persist_seconds
+        self.compression = compression
+        self._lock = threading.Lock()
+        self._control_dir = None
+        self._hosts = {}
+        # host -> [lock, whether its master has been started]
+
+    def _control_path(self):
+        return os.path.join(self._control_dir, "%r@%h:%p")
+
+    def _options(self):
+        ## Compression is a property of the connection, so it is set on the master
+        return ["-S", self._control_path(), "-o", "ControlPersist={}".format(self.persist_seconds),
+                "-o", "Compression={}".format("yes" if self.compression else "no")]
+
+    def _open(self, host):
+        """Start the control master for HOST, unless we already have.
+
+        Only commands for HOST wait for its handshake: a slow or
+        unreachable host doesn't hold up connecting to the others."""
+        with self._lock:
+            if self._control_dir is None:
+                self._control_dir = tempfile.mkdtemp(prefix="zfs-ssh-")
+                atexit.register(self.close)
+            entry = self._hosts.setdefault(host, [threading.Lock(), False])
+        with entry[0]:
+            if entry[1]:
+                return
+            entry[1] = True
+            ## If this fails the commands themselves will report it
+            ## (and try to connect again)
+            subprocess.call(["ssh", "-o", "ControlMaster=yes"] + self._options()
+                            + ["-o", "ConnectTimeout=30", "-o", "ServerAliveInterval=15",
+                               "-o", "ServerAliveCountMax=4", "-N", "-f", host],
+                            stdin=open(os.devnull))
+
+    def command(self, host):
+        """Return the 'ssh ...' prefix for running a command on HOST."""
+        self._open(host)
+        return "ssh {} -o ControlMaster=auto {}".format(" ".join(self._options()), host)
+
+    def close(self):
+        with self._lock:
+            devnull = open(os.devnull, 'w')
+            for host in self._hosts:
+                subprocess.call(["ssh", "-S", self._control_path(), "-O", "exit", host],
+                                stdout=devnull, stderr=devnull)
+            self._hosts = {}
+            if self._control_dir is not None:
+                shutil.rmtree(self._control_dir, ignore_errors=True)
+                self._control_dir = None
+
+ssh_sessions = SshSessions()
+
+executor = command_executor.CommandExecutor()
+## Children run in process groups of their own, so they don't see a
+## Ctrl-C meant for us: take them down with us
+atexit.register(executor.cancel_all)
+
+output_lock = threading.Lock()
+
+def say(message, stream=None):
+    """Write MESSAGE (which may be several lines) to STREAM, stdout by default, in one piece.
+
+    Worker threads report at the same time, so everything the script
+    prints goes through here, and no line is broken up by another's."""
+    stream = stream or sys.stdout
+    with output_lock:
+        stream.write("{}\n".format(message))
+        stream.flush()
+
 def maybe_ssh(host):
     if (host == 'localhost'):
         ## no need to ssh host @ start of command - empty string
         return ""
     ##else
     ## will need the ssh in there
-    return "ssh -C {}".format(host)
+    return ssh_sessions.command(host)
+
+def print_command_failure(e):
+    """Report a command_executor.CommandFailed to stderr."""
+    lines = ["    Exception running command:  {}".format(e[0])]
+    if e[3] is not None:
+        lines.append("    Command {}".format(e[3]))
+    lines.append("    Output from failed command:")
+    lines.extend("       {}".format(line) for line in e[2].split('\n'))
+    say("\n".join(lines), sys.stderr)
+
+def run_command(cmd):
+    """Run a shell command, return (succeeded, list of lines output).
+
+    The command is killed if it runs for longer than executor.timeout."""
+    try:
+        return (True, executor.run(cmd))
+    except command_executor.CommandFailed as e:
+        print_command_failure(e)
+        return (False, [])
+
+def on_host(host, cmd):
+    """Return a shell command running CMD (which may be a pipeline) on HOST."""
+    if host == 'localhost':
+        return cmd
+    return "{} {}".format(maybe_ssh(host), pipes.quote(cmd))
+
+def local_arguments(cmd):
+    """Return CMD as a list of arguments to run without a shell, or None if it needs one."""
+    if set(cmd) & set("|&;<>$`"):
+        return None
+    return shlex.split(cmd)
 
 def run_query(cmd):
     """Run a shell command, return list of lines output."""
+    return run_command(cmd)[1]
+
+def fetch_listing(cmd, parse, host, filesystem):
+    """Run the 'zfs list' CMD of FILESYSTEM on HOST, and return what PARSE makes of its output.
+
+    PARSE is given the lines as they arrive, so they are never held in
+    memory all at once. If FILESYSTEM does not exist, the result is
+    empty. If the listing fails any other way (or times out) partway
+    through, its error output is printed and ZfsReplicationListingFailed
+    raised: planning, and above all pruning, from a partial listing
+    would take whatever it missed for gone."""
     try:
-        return subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True).split('\n')
-    except subprocess.CalledProcessError as e:
-        print >> sys.stderr, "    Exception running command: ", cmd
-        print >> sys.stderr, "    Output from failed command:"
-        for line in e.output.split('\n'):
-            print >> sys.stderr, "      ", line
-        return []
-
-def snapshots_in_creation_order(filesystem, host='localhost'):
+        return parse(executor.stream(cmd))
+    except command_executor.CommandFailed as e:
+        if e[3] is None and "cannot open '{}': dataset does not exist".format(filesystem) in e[2]:
+            return {}
+        print_command_failure(e)
+        raise ZfsReplicationListingFailed("Couldn't list {}:{}".format(host, filesystem),
+                                          "zfs list {}".format(e[3] or "exited with status {}".format(e[1])))
+
+def fetch_catalog(filesystem, host='localhost', recursive=True, bookmarks=True):
+    """Return a dict mapping FILESYSTEM (and, if RECURSIVE, all its descendants) to their SnapshotCatalog.
+
+    The whole tree is listed with a single 'zfs list', so replicating
+    N children costs one round trip per side rather than 2N+2. If
+    FILESYSTEM does not exist, the result is empty; if it can't be
+    listed, ZfsReplicationListingFailed is raised (see fetch_listing).
+    Only a source's bookmarks are of any use, so a destination is
+    listed without BOOKMARKS."""
+    cmd = "{} sudo zfs list -H -p {} -t filesystem,volume,snapshot{} -o name,guid,createtxg,creation,receive_resume_token {}".format(
+        maybe_ssh(host), "-r" if recursive else "-d 1", ",bookmark" if bookmarks else "", filesystem)
+    with metrics.phase('listing'):
+        return fetch_listing(cmd, snapshot_catalog.catalogs_from_listing, host, filesystem)
+
+def fetch_fingerprints(filesystem, host='localhost'):
+    """Return the catalog_cache.Fingerprint of FILESYSTEM and each of its descendants.
+
+    This lists only filesystems, not snapshots, so it is cheap. Raise
+    ZfsReplicationListingFailed if it fails, like fetch_catalog. Zfs
+    older than OpenZFS 2.2 rejects the snapshots_changed property, so
+    check lists_snapshots_changed first."""
+    cmd = "{} sudo zfs list -H -p -r -t filesystem,volume -o name,guid,snapshots_changed,receive_resume_token {}".format(
+        maybe_ssh(host), filesystem)
+    with metrics.phase('listing'):
+        return fetch_listing(cmd, catalog_cache.fingerprints_from_listing, host, filesystem)
+
+def lists_snapshots_changed(host):
+    """Can HOST's zfs list the snapshots_changed property, which fetch_fingerprints needs?
+
+    Worked out from its version (see features_of), once per run."""
+    return features_of(host).at_least(catalog_cache.SNAPSHOTS_CHANGED_VERSION)
+
+def fetch_dest_catalog(filesystem, host='localhost'):
+    """Like fetch_catalog, but use the saved catalog if it is still up to date.
+
+    Hosts whose zfs can't tell us that (see lists_snapshots_changed)
+    are just listed."""
+    if saved_catalogs is not None and lists_snapshots_changed(host):
+        catalogs = saved_catalogs.load(host, filesystem, fetch_fingerprints(filesystem, host))
+        if catalogs is not None:
+            if verbose:
+                say("Using saved catalog of {}:{}".format(host, filesystem))
+            return catalogs
+    return fetch_catalog(filesystem, host, bookmarks=False)
+
+def save_dest_catalog(filesystem, host, catalogs, failed=()):
+    """Save CATALOGS of FILESYSTEM on HOST for the next run, except for the FAILED datasets."""
+    if saved_catalogs is not None and lists_snapshots_changed(host):
+        try:
+            fingerprints = fetch_fingerprints(filesystem, host)
+        except ZfsReplicationListingFailed:
+            ## Without them we can't tell later whether CATALOGS still hold
+            saved_catalogs.forget(host, filesystem)
+            return
+        saved_catalogs.store(host, filesystem, catalogs, fingerprints, exclude=failed)
+
+def snapshots_in_creation_order(filesystem, host='localhost', catalog=None):
     "Return list of snapshots on FILESYSTEM in order of creation."
-    result = []
-    cmd = "{} sudo zfs list -o name -r -t snapshot -s creation {}".format(maybe_ssh(host), filesystem)
-    lines = run_query(cmd)
-    snapshot_prefix = filesystem + "@"
-    for line in lines:
-        if line.startswith(snapshot_prefix):
-            result.append(line)
-    return result
+    if catalog is None:
+        catalog = fetch_catalog(filesystem, host, recursive=False)
+    snapshots = catalog.get(filesystem, snapshot_catalog.SnapshotCatalog(filesystem))
+    return [snapshots.full_name(record) for record in snapshots]
 
 def strip_filesystem_name(snapshot_name):
     """Given the name of a snapshot, strip the filesystem part.
@@ -127,170 +544,1817 @@ def strip_filesystem_name(snapshot_name):
     return snapshot_name.split("@")[1]
 
 def maybe_run_command(cmd, dry_run=True):
+    """Run CMD unless DRY_RUN. Return False if it was run and failed."""
     if dry_run:
-        print "   Would execute: {}".format(cmd)
+        say("   Would execute: {}".format(cmd))
+        return True
     else:
         if not quiet:
-            print "   Executing: {}".format(cmd)
-        text = run_query(cmd)
+            say("   Executing: {}".format(cmd))
+        (succeeded, text) = run_command(cmd)
         if verbose:
-            if not text:
-                print "    <no output>"
-            else:
-                print "    output:"
-                for line in text:
-                    print "     {}".format(line)
+            say_output(text)
+        return succeeded
+
+def say_output(lines):
+    """Print the output of a command that succeeded, for verbose mode."""
+    if not [line for line in lines if line]:
+        say("    <no output>")
+    else:
+        say("\n".join(["    output:"] + ["     {}".format(line) for line in lines]))
+
+def restore_sigpipe():
+    ## Python ignores SIGPIPE, and children inherit that. Let zfs send
+    ## die quietly when its reader goes away, as it would in a shell pipe.
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+def transfer_codec(src_host, dest_host):
+    """Return the compression codec to use between SRC_HOST and DEST_HOST."""
+    if src_host == 'localhost' and dest_host == 'localhost':
+        return stream_compression.NO_COMPRESSION
+    if isinstance(compression, stream_compression.AdaptiveCodec):
+        return compression.codec()
+    return compression
+
+def adjust_compression(relay, link_upstream=False):
+    """Let 'auto' compression learn from the first seconds of RELAY's stream.
+
+    LINK_UPSTREAM says whether the stream reaches the relay over the
+    network (a remote source sending to this host)."""
+    level = compression.sample(relay.elapsed(), relay.buffer.seconds_full, relay.buffer.seconds_empty,
+                               relay.bytes_written, link_upstream)
+    if verbose:
+        say("    compression: after {:.1f}s buffer full {:.1f}s, empty {:.1f}s; next level {}".format(
+            relay.elapsed(), relay.buffer.seconds_full, relay.buffer.seconds_empty, level))
 
-def dependent_zfs_filesystems(filesystem, host='localhost'):
+def probe_features(host):
+    """Return the send_features.HostFeatures of HOST, asking it what its zfs and pools support.
+
+    If HOST can't be asked, it is taken to support nothing, so its
+    streams are sent plain."""
+    features = send_features.parse_probe(run_query(on_host(host, send_features.PROBE_COMMAND)))
+    pools = features.pools_using('encryption')
+    if pools:
+        features.encrypted = send_features.parse_encrypted(run_query(on_host(
+            host, send_features.encryption_command(pools))))
+    pools = features.pools_using('large_blocks')
+    if pools:
+        features.large_blocks = send_features.parse_large_blocks(run_query(on_host(
+            host, send_features.large_blocks_command(pools))))
+    if verbose:
+        say("  Send features of {}: {}".format(host, features.describe()))
+    return features
+
+def features_of(host):
+    """Return HOST's send_features.HostFeatures, probing it the first time they are asked for."""
+    with host_features_lock:
+        entry = host_features.setdefault(host, [threading.Lock(), None])
+    with entry[0]:
+        if entry[1] is None:
+            entry[1] = probe_features(host)
+    return entry[1]
+
+def probe_send_features(*hosts):
+    """Probe HOSTS (see features_of) at once, e.g. while their trees are being listed, unless flags are off."""
+    if use_send_flags:
+        executor.gather(*[(lambda host=host: features_of(host)) for host in sorted(set(hosts))])
+
+def send_flags(src_host, src_dataset, dest_host, dest_dataset, dest_exists=True):
+    """Return the letters of the 'zfs send' flags (see send_features) for SRC_DATASET's streams to DEST_DATASET.
+
+    The flags chosen for each pair of pools, and for each encrypted
+    dataset, are printed the first time they are used."""
+    if not use_send_flags:
+        return ""
+    (src, dest) = (features_of(src_host), features_of(dest_host))
+    (flags, reasons) = send_features.choose_flags(src, src_dataset, dest, dest_dataset, dest_exists)
+    if src_dataset in src.encrypted:
+        key = (src_host, src_dataset + " (encrypted)", dest_host, dest_dataset, flags, tuple(reasons))
+    else:
+        key = (src_host, send_features.pool_of(src_dataset), dest_host, send_features.pool_of(dest_dataset),
+               flags, tuple(reasons))
+    with host_features_lock:
+        first = key not in logged_send_flags
+        logged_send_flags.add(key)
+    if first and not quiet:
+        say("  Sending {}:{} to {}:{} with {}{}".format(src_host, key[1], dest_host, key[3],
+                                                      send_features.describe_flags(flags),
+                                                      "; {}".format("; ".join(reasons)) if reasons else ""))
+    return flags
+
+def mark_large_blocks(host, datasets, dry_run=True):
+    """Record that DATASETS on HOST were received with -L, so that later runs keep sending them -L.
+
+    The mark is the user property send_features.LARGE_BLOCKS_PROPERTY;
+    if it can't be set, say so (later runs' incrementals would then be
+    sent without -L, which the receiver may refuse)."""
+    if not dry_run:
+        features_of(host).large_blocks.update(datasets)
+    if not maybe_run_command(on_host(host, "sudo zfs set {}=on {}".format(send_features.LARGE_BLOCKS_PROPERTY,
+                                                                         " ".join(datasets))), dry_run):
+        say("    Couldn't mark {} as received with -L; set {}=on by hand".format(
+            ", ".join("{}:{}".format(host, dataset) for dataset in datasets),
+            send_features.LARGE_BLOCKS_PROPERTY), sys.stderr)
+
+def send_command(catalog, target, base=None, flags=""):
+    """Return the 'zfs send' of CATALOG's snapshot TARGET: in full, or incremental (-I) from BASE.
+
+    If BASE is a bookmark the stream can only be '-i' (TARGET alone, none
+    of the snapshots between them). FLAGS are the letters of the send
+    flags to use (see send_flags)."""
+    flags = send_features.flag_argument(flags)
+    if base is None:
+        return "sudo zfs send {}{}".format(flags, catalog.full_name(target))
+    if isinstance(base, snapshot_catalog.BookmarkRecord):
+        return "sudo zfs send {}-i {} {}".format(flags, catalog.full_name(base), catalog.full_name(target))
+    return "sudo zfs send {}-I {} {}".format(flags, catalog.full_name(base), catalog.full_name(target))
+
+def estimate_send_size(src_host, send_cmd, plain=False):
+    """Return the number of bytes 'zfs send' SEND_CMD would produce on SRC_HOST, and the number without its flags.
+
+    Either is None if not known. The second is only asked for (in the
+    same command) if PLAIN and SEND_CMD has flags that shrink its
+    stream (-c, -w); otherwise it is the same as the first."""
+    cmds = [send_cmd]
+    if plain and send_features.plain_command(send_cmd):
+        cmds.append(send_features.plain_command(send_cmd))
+    sizes = []
+    for line in run_query(on_host(src_host, " && ".join(cmd.replace("zfs send ", "zfs send -nvP ", 1)
+                                                        for cmd in cmds))):
+        fields = line.split('\t')
+        if fields[0] == 'size' and len(fields) == 2:
+            sizes.append(int(fields[1]))
+    if len(sizes) != len(cmds):
+        return (None, None)
+    return (sizes[0], sizes[-1])
+
+def report_progress(relay, dataset, estimated, done):
+    """Print RELAY's progress every progress_interval seconds until DONE is set."""
+    while not done.wait(progress_interval):
+        say(replication_metrics.progress_line(dataset, relay.bytes_written, estimated, relay.elapsed()))
+
+def watch_for_stall(relay, procs, done):
+    """Stop PROCS if RELAY moves no data for executor.timeout seconds, until DONE is set."""
+    last = (relay.bytes_read + relay.bytes_written, time.time())
+    while not done.wait(min(executor.timeout, 5)):
+        moved = relay.bytes_read + relay.bytes_written
+        if moved != last[0]:
+            last = (moved, time.time())
+        elif time.time() - last[1] >= executor.timeout:
+            for proc in procs:
+                executor.stop(proc, "stalled (no data for {}s)".format(executor.timeout))
+            return
+
+def run_transfer(src_host, send_cmd, dest_host, receive_cmd, dry_run=True, dataset=None):
+    """Run SEND_CMD on SRC_HOST, piping its output into RECEIVE_CMD on DEST_HOST.
+
+    The stream goes through a buffered relay, compressed (on the way
+    out of SRC_HOST, and decompressed on DEST_HOST) with the codec
+    chosen by transfer_codec. Bytes and time are recorded in metrics
+    against DATASET. Return False if the transfer was attempted and
+    failed."""
+    if dataset is None:
+        dataset = "{}:{}".format(src_host, send_cmd)
+    with metrics.phase('transfer', dataset):
+        return _run_transfer(src_host, send_cmd, [(dest_host, receive_cmd)], dry_run, dataset)[0]
+
+def run_fanout_transfer(src_host, send_cmd, targets, dry_run=True, dataset=None):
+    """Like run_transfer, but tee the output of a single SEND_CMD into several receives.
+
+    TARGETS is a list of (dest_host, receive_cmd). A target that falls
+    more than split_after seconds behind the others is split off (see
+    transfer_relay.TeeRelay), and fails. Return a list saying whether
+    each target's transfer succeeded."""
+    if dataset is None:
+        dataset = "{}:{}".format(src_host, send_cmd)
+    with metrics.phase('transfer', dataset):
+        return _run_transfer(src_host, send_cmd, targets, dry_run, dataset)
+
+def _run_transfer(src_host, send_cmd, targets, dry_run, dataset):
+    (estimated, plain) = send_estimates.pop((src_host, send_cmd), (None, None))
+    if estimated is None and progress_interval and not quiet:
+        (estimated, plain) = estimate_send_size(src_host, send_cmd, plain=True)
+    if estimated is not None:
+        metrics.record_estimate(dataset, estimated, plain)
+    ## One compressed stream for every target, unless none of them needs it
+    remote_hosts = [dest_host for (dest_host, _) in targets if dest_host != 'localhost']
+    codec = transfer_codec(src_host, remote_hosts[0] if remote_hosts else 'localhost')
+    ## Pulled from a remote source: the link is what feeds the relay
+    link_upstream = src_host != 'localhost' and not remote_hosts
+    if codec.compress_command():
+        send_cmd = "{} | {}".format(send_cmd, codec.compress_command())
+        targets = [(dest_host, "{} | {}".format(codec.decompress_command(), receive_cmd))
+                   for (dest_host, receive_cmd) in targets]
+    send_cmd = on_host(src_host, send_cmd)
+    receive_cmds = [on_host(dest_host, receive_cmd) for (dest_host, receive_cmd) in targets]
+    ## Both ends here: no shell or ssh in between, and no copying through us either
+    (send_args, receive_args) = (None, None)
+    if src_host == 'localhost' and [dest_host for (dest_host, _) in targets] == ['localhost'] and \
+       not codec.compress_command() and transfer_relay.splice_available():
+        (send_args, receive_args) = (local_arguments(send_cmd), local_arguments(receive_cmds[0]))
+    if dry_run:
+        for receive_cmd in receive_cmds:
+            say("   Would execute: {} | {}".format(send_cmd, receive_cmd))
+        return [True] * len(targets)
+    if not quiet:
+        for receive_cmd in receive_cmds:
+            say("   Executing: {} | {}".format(send_cmd, receive_cmd))
+    send_errors = tempfile.TemporaryFile()
+    receive_outputs = []
+    receives = []
+    try:
+        for receive_cmd in receive_cmds:
+            receive_outputs.append(tempfile.TemporaryFile())
+            receives.append(executor.start(receive_args or receive_cmd, stdin=subprocess.PIPE,
+                                           stdout=receive_outputs[-1], stderr=subprocess.STDOUT,
+                                           close_fds=True, preexec_fn=restore_sigpipe))
+        send = executor.start(send_args or send_cmd, stdout=subprocess.PIPE, stderr=send_errors,
+                              close_fds=True, preexec_fn=restore_sigpipe)
+    except command_executor.CommandFailed as e:
+        print_command_failure(e)
+        for receive in receives:
+            receive.stdin.close()
+            receive.wait()
+            executor.finished(receive)
+        return [False] * len(targets)
+    if len(receives) > 1:
+        relay = transfer_relay.TeeRelay(send.stdout.fileno(), [receive.stdin.fileno() for receive in receives],
+                                        buffer_size, split_after=split_after)
+    elif send_args and receive_args:
+        relay = transfer_relay.SpliceRelay(send.stdout.fileno(), receives[0].stdin.fileno(), buffer_size)
+    elif isinstance(compression, stream_compression.AdaptiveCodec) and codec is not stream_compression.NO_COMPRESSION:
+        relay = transfer_relay.Relay(send.stdout.fileno(), receives[0].stdin.fileno(), buffer_size,
+                                     sample_after=stream_compression.AUTO_SAMPLE_SECONDS,
+                                     on_sample=lambda relay: adjust_compression(relay, link_upstream))
+    else:
+        relay = transfer_relay.Relay(send.stdout.fileno(), receives[0].stdin.fileno(), buffer_size)
+    relay_errors = [None] * len(receives)
+    done = threading.Event()
+    if progress_interval and not quiet:
+        reporter = threading.Thread(target=report_progress, args=(relay, dataset, estimated, done))
+        reporter.daemon = True
+        reporter.start()
+    if executor.timeout:
+        watchdog = threading.Thread(target=watch_for_stall, args=(relay, [send] + receives, done))
+        watchdog.daemon = True
+        watchdog.start()
+    try:
+        if len(receives) > 1:
+            relay_errors = relay.run()
+            if all(relay_errors):
+                executor.stop(send, 'left with no destination')
+        else:
+            relay.run()
+    except transfer_relay.RelayError as e:
+        relay_errors = [e] * len(receives)
+        executor.stop(send, 'stopped after the relay failed')
+    finally:
+        done.set()
+        send.stdout.close()
+        for receive in receives:
+            receive.stdin.close()
+    send_status = send.wait()
+    executor.finished(send)
+    results = []
+    for (receive, receive_output, receive_cmd, relay_error) in zip(receives, receive_outputs,
+                                                                   receive_cmds, relay_errors):
+        receive_status = receive.wait()
+        executor.finished(receive)
+        stopped_because = send.stopped_because or receive.stopped_because
+        succeeded = send_status == 0 and receive_status == 0 and relay_error is None and stopped_because is None
+        results.append(succeeded)
+        if not succeeded:
+            lines = ["    Exception running command:  {} | {}".format(send_cmd, receive_cmd)]
+            if relay_error is not None:
+                lines.append("    Relay failed:  {}".format(relay_error))
+            if stopped_because is not None:
+                lines.append("    Transfer {}".format(stopped_because))
+            for (name, output) in (("send", send_errors), ("receive", receive_output)):
+                output.seek(0)
+                lines.append("    Output from failed {}:".format(name))
+                lines.extend("       {}".format(line) for line in output.read().split('\n'))
+            say("\n".join(lines), sys.stderr)
+        elif verbose:
+            receive_output.seek(0)
+            say_output(receive_output.read().split('\n'))
+    metrics.record_transfer(dataset, relay.bytes_written, relay.elapsed(), all(results))
+    if verbose:
+        say("    sent {} in {:.1f}s ({}/s){}".format(
+            replication_metrics.format_bytes(relay.bytes_written), relay.elapsed(),
+            replication_metrics.format_bytes(replication_metrics.rate(relay.bytes_written, relay.elapsed())),
+            ", about {} less than a plain stream".format(replication_metrics.format_bytes(plain - estimated))
+            if estimated is not None and plain > estimated else ""))
+    return results
+
+def dependent_zfs_filesystems(filesystem, host='localhost', catalog=None):
     "Return list of filsystems under FILESYSTEM recursively."
-    result = []
-    cmd = "{} sudo zfs list -r -o name {}".format(maybe_ssh(host), filesystem)
-    lines = run_query(cmd)
-    for line in lines:
-        if line.startswith(filesystem+"/"):
-            sub_filesystem = line[len(filesystem+"/"):]
-            if sub_filesystem:
-                result.append(sub_filesystem)
-    return result
+    if catalog is None:
+        catalog = fetch_catalog(filesystem, host)
+    prefix = filesystem + "/"
+    return sorted(dataset[len(prefix):] for dataset in catalog if dataset.startswith(prefix))
+
+SSH_FAILED = 255
+# The exit status of ssh when it couldn't run the command at all.
+
+def token_rejected(e):
+    """Did 'zfs send -t' fail (command_executor.CommandFailed E) because zfs refused the resume token?
+
+    Not if the command was stopped (e.g. timed out) or ssh failed: only
+    zfs's own 'cannot resume send' means the token is no use."""
+    return e[3] is None and e[1] not in (None, SSH_FAILED) and "cannot resume send" in e[2]
+
+def resume_interrupted_receive(src_host, src_filesystem, dest_host, dest_filesystem, dest_catalog, dry_run=True):
+    """Finish an interrupted 'zfs receive -s' into DEST_FILESYSTEM, if there is one.
+
+    The transfer carries on from where it stopped, using the
+    destination's receive_resume_token. If zfs on the source says it
+    can no longer produce the rest of the stream (e.g. the snapshot
+    being sent has since been destroyed), the partially received state
+    is thrown away so that a normal send can take its place. If the
+    source couldn't be asked at all (ssh failed, or the check timed
+    out), the state is kept for the next run. Return False if there was
+    a resumable transfer and it failed again, or couldn't be checked."""
+    dest = dest_catalog.get(dest_filesystem)
+    if dest is None or not dest.resume_token:
+        return True
+    token = dest.resume_token
+    if not quiet:
+        say("    Resuming interrupted receive into {}:{}".format(dest_host, dest_filesystem))
+    try:
+        executor.run("{} sudo zfs send -n -t {}".format(maybe_ssh(src_host), token))
+        resumable = True
+    except command_executor.CommandFailed as e:
+        print_command_failure(e)
+        if not token_rejected(e):
+            say("    Couldn't check whether {}:{} can be resumed; keeping its partially received state".format(
+                dest_host, dest_filesystem), sys.stderr)
+            return False
+        resumable = False
+    if not resumable:
+        if not quiet:
+            say("    Cannot resume: discarding partially received state of {}:{}".format(dest_host, dest_filesystem))
+        with metrics.phase('destroy', src_filesystem):
+            succeeded = maybe_run_command("{} sudo zfs receive -A {}".format(maybe_ssh(dest_host),
+                                                                             dest_filesystem),
+                                          dry_run)
+    else:
+        succeeded = run_transfer(src_host, "sudo zfs send -t {}".format(token),
+                                 dest_host, "sudo zfs receive -s -F {}".format(dest_filesystem),
+                                 dry_run, dataset=src_filesystem)
+    if succeeded and not dry_run:
+        ## We don't know which snapshot the token was for, so look
+        dest_catalog[dest_filesystem] = fetch_catalog(dest_filesystem, dest_host, recursive=False,
+                                                      bookmarks=False).get(
+            dest_filesystem, snapshot_catalog.SnapshotCatalog(dest_filesystem))
+    return succeeded
+
+def is_auto_snapshot(record):
+    """True for snapshots made by zfs-auto-snapshot, the only ones we ever destroy."""
+    return record.name.startswith('zfs-auto-snap')
+
+def snapshots_to_prune(src, dest, delete_snapshots_not_in_src=False, policy=None):
+    """Return the snapshots of DEST (oldest first) that should be destroyed.
+
+    Only automatic snapshots are ever pruned: with
+    DELETE_SNAPSHOTS_NOT_IN_SRC those that are not in SRC, and with a
+    retention POLICY those it doesn't keep. DEST's newest snapshot, and
+    its last snapshot in common with SRC (the base of the next
+    incremental, even if SRC only has a bookmark of it), are always
+    kept."""
+    protected = set()
+    if len(dest):
+        protected.add(dest.latest().guid)
+    last_common = src.last_common_base(dest) if src is not None else None
+    if last_common is not None:
+        protected.add(last_common.guid)
+    automatic = [record for record in dest if is_auto_snapshot(record)]
+    kept = policy.keep(automatic) if policy is not None else None
+    doomed = []
+    for record in automatic:
+        if record.guid in protected:
+            continue
+        if ((delete_snapshots_not_in_src and src is not None and record.guid not in src)
+                or (kept is not None and record.guid not in kept)):
+            doomed.append(record)
+    return doomed
+
+MAX_DESTROY_COMMAND = 32 << 10
+# Longest command (in bytes) run on a host to destroy snapshots. For a
+# remote host the whole command becomes one argument to ssh, and Linux
+# allows at most 128 KiB for a single argument.
+
+def destroy_commands(catalog, doomed):
+    """Return 'zfs destroy' commands destroying the DOOMED snapshots of CATALOG's dataset.
+
+    Runs of three or more snapshots that are next to each other in
+    CATALOG become a 'first%last' range, and the rest are listed with
+    commas, so that many snapshots go in one command (and one txg).
+    Commands are split to stay under MAX_DESTROY_COMMAND."""
+    doomed_guids = set(record.guid for record in doomed)
+    items = []
+    run = []
+    for record in list(catalog) + [None]:
+        if record is not None and record.guid in doomed_guids:
+            run.append(record)
+            continue
+        if len(run) > 2:
+            items.append("{}%{}".format(run[0].name, run[-1].name))
+        else:
+            items.extend(snapshot.name for snapshot in run)
+        run = []
+    commands = []
+    prefix = "sudo zfs destroy {}@".format(catalog.dataset)
+    command = None
+    for item in items:
+        if command is not None and len(command) + len(item) + 1 <= MAX_DESTROY_COMMAND:
+            command += "," + item
+        else:
+            if command is not None:
+                commands.append(command)
+            command = prefix + item
+    if command is not None:
+        commands.append(command)
+    return commands
+
+def command_batches(commands):
+    """Join COMMANDS, (dataset, command) pairs, into shell scripts of up to MAX_DESTROY_COMMAND bytes.
+
+    Return a list of (datasets, script) pairs. Each script runs all its
+    commands even if some fail, and then fails if any did."""
+    batches = []
+    for (dataset, command) in commands:
+        if batches and len(batches[-1][1]) + len(command) + 16 <= MAX_DESTROY_COMMAND:
+            batches[-1][0].add(dataset)
+            batches[-1][1] += "; {} || failed=1".format(command)
+        else:
+            batches.append([set([dataset]), "failed=0; {} || failed=1".format(command)])
+    return [(datasets, script + "; exit $failed") for (datasets, script) in batches]
+
+def prune_snapshots(host, catalogs, doomed, dry_run=True):
+    """Destroy the DOOMED snapshots (a dict of dataset -> records) of CATALOGS on HOST.
+
+    The destroy commands for all the datasets are run a batch at a time
+    in one shell on HOST, rather than paying an ssh round trip per
+    snapshot. CATALOGS is updated to match; if a batch fails, its
+    datasets are listed again since we can't tell what was destroyed.
+    Return False if anything failed."""
+    doomed = dict((dataset, records) for (dataset, records) in doomed.iteritems() if records)
+    if not doomed:
+        return True
+    if not quiet:
+        say("  Pruning {} snapshot(s) from {} filesystem(s) on {}".format(
+            sum(len(records) for records in doomed.itervalues()), len(doomed), host))
+    if verbose:
+        say("\n".join("   {}".format(catalogs[dataset].full_name(record))
+                      for dataset in sorted(doomed) for record in doomed[dataset]))
+    batches = command_batches([(dataset, command) for dataset in sorted(doomed)
+                               for command in destroy_commands(catalogs[dataset], doomed[dataset])])
+    succeeded = True
+    with metrics.phase('destroy'):
+        for (datasets, script) in batches:
+            if maybe_run_command(on_host(host, script), dry_run):
+                if not dry_run:
+                    for dataset in datasets:
+                        catalogs[dataset].remove(doomed[dataset])
+                continue
+            succeeded = False
+            if not dry_run:
+                for dataset in datasets:
+                    try:
+                        catalogs[dataset] = fetch_catalog(dataset, host, recursive=False,
+                                                          bookmarks=False).get(dataset, catalogs[dataset])
+                    except ZfsReplicationListingFailed:
+                        ## Its snapshots_changed has moved, so a saved catalog won't be trusted either
+                        pass
+    return succeeded
+
+def prune_tree(src_filesystem, dest_host, dest_filesystem, src_catalog, dest_catalog,
+               dry_run=True, delete_snapshots_not_in_src=False, retention=None, skip=()):
+    """Prune DEST_FILESYSTEM and its descendants (see snapshots_to_prune and prune_snapshots).
+
+    RETENTION is a retention_policy.RetentionRules. Only destination
+    datasets with a source counterpart are pruned, and not those (by
+    destination name) in SKIP, e.g. ones that failed to replicate."""
+    if not delete_snapshots_not_in_src and not retention:
+        return True
+    doomed = {}
+    with metrics.phase('planning'):
+        for dataset in dest_catalog:
+            if not catalog_cache.in_tree(dataset, dest_filesystem) or dataset in skip:
+                continue
+            src = src_catalog.get(src_filesystem + dataset[len(dest_filesystem):])
+            if src is None:
+                continue
+            policy = retention.policy_for(dataset) if retention else None
+            doomed[dataset] = snapshots_to_prune(src, dest_catalog[dataset], delete_snapshots_not_in_src, policy)
+    return prune_snapshots(dest_host, dest_catalog, doomed, dry_run)
+
+def bookmark_tag(dest_host, dest_filesystem):
+    """Return the tag naming the bookmarks made for replicating to DEST_FILESYSTEM's tree on DEST_HOST.
+
+    Each job prunes only the bookmarks with its own tag: a job
+    replicating the same source elsewhere may still need older ones."""
+    return "_replicated_" + hashlib.sha1("{}:{}".format(dest_host, dest_filesystem)).hexdigest()[:8]
+
+def stale_bookmarks(src, keep, tag):
+    """Return SRC's bookmarks with TAG other than the one of KEEP (a snapshot record)."""
+    return [bookmark for bookmark in src.bookmarks()
+            if bookmark.name.endswith(tag) and bookmark.name != keep.name + tag]
+
+def bookmark_wanted(src, dest, tag):
+    """Return the snapshot of SRC that create_bookmarks should see to, or None.
+
+    That is SRC's last snapshot in common with DEST, if it has no
+    bookmark with TAG yet or older ones need destroying: it is the
+    base of the dataset's next incremental, which can then still be
+    sent once the snapshot has been destroyed on the source."""
+    last_common = src.last_common(dest)
+    if last_common is None:
+        return None
+    if src.find_bookmark_name(last_common.name + tag) is None or stale_bookmarks(src, last_common, tag):
+        return last_common
+    return None
+
+def create_bookmarks(host, catalogs, wanted, tag, dry_run=True):
+    """Bookmark the WANTED snapshots (a dict of dataset -> record) of CATALOGS on HOST.
+
+    Each bookmark is named after its snapshot and TAG (see
+    bookmark_tag); one that already exists (made by another run to the
+    same destination) is taken to be the same. Once it exists, the
+    dataset's other bookmarks with TAG are destroyed, so there is only
+    ever one per dataset and destination. Like pruning, the commands
+    for all the datasets are run a batch at a time in one shell.
+    CATALOGS is updated to match. A host where 'zfs bookmark' fails
+    (for want of the bookmarks pool feature, or of sudo rights to it)
+    is warned about once, and not tried again in this run; that is not
+    counted as a failure to replicate."""
+    if not make_bookmarks or host in hosts_without_bookmarks or not wanted:
+        return
+    stale = dict((dataset, stale_bookmarks(catalogs[dataset], wanted[dataset], tag)) for dataset in wanted)
+    if verbose:
+        say("  Bookmarking {} snapshot(s) on {}, destroying {} older bookmark(s)".format(
+            len(wanted), host, sum(len(bookmarks) for bookmarks in stale.itervalues())))
+    commands = []
+    for dataset in sorted(wanted):
+        catalog = catalogs[dataset]
+        bookmark = "{}#{}{}".format(dataset, wanted[dataset].name, tag)
+        command = "{{ sudo zfs bookmark {} {} || sudo zfs list -H -o name {} >/dev/null; }}".format(
+            catalog.full_name(wanted[dataset]), bookmark, bookmark)
+        if stale[dataset]:
+            ## A bookmark we fail to destroy is just tried again next time
+            command += " && {{ {}; true; }}".format("; ".join("sudo zfs destroy {}".format(catalog.full_name(old))
+                                                             for old in stale[dataset]))
+        commands.append((dataset, command))
+    batches = command_batches(commands)
+    for (datasets, script) in batches:
+        if not maybe_run_command(on_host(host, script), dry_run):
+            hosts_without_bookmarks.add(host)
+            say("  Couldn't bookmark replicated snapshots on {}; without bookmarks, a snapshot"
+                " destroyed on the source can force a full send. See --no-bookmarks.".format(host), sys.stderr)
+            return
+        if not dry_run:
+            for dataset in datasets:
+                record = wanted[dataset]
+                catalogs[dataset].add_bookmark(snapshot_catalog.BookmarkRecord(record.name + tag, record.guid,
+                                                                               record.createtxg, record.creation))
+                catalogs[dataset].remove_bookmarks(stale[dataset])
+
+def bookmarks_wanted(src_filesystem, dest_host, dest_filesystem, src_catalog, dest_catalog, skip=()):
+    """Return the snapshots of SRC_FILESYSTEM and its descendants to bookmark, for create_bookmarks.
+
+    See bookmark_wanted. Destination datasets (by name) in SKIP, e.g.
+    ones that failed to replicate, are left out."""
+    tag = bookmark_tag(dest_host, dest_filesystem)
+    wanted = {}
+    for dataset in src_catalog:
+        if not catalog_cache.in_tree(dataset, src_filesystem):
+            continue
+        dest_dataset = dest_filesystem + dataset[len(src_filesystem):]
+        dest = dest_catalog.get(dest_dataset)
+        if dest is None or dest_dataset in skip:
+            continue
+        record = bookmark_wanted(src_catalog[dataset], dest, tag)
+        if record is not None:
+            wanted[dataset] = record
+    return wanted
 
 def replicate_snapshots(src_host, src_filesystem,
                         dest_host, dest_filesystem,
                         dry_run=True,
-                        delete_snapshots_not_in_src=False):
-    """Synchronise ZFS snapshots from source filesystem to a destination filesystem."""
-
-    if verbose:
-        print "   Started. source-host: {}, source-fs: {}, dest-host: {}, dest-fs: {}, dry-run: {}".format(
-            src_host, src_filesystem,
-            dest_host, dest_filesystem,
-            dry_run)
+                        delete_snapshots_not_in_src=False,
+                        src_catalog=None,
+                        dest_catalog=None,
+                        plan=None):
+    """Synchronise ZFS snapshots from source filesystem to a destination filesystem.
 
-    dest_snapshots = snapshots_in_creation_order(dest_filesystem, dest_host)
-    src_snapshots = snapshots_in_creation_order(src_filesystem, src_host)
+    Carry out PLAN, the dataset's replication_plan.DatasetPlan (see
+    plan_dataset), which is worked out here unless given. SRC_CATALOG
+    and DEST_CATALOG (see fetch_catalog) save listing the snapshots
+    again when replicating a whole tree. DEST_CATALOG is updated to
+    match what is transferred. Return False if a transfer failed; raise
+    the plan's error if it says the dataset can't be replicated.
 
-    if not src_snapshots:
-        raise ZfsReplicationNoRemoteSnapshots("No source snapshots to replicate",
-                                              "src-host: {}".format(src_host),
-                                              "src-filesystem: {}".format(src_filesystem))
+    Expired auto-snapshots are not destroyed here, even with
+    DELETE_SNAPSHOTS_NOT_IN_SRC: that is left to prune_snapshots, so
+    that a whole tree's can be destroyed in a few batched commands.
 
-    src_set = set(map(strip_filesystem_name, src_snapshots))
-    dest_set = set(map(strip_filesystem_name, dest_snapshots))
+    A plan that resumes an interrupted receive ends there, since what
+    is left depends on what the resumed stream held: once it has been
+    resumed the destination is listed again and the rest planned
+    afresh (in a dry run, it stops there)."""
 
-    last_common_snapshot = next((s for s in reversed(src_snapshots) if strip_filesystem_name(s) in dest_set), None)
+    if verbose:
+        say("   Started. source-host: {}, source-fs: {}, dest-host: {}, dest-fs: {}, dry-run: {}".format(
+            src_host, src_filesystem,
+            dest_host, dest_filesystem,
+            dry_run))
 
-    extra_snapshots_in_dest = [s for s in dest_snapshots if not strip_filesystem_name(s) in src_set]
+    if src_catalog is None and dest_catalog is None:
+        (src_catalog, dest_catalog) = executor.gather(
+            lambda: fetch_catalog(src_filesystem, src_host, recursive=False),
+            lambda: fetch_catalog(dest_filesystem, dest_host, recursive=False, bookmarks=False))
+    if src_catalog is None:
+        src_catalog = fetch_catalog(src_filesystem, src_host, recursive=False)
+    if dest_catalog is None:
+        dest_catalog = fetch_catalog(dest_filesystem, dest_host, recursive=False, bookmarks=False)
+    if plan is None:
+        with metrics.phase('planning', src_filesystem):
+            ## Planned as the top of a tree: seeded if it doesn't exist
+            plan = plan_dataset('', src_filesystem, dest_filesystem, src_catalog, dest_catalog,
+                                flags=send_flags(src_host, src_filesystem, dest_host, dest_filesystem,
+                                                 dest_filesystem in dest_catalog),
+                                src_host=src_host, dest_host=dest_host)
 
-    last_src_snapshot = src_snapshots[-1]
+    if plan.transfers and plan.transfers[0].kind == 'resume':
+        if not resume_interrupted_receive(src_host, src_filesystem, dest_host, dest_filesystem, dest_catalog,
+                                          dry_run):
+            ## Leave the partial state for the next run to resume again
+            return False
+        if dry_run:
+            return True
+        return replicate_snapshots(src_host, src_filesystem,
+                                   dest_host, dest_filesystem,
+                                   dry_run = dry_run,
+                                   delete_snapshots_not_in_src = delete_snapshots_not_in_src,
+                                   src_catalog = src_catalog,
+                                   dest_catalog = dest_catalog)
+    if plan.error is not None:
+        raise plan.error
+    if plan.problem is not None:
+        say("    {}:{}: {}; not replicating it".format(dest_host, dest_filesystem, plan.problem), sys.stderr)
+        return False
 
+    src = src_catalog[src_filesystem]
+    dest = dest_catalog.get(dest_filesystem, snapshot_catalog.SnapshotCatalog(dest_filesystem))
     if verbose:
-        print "Source snapshots:"
-        for snapshot in src_snapshots:
-            print " {}".format(snapshot)
-        print "Dest snapshots:"
-        for snapshot in dest_snapshots:
-            print " {}".format(snapshot)
-        print "Last common snapshot: {}".format(last_common_snapshot)
-        print "Last source snapshot: {}".format(last_src_snapshot)
-
-    if extra_snapshots_in_dest:
+        last_common = src.last_common_base(dest)
+        say("\n".join(["Source snapshots:"] + [" {}".format(src.full_name(record)) for record in src]
+                      + ["Dest snapshots:"] + [" {}".format(dest.full_name(record)) for record in dest]
+                      + ["Last common snapshot: {}".format(src.full_name(last_common) if last_common else None),
+                         "Last source snapshot: {}".format(src.full_name(src.latest()))]))
+
+    extra_in_dest = dest.not_in(src)
+    if extra_in_dest:
+        ## With DELETE_SNAPSHOTS_NOT_IN_SRC, the caller prunes them afterwards (see prune_snapshots)
         if verbose:
-            print "Present in destination, but not in source:"
-        for snapshot in extra_snapshots_in_dest:
+            say("Present in destination, but not in source:")
+        for record in extra_in_dest:
+            snapshot = dest.full_name(record)
             if verbose:
-                print " {}".format(snapshot)
-            snapshot_name = strip_filesystem_name(snapshot)
-            if snapshot_name.startswith('zfs-auto-snap'):
-                if delete_snapshots_not_in_src:
-                    if not quiet:
-                        print "Deleting expired auto-snapshot {} from destination.".format(snapshot)
-                        maybe_run_command("{} sudo zfs destroy {}".format(maybe_ssh(dest_host), snapshot),
-                                          dry_run)
-                else:
-                    if not quiet:
-                        print "NOT deleting expired auto-snapshot {} from destination.".format(snapshot)
+                say(" {}".format(snapshot))
+            if is_auto_snapshot(record):
+                if not delete_snapshots_not_in_src and not quiet:
+                    say("NOT deleting expired auto-snapshot {} from destination.".format(snapshot))
             else:
                 if not quiet:
-                    print "Leaving manual snapshot {} on destination.".format(snapshot)
+                    say("Leaving manual snapshot {} on destination.".format(snapshot))
 
-    if not dest_snapshots:
-        first_src_snapshot = src_snapshots[0]
+    if not plan.transfers:
         if not quiet:
-            print "No snapshots exist on destination. Transferring oldest snapshot: '{}' from source.".format(
-                strip_filesystem_name(first_src_snapshot))
-        maybe_run_command(("{} sudo zfs send {} ".format(maybe_ssh(src_host),
-                                                              first_src_snapshot)
-                                + "| {} sudo zfs receive -F {}".format(maybe_ssh(src_host),
-                                                                       dest_filesystem)),
-                              dry_run)
-        if dry_run:
-            print "Would then call again recursively but will not show that output in dry run"
-            return
+            say("    Destination up to date. Last source snapshot '{}' already on destination filesystem {}:{}.".format(
+                src.latest().name, dest_host, dest_filesystem))
+        return True
+    for transfer in plan.transfers:
+        records = [src.find_name(name) for name in transfer.snapshots]
+        base = None
+        if transfer.base_guid is not None:
+            base = src.find_guid(transfer.base_guid) or src.find_bookmark(transfer.base_guid)
+        if not quiet:
+            if transfer.kind == 'full':
+                say("No snapshots exist on destination. Transferring oldest snapshot: '{}' from source.".format(
+                    records[0].name))
+            elif isinstance(base, snapshot_catalog.BookmarkRecord):
+                say("    Last common snapshot '{}' is gone from the source. Transferring '{}' from its bookmark.".format(
+                    base.name, records[0].name))
+        if not run_transfer(src_host, transfer.send_cmd,
+                            dest_host, "sudo zfs receive -s -F {}".format(dest_filesystem),
+                            dry_run, dataset=src_filesystem):
+            return False
+        if transfer.kind == 'full':
+            if 'w' in plan.flags and not dry_run:
+                ## Received raw, so encrypted: later runs must send it raw too
+                features_of(dest_host).encrypted.add(dest_filesystem)
+            if 'L' in plan.flags:
+                mark_large_blocks(dest_host, [dest_filesystem], dry_run)
+            if verbose and not dry_run:
+                say("Have transferred initial snapshot {}.".format(records[0].name))
+        if not dry_run:
+            dest = dest_catalog.setdefault(dest_filesystem, dest)
+            if base is None:
+                dest.append_received(records)
+            else:
+                dest.received_incremental(base, records)
+    return True
+
+def plan_dataset(filesystem, src_dataset, dest_dataset, src_catalog, dest_catalog,
+                 delete_snapshots_not_in_src=False, policy=None, flags="",
+                 src_host='localhost', dest_host='localhost'):
+    """Return the replication_plan.DatasetPlan for replicating SRC_DATASET to DEST_DATASET.
+
+    It lists what replicate_snapshots is to send (with the send FLAGS),
+    given the catalogs, and what snapshots_to_prune would then destroy
+    (with the retention POLICY, if any). FILESYSTEM is the dataset's
+    name below the top of the tree, '' for the top itself; only the
+    top is seeded if it doesn't exist on the destination.
+
+    Snapshots are matched by guid, not name. A destination snapshot
+    with the same name as a source snapshot but a different guid is
+    not the same snapshot, and the dataset is not replicated (the
+    plan's error is ZfsReplicationSnapshotMismatch) rather than risk
+    sending an incremental onto the wrong base.
+
+    If the last snapshot in common has been destroyed on the source but
+    a bookmark of it is left, the next snapshot is sent from the
+    bookmark, and the rest from that snapshot, instead of giving up
+    for want of a common snapshot. A seed and the incrementals after
+    it share the same flags. SRC_HOST and DEST_HOST are only used in
+    error messages."""
+    plan = replication_plan.DatasetPlan(filesystem, src_dataset, dest_dataset, flags)
+    src = src_catalog.get(src_dataset)
+    dest = dest_catalog.get(dest_dataset)
+    if dest is None and filesystem:
+        plan.problem = "destination does not exist"
+        return plan
+    if dest is None:
+        dest = snapshot_catalog.SnapshotCatalog(dest_dataset)
+    if dest.resume_token:
+        ## What is left to do after it depends on what the resumed stream holds
+        plan.transfers.append(replication_plan.PlannedTransfer('resume',
+                                                               "sudo zfs send -t {}".format(dest.resume_token)))
+        return plan
+    if src is None or not len(src):
+        plan.problem = "no source snapshots"
+        plan.error = ZfsReplicationNoRemoteSnapshots("No source snapshots to replicate",
+                                                     "src-host: {}".format(src_host),
+                                                     "src-filesystem: {}".format(src_dataset))
+        return plan
+    collisions = src.name_collisions(dest)
+    if collisions:
+        names = ", ".join(record.name for (record, _) in collisions)
+        plan.problem = "snapshots with the same name but different guids: {}".format(names)
+        plan.error = ZfsReplicationSnapshotMismatch("Snapshots with the same name but different guids: {}".format(
+                                                        names),
+                                                    "src-host: {}".format(src_host),
+                                                    "src_filesystem: {}".format(src_dataset),
+                                                    "dest-host: {}".format(dest_host),
+                                                    "dest_filesystem: {}".format(dest_dataset))
+        return plan
+    ## What the destination will look like once the transfers are done
+    projected = snapshot_catalog.SnapshotCatalog(dest_dataset, list(dest))
+    if not len(dest):
+        base = src.oldest()
+        plan.transfers.append(replication_plan.PlannedTransfer('full', send_command(src, base, flags=flags),
+                                                               [base.name]))
+        projected.append_received([base])
+    else:
+        base = src.last_common_base(dest)
+        if base is None:
+            plan.problem = "no snapshots in common"
+            plan.error = ZfsReplicationNoSnapshotsInCommon("No snapshots in common. ",
+                                                           "src-host: {}".format(src_host),
+                                                           "src_filesystem: {}".format(src_dataset),
+                                                           "dest-host: {}".format(dest_host),
+                                                           "dest_filesystem: {}".format(dest_dataset))
+            return plan
+    if isinstance(base, snapshot_catalog.BookmarkRecord) and src.after(base):
+        ## 'zfs send -I' can't start from a bookmark: send the next snapshot on its own first
+        first = src.after(base)[0]
+        plan.transfers.append(replication_plan.PlannedTransfer('incremental', send_command(src, first, base, flags),
+                                                               [first.name], base.guid))
+        projected.received_incremental(base, [first])
+        base = first
+    if src.after(base):
+        plan.transfers.append(replication_plan.PlannedTransfer(
+            'incremental', send_command(src, src.latest(), base, flags),
+            [record.name for record in src.after(base)], base.guid))
+        projected.received_incremental(base, src.after(base))
+    plan.doomed = [record.name for record in
+                   snapshots_to_prune(src, projected, delete_snapshots_not_in_src, policy)]
+    return plan
+
+def plan_tree(src_filesystem, dest_filesystem, src_catalog, dest_catalog,
+              delete_snapshots_not_in_src=False, retention=None, src_host='localhost', dest_host='localhost'):
+    """Return a DatasetPlan (see plan_dataset) for SRC_FILESYSTEM and each of its descendants.
+
+    Each dataset's sends use the flags send_flags picks for it between
+    SRC_HOST and DEST_HOST."""
+    plans = []
+    with metrics.phase('planning'):
+        for filesystem in [''] + dependent_zfs_filesystems(src_filesystem, catalog=src_catalog):
+            src_dataset = "{}/{}".format(src_filesystem, filesystem) if filesystem else src_filesystem
+            dest_dataset = "{}/{}".format(dest_filesystem, filesystem) if filesystem else dest_filesystem
+            plans.append(plan_dataset(filesystem, src_dataset, dest_dataset, src_catalog, dest_catalog,
+                                      delete_snapshots_not_in_src,
+                                      retention.policy_for(dest_dataset) if retention else None,
+                                      send_flags(src_host, src_dataset, dest_host, dest_dataset,
+                                                 dest_dataset in dest_catalog)
+                                      if dest_dataset in dest_catalog or not filesystem else "",
+                                      src_host, dest_host))
+    return plans
+
+def estimate_plan(src_host, plans, jobs=1):
+    """Fill in the estimated size of every transfer in PLANS, asking up to JOBS at a time.
+
+    The estimates are kept in send_estimates, so the transfers
+    themselves don't ask again."""
+    pending = Queue.Queue()
+    for plan in plans:
+        for transfer in plan.transfers:
+            pending.put(transfer)
+
+    def worker():
+        while True:
+            try:
+                transfer = pending.get_nowait()
+            except Queue.Empty:
+                return
+            (transfer.estimated_bytes, plain) = estimate_send_size(src_host, transfer.send_cmd, plain=not quiet)
+            if transfer.estimated_bytes is not None:
+                send_estimates[(src_host, transfer.send_cmd)] = (transfer.estimated_bytes, plain)
+
+    if not pending.empty():
+        with metrics.phase('planning'):
+            executor.gather(*[worker] * max(1, min(jobs, pending.qsize())))
+
+def print_plan(plans, src_host, dest_host):
+    """Print PLANS in the order they will be carried out (with each transfer's 'zfs send' if verbose)."""
+    weights = replication_plan.subtree_bytes(plans)
+    by_name = dict((plan.filesystem, plan) for plan in plans)
+
+    def size(count):
+        return replication_metrics.format_bytes(count) if count is not None else "?"
+
+    lines = ["Plan ({} estimated):".format(size(sum(plan.estimated_bytes() for plan in plans)))]
+    for filesystem in replication_plan.execution_order([plan.filesystem for plan in plans], weights):
+        plan = by_name[filesystem]
+        if plan.problem is not None:
+            steps = ["not replicated: {}".format(plan.problem)]
         else:
-            ## Live run - recurse after transferring initial snapshot
-            if verbose:
-                print "Have transferred initial snapshot {}. Will recurse to transfer remaining snapshots."
-            return replicate_snapshots(src_host, src_filesystem,
-                                       dest_host, dest_filesystem,
-                                       dry_run = False,
-                                       delete_snapshots_not_in_src = delete_snapshots_not_in_src)
-
-    if not last_common_snapshot:
-        raise ZfsReplicationNoSnapshotsInCommon("No snapshots in common. ",
-                                                "src-host: {}".format(src_host),
-                                                "src_filesystem: {}".format(src_filesystem),
-                                                "dest-host: {}".format(dest_host),
-                                                "dest_filesystem: {}".format(dest_filesystem))
-    if last_src_snapshot == last_common_snapshot:
+            steps = []
+            for transfer in plan.transfers:
+                if transfer.kind == 'resume':
+                    steps.append("resume interrupted receive ({})".format(size(transfer.estimated_bytes)))
+                elif transfer.kind == 'full':
+                    steps.append("seed with '{}' ({})".format(transfer.snapshots[0], size(transfer.estimated_bytes)))
+                else:
+                    steps.append("send {} snapshot(s) to '{}' ({})".format(
+                        len(transfer.snapshots), transfer.snapshots[-1], size(transfer.estimated_bytes)))
+            if plan.doomed:
+                steps.append("prune {} snapshot(s)".format(len(plan.doomed)))
+            if not steps:
+                steps.append("up to date")
+        lines.append("  {}:{} -> {}:{}: {}".format(src_host, plan.src_dataset, dest_host, plan.dest_dataset,
+                                                  ", then ".join(steps)))
+        if verbose:
+            lines.extend("    {}".format(transfer.send_cmd) for transfer in plan.transfers)
+    say("\n".join(lines))
+
+def consistent_for_recursive_stream(src, dest, base, target):
+    """Can SRC's dataset go in a 'zfs send -R -I BASE TARGET' received onto DEST?
+
+    BASE and TARGET are snapshots of the top of the tree; SRC (and DEST,
+    which is None if the dataset does not exist on the destination) must
+    have them by name. A dataset created since BASE is sent in full, so
+    it must not exist on the destination yet. Otherwise the destination
+    must have BASE (by guid) as its newest snapshot, with no interrupted
+    receive and no snapshots sharing a name but not a guid: the stream
+    is received without -F, which on a replication stream would also
+    destroy destination snapshots the source no longer has."""
+    src_base = src.find_name(base.name)
+    if src.find_name(target.name) is None:
+        return False
+    if src_base is None:
+        return dest is None
+    if dest is None or dest.resume_token or not len(dest):
+        return False
+    return dest.latest().guid == src_base.guid and not src.name_collisions(dest)
+
+def plan_recursive_stream(src_filesystem, dest_filesystem, src_catalog, dest_catalog):
+    """Work out a single 'zfs send -R -I' bringing DEST_FILESYSTEM's tree up to date.
+
+    Return (base, target, excluded): the stream goes from SRC_FILESYSTEM's
+    last snapshot in common with the destination to its newest one, and
+    leaves out the source datasets in EXCLUDED (and so their
+    descendants), which have diverged from the destination and need
+    replicating one by one. Return None if the top of the tree itself
+    can't be sent this way, or is up to date."""
+    src = src_catalog.get(src_filesystem)
+    dest = dest_catalog.get(dest_filesystem)
+    if src is None or dest is None or not len(src):
+        return None
+    base = src.last_common(dest)
+    target = src.latest()
+    if base is None or base is target or not consistent_for_recursive_stream(src, dest, base, target):
+        return None
+    excluded = []
+    for dataset in sorted(src_catalog):
+        if dataset == src_filesystem or any(catalog_cache.in_tree(dataset, other) for other in excluded):
+            continue
+        child_dest = dest_catalog.get(dest_filesystem + dataset[len(src_filesystem):])
+        if not consistent_for_recursive_stream(src_catalog[dataset], child_dest, base, target):
+            excluded.append(dataset)
+    return (base, target, excluded)
+
+def replicate_recursive_stream(src_host, src_filesystem, dest_host, dest_filesystem,
+                               dry_run=True, src_catalog=None, dest_catalog=None):
+    """Bring as much of DEST_FILESYSTEM's tree up to date as one 'zfs send -R -I' can.
+
+    The stream carries properties, and creates children made on the
+    source since the last common snapshot. The destination tree is
+    listed again afterwards and DEST_CATALOG replaced with it, so the
+    usual per-filesystem pass that follows finds the datasets the
+    stream dealt with up to date and only has work to do for the
+    diverged ones. Nothing is sent if datasets would have to be left
+    out and the source's zfs has no 'zfs send -X' (see
+    send_features.EXCLUDE_VERSION). Return whether a stream was sent
+    successfully."""
+    with metrics.phase('planning', src_filesystem):
+        plan = plan_recursive_stream(src_filesystem, dest_filesystem, src_catalog, dest_catalog)
+    if plan is None:
+        if verbose:
+            say("  Can't send {}:{} as one recursive stream".format(src_host, src_filesystem))
+        return False
+    (base, target, excluded) = plan
+    src = src_catalog[src_filesystem]
+    flags = send_flags(src_host, src_filesystem, dest_host, dest_filesystem)
+    ## One stream has one set of flags: a dataset that must be sent with
+    ## others (raw, or not) goes on its own too
+    other_flags = []
+    for dataset in sorted(src_catalog):
+        dest_dataset = dest_filesystem + dataset[len(src_filesystem):]
+        if (dataset == src_filesystem or dest_dataset not in dest_catalog
+                or any(catalog_cache.in_tree(dataset, other) for other in excluded + other_flags)):
+            continue
+        if send_flags(src_host, dataset, dest_host, dest_dataset) != flags:
+            other_flags.append(dataset)
+    if (excluded or other_flags) and not features_of(src_host).at_least(send_features.EXCLUDE_VERSION):
+        ## Without 'zfs send -X' the stream would take them along
         if not quiet:
-            print "    Destination up to date. Last source snapshot '{}' already on destination filesystem {}:{}.".format(
-                strip_filesystem_name(last_src_snapshot), dest_host, dest_filesystem)
+            say("  Not sending {}:{} as one recursive stream: leaving children out needs OpenZFS {}.{}".format(
+                src_host, src_filesystem, *send_features.EXCLUDE_VERSION))
+        return False
+    if not quiet:
+        say("  Sending {}:{} recursively, from '{}' to '{}'".format(src_host, src_filesystem,
+                                                                    base.name, target.name))
+        for dataset in excluded:
+            say("    Leaving out diverged {}:{}, to be replicated on its own".format(src_host, dataset))
+        for dataset in other_flags:
+            say("    Leaving out {}:{}, which needs other send flags, to be replicated on its own".format(
+                src_host, dataset))
+    excluded = excluded + other_flags
+    send_cmd = "sudo zfs send {}-R {}-I {} {}".format(send_features.flag_argument(flags),
+                                                     "-X {} ".format(",".join(excluded)) if excluded else "",
+                                                     src.full_name(base), src.full_name(target))
+    transferred = run_transfer(src_host, send_cmd,
+                               dest_host, "sudo zfs receive -u {}".format(dest_filesystem),
+                               dry_run, dataset=src_filesystem)
+    if not transferred:
+        say("  Recursive stream of {}:{} failed; replicating each filesystem on its own".format(
+            src_host, src_filesystem), sys.stderr)
+    elif not dry_run:
+        catalogs = fetch_catalog(dest_filesystem, dest_host, bookmarks=False)
+        if catalogs:
+            ## Datasets created since BASE came in full, with the stream's flags
+            created = sorted(set(catalogs) - set(dest_catalog))
+            dest_catalog.clear()
+            dest_catalog.update(catalogs)
+            if 'L' in flags and created:
+                mark_large_blocks(dest_host, created, dry_run)
+    return transferred
+
+class ConcurrencyLimits(object):
+    """Caps on how many replications may share a source host or destination pool.
+
+    A limit of 0 means no limit."""
+
+    def __init__(self, max_per_src_host=0, max_per_dest_pool=0):
+        self.max_per_src_host = max_per_src_host
+        self.max_per_dest_pool = max_per_dest_pool
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _semaphore(self, key, limit):
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.Semaphore(limit)
+            return self._semaphores[key]
+
+    def acquire(self, src_host, dest_host, dest_filesystem):
+        """Block until there is room for one more replication; return a token for release()."""
+        return self.acquire_for_targets(src_host, [(dest_host, dest_filesystem)])
+
+    def acquire_for_targets(self, src_host, targets):
+        """Like acquire, for one replication writing to each of TARGETS ((dest_host, dest_filesystem) pairs).
+
+        Semaphores are always taken in the same order (source host,
+        then destination pools in sorted order), so workers can't
+        deadlock each other."""
+        taken = []
+        if self.max_per_src_host > 0:
+            taken.append(self._semaphore(('src-host', src_host), self.max_per_src_host))
+        if self.max_per_dest_pool > 0:
+            for (dest_host, dest_pool) in sorted(set((dest_host, send_features.pool_of(dest_filesystem))
+                                                     for (dest_host, dest_filesystem) in targets)):
+                taken.append(self._semaphore(('dest-pool', dest_host, dest_pool), self.max_per_dest_pool))
+        for semaphore in taken:
+            semaphore.acquire()
+        return taken
+
+    def release(self, taken):
+        for semaphore in reversed(taken):
+            semaphore.release()
+
+def run_parents_first(filesystems, work, jobs=1, weights=None):
+    """Call WORK on each of FILESYSTEMS using up to JOBS worker threads.
+
+    FILESYSTEMS are child filesystem names relative to a common root,
+    in 'zfs list' order. A filesystem is only handed to WORK once its
+    parent (if it is in FILESYSTEMS) has been dealt with. Ready
+    filesystems are started heaviest first by WEIGHTS (a dict, e.g.
+    replication_plan.subtree_bytes), if given, and otherwise in their
+    original order, so with a single job and no weights this is the
+    same order as a plain loop. WORK must not raise."""
+    if not filesystems:
         return
-    maybe_run_command(("{} sudo zfs send -I {} {} ".format(maybe_ssh(src_host),
-                                                           last_common_snapshot, last_src_snapshot)
-                       + "| {} sudo zfs receive -F {}".format(maybe_ssh(dest_host), dest_filesystem)),
-                      dry_run)
+    order = dict((filesystem, (-(weights or {}).get(filesystem, 0), index))
+                 for (index, filesystem) in enumerate(filesystems))
+    waiting = {}
+    ready = Queue.PriorityQueue()
+    for filesystem in filesystems:
+        parent = replication_plan.parent_of(filesystem, order)
+        if parent:
+            waiting.setdefault(parent, []).append(filesystem)
+        else:
+            ready.put((order[filesystem], filesystem))
+
+    workers = []
+    lock = threading.Lock()
+    remaining = [len(filesystems)]
+
+    def worker():
+        while True:
+            (index, filesystem) = ready.get()
+            if filesystem is None:
+                return
+            try:
+                work(filesystem)
+            finally:
+                with lock:
+                    for child in waiting.pop(filesystem, []):
+                        ready.put((order[child], child))
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        for _ in workers:
+                            ready.put(((sys.maxint, 0), None))
+
+    for _ in range(max(1, min(jobs, len(filesystems)))):
+        workers.append(threading.Thread(target=worker))
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        ## join with a timeout so that Ctrl-C still gets through
+        while thread.is_alive():
+            thread.join(1)
+
+def print_replication_error(e, src_host, src_filesystem):
+    """Explain to stderr why replicating SRC_FILESYSTEM raised E."""
+    if isinstance(e, ZfsReplicationListingFailed):
+        say("    {}: {}; not replicating it".format(e[0], e[1]), sys.stderr)
+    elif isinstance(e, ZfsReplicationNoRemoteSnapshots):
+        say("    Exception:  {}\n     {} {}".format(e[0], e[1], e[2]), sys.stderr)
+    elif isinstance(e, (ZfsReplicationNoSnapshotsInCommon, ZfsReplicationSnapshotMismatch)):
+        say("    Exception:  {}\n     {} {}\n     {} {}".format(e[0], e[1], e[2], e[3], e[4]), sys.stderr)
+    else:
+        say("    Exception replicating {}:{}: {}: {}".format(src_host, src_filesystem, type(e), e), sys.stderr)
 
 def replicate_snapshots_recursively(src_host, src_filesystem,
                                     dest_host, dest_filesystem,
                                     dry_run=True,
-                                    delete_snapshots_not_in_src=False):
-    print "Copying ZFS snapshots from {}:{} to {}:{} recursively".format(src_host, src_filesystem,
-                                                                         dest_host, dest_filesystem)
-    replicate_snapshots(src_host, src_filesystem,
-                        dest_host, dest_filesystem,
-                        dry_run=dry_run,
-                        delete_snapshots_not_in_src=delete_snapshots_not_in_src)
+                                    delete_snapshots_not_in_src=False,
+                                    jobs=1,
+                                    limits=None,
+                                    recursive_stream=False,
+                                    retention=None,
+                                    src_catalog=None,
+                                    dest_catalog=None,
+                                    plan_json=None):
+    """Replicate SRC_FILESYSTEM and then its children, up to JOBS children at once.
 
-    src_subfilesystems = dependent_zfs_filesystems(src_filesystem, src_host)
-    dest_subfilesystems = dependent_zfs_filesystems(dest_filesystem, dest_host)
-    for filesystem in src_subfilesystems:
-        if filesystem in dest_subfilesystems:
-            try:
-                print "  Copying ZFS snapshots from {}:{}/{} to {}:{}/{}".format(src_host,
-                                                                                 src_filesystem,
-                                                                                 filesystem,
-                                                                                 dest_host,
-                                                                                 dest_filesystem,
-                                                                                 filesystem)
-                replicate_snapshots(src_host, "{}/{}".format(src_filesystem, filesystem),
-                                    dest_host, "{}/{}".format(dest_filesystem, filesystem),
-                                    dry_run=dry_run,
-                                    delete_snapshots_not_in_src=delete_snapshots_not_in_src)
-            except ZfsReplicationNoRemoteSnapshots as e:
-                print >> sys.stderr, "    Exception: ", e[0]
-                print >> sys.stderr, "    ", e[1], e[2]
-            except ZfsReplicationNoSnapshotsInCommon as e:
-                print >> sys.stderr, "    Exception: ", e[0]
-                print >> sys.stderr, "    ", e[1], e[2]
-                print >> sys.stderr, "    ", e[3], e[4]
-        else:
-            print >> sys.stderr, "  destination filesystem {}:{}/{} does not exist. Not replicating {}:{}/{}".format(
+    With RECURSIVE_STREAM, first send as much of the tree as possible in
+    one 'zfs send -R' (see replicate_recursive_stream). The rest is
+    planned (see plan_tree); with more than one job, in a dry run, or if
+    the plan is to be written as JSON to PLAN_JSON, the plan's sends are
+    sized first. The plan is then carried out (see replicate_snapshots),
+    children largest subtree first; a dry run prints it instead. Then
+    prune the destination tree: auto-snapshots not on the source if
+    DELETE_SNAPSHOTS_NOT_IN_SRC, and those the RETENTION rules don't keep
+    (see prune_tree). SRC_CATALOG and DEST_CATALOG, if given, are the two
+    trees' catalogs, already listed. Return the number of filesystems that
+    could not be replicated."""
+    if limits is None:
+        limits = ConcurrencyLimits()
+    say("Copying ZFS snapshots from {}:{} to {}:{} recursively".format(src_host, src_filesystem,
+                                                                       dest_host, dest_filesystem))
+    if src_catalog is None or dest_catalog is None:
+        (src_catalog, dest_catalog, _) = executor.gather(lambda: fetch_catalog(src_filesystem, src_host),
+                                                         lambda: fetch_dest_catalog(dest_filesystem, dest_host),
+                                                         lambda: probe_send_features(src_host, dest_host))
+    if recursive_stream:
+        replicate_recursive_stream(src_host, src_filesystem, dest_host, dest_filesystem,
+                                   dry_run=dry_run, src_catalog=src_catalog, dest_catalog=dest_catalog)
+    plans = plan_tree(src_filesystem, dest_filesystem, src_catalog, dest_catalog,
+                      delete_snapshots_not_in_src=delete_snapshots_not_in_src, retention=retention,
+                      src_host=src_host, dest_host=dest_host)
+    if jobs > 1 or dry_run or plan_json:
+        estimate_plan(src_host, plans, jobs)
+    if plan_json:
+        replication_metrics.write_atomically(plan_json, replication_plan.plan_to_json(
+            plans, src_host=src_host, src_filesystem=src_filesystem,
+            dest_host=dest_host, dest_filesystem=dest_filesystem))
+    by_name = dict((plan.filesystem, plan) for plan in plans)
+    failures = []
+    if dry_run:
+        ## The plan says what would be sent; its transfers aren't walked through again
+        print_plan(plans, src_host, dest_host)
+        if by_name[''].error is not None:
+            raise by_name[''].error
+        succeeded = True
+        failures.extend(plan.filesystem for plan in plans if plan.filesystem and plan.error is not None)
+    else:
+        succeeded = replicate_snapshots(src_host, src_filesystem,
+                                        dest_host, dest_filesystem,
+                                        dry_run=dry_run,
+                                        delete_snapshots_not_in_src=delete_snapshots_not_in_src,
+                                        src_catalog=src_catalog,
+                                        dest_catalog=dest_catalog,
+                                        plan=by_name[''])
+
+    src_subfilesystems = dependent_zfs_filesystems(src_filesystem, src_host, src_catalog)
+    dest_subfilesystems = set(dependent_zfs_filesystems(dest_filesystem, dest_host, dest_catalog))
+
+    def replicate_child(filesystem):
+        if filesystem not in dest_subfilesystems:
+            say("  destination filesystem {}:{}/{} does not exist. Not replicating {}:{}/{}".format(
                 dest_host,
                 dest_filesystem,
                 filesystem,
                 src_host,
                 src_filesystem,
-                filesystem,)
+                filesystem,), sys.stderr)
+            return
+        taken = limits.acquire(src_host, dest_host, dest_filesystem)
+        try:
+            say("  Copying ZFS snapshots from {}:{}/{} to {}:{}/{}".format(src_host,
+                                                                           src_filesystem,
+                                                                           filesystem,
+                                                                           dest_host,
+                                                                           dest_filesystem,
+                                                                           filesystem))
+            if not replicate_snapshots(src_host, "{}/{}".format(src_filesystem, filesystem),
+                                       dest_host, "{}/{}".format(dest_filesystem, filesystem),
+                                       dry_run=dry_run,
+                                       delete_snapshots_not_in_src=delete_snapshots_not_in_src,
+                                       src_catalog=src_catalog,
+                                       dest_catalog=dest_catalog,
+                                       plan=by_name[filesystem]):
+                failures.append(filesystem)
+        except Exception as e:
+            failures.append(filesystem)
+            print_replication_error(e, src_host, "{}/{}".format(src_filesystem, filesystem))
+        finally:
+            limits.release(taken)
+
+    if not dry_run:
+        run_parents_first(src_subfilesystems, replicate_child, jobs, replication_plan.subtree_bytes(plans))
+    failed = set("{}/{}".format(dest_filesystem, filesystem) for filesystem in failures)
+    if not succeeded:
+        failed.add(dest_filesystem)
+    ## Bookmarking (on the source) and pruning (on the destination) at the same time
+    wanted = bookmarks_wanted(src_filesystem, dest_host, dest_filesystem, src_catalog, dest_catalog, skip=failed)
+    (pruned, _) = executor.gather(lambda: prune_tree(src_filesystem, dest_host, dest_filesystem,
+                                                     src_catalog, dest_catalog, dry_run=dry_run,
+                                                     delete_snapshots_not_in_src=delete_snapshots_not_in_src,
+                                                     retention=retention, skip=failed),
+                                  lambda: create_bookmarks(src_host, src_catalog, wanted,
+                                                           bookmark_tag(dest_host, dest_filesystem), dry_run))
+    if not pruned:
+        say("  Failed to prune some snapshots from {}:{}".format(dest_host, dest_filesystem), sys.stderr)
+    if not dry_run:
+        save_dest_catalog(dest_filesystem, dest_host, dest_catalog, failed)
+    if failures:
+        say("  {} child filesystem(s) failed to replicate: {}".format(len(failures),
+                                                                      ", ".join(sorted(failures))), sys.stderr)
+    return len(failures) + (0 if succeeded else 1)
+
+def fanout_dataset(src_host, src_dataset, dest_datasets, targets, src_catalog, dest_catalogs,
+                   dry_run=True, limits=None):
+    """Send SRC_DATASET's new snapshots to several destinations with one 'zfs send'.
+
+    DEST_DATASETS[i] is the dataset on TARGETS[i] ((dest_host,
+    dest_filesystem) pairs) matching SRC_DATASET, and DEST_CATALOGS[i]
+    that target's catalogs. Destinations whose last common snapshot
+    with the source is the same, and that take the same send flags
+    (see send_flags), get a single incremental stream, teed to all of
+    them. Destinations with nothing in common with any other,
+    or that need anything more than a plain incremental (a seed, a
+    resumed receive, a name collision), are left alone. Catalogs are
+    updated; a destination whose part failed is listed again, so that
+    replicate_snapshots then resumes it on its own."""
+    src = src_catalog.get(src_dataset)
+    if src is None or not len(src):
+        return
+    groups = {}
+    for index in range(len(targets)):
+        dest = dest_catalogs[index].get(dest_datasets[index])
+        if dest is None or not len(dest) or dest.resume_token or src.name_collisions(dest):
+            continue
+        last_common = src.last_common_base(dest)
+        ## One anchored on a bookmark is left to replicate_snapshots, which knows how to send from it
+        if (last_common is not None and last_common is not src.latest()
+                and not isinstance(last_common, snapshot_catalog.BookmarkRecord)):
+            (dest_host, _) = targets[index]
+            flags = send_flags(src_host, src_dataset, dest_host, dest_datasets[index])
+            groups.setdefault((last_common.guid, flags), []).append(index)
+    for ((guid, flags), indexes) in sorted(groups.items()):
+        if len(indexes) < 2:
+            continue
+        base = src.find_guid(guid)
+        group = [targets[index] for index in indexes]
+        taken = limits.acquire_for_targets(src_host, group) if limits else []
+        try:
+            if not quiet:
+                say("  Sending {}:{} to {} destinations at once".format(src_host, src_dataset, len(indexes)))
+            results = run_fanout_transfer(src_host, send_command(src, src.latest(), base, flags),
+                                          [(dest_host, "sudo zfs receive -s -F {}".format(dest_datasets[index]))
+                                           for (index, (dest_host, _)) in zip(indexes, group)],
+                                          dry_run, dataset=src_dataset)
+        finally:
+            if limits:
+                limits.release(taken)
+        if dry_run:
+            continue
+        for (index, transferred) in zip(indexes, results):
+            (dest_host, _) = targets[index]
+            dest = dest_catalogs[index][dest_datasets[index]]
+            if transferred:
+                dest.received_incremental(base, src.after(base))
+            else:
+                say("    {}:{} will be finished on its own".format(dest_host, dest_datasets[index]), sys.stderr)
+                dest_catalogs[index][dest_datasets[index]] = fetch_catalog(
+                    dest_datasets[index], dest_host, recursive=False, bookmarks=False).get(dest_datasets[index], dest)
+
+def replicate_to_many(src_host, src_filesystem, targets,
+                      dry_run=True,
+                      delete_snapshots_not_in_src=False,
+                      jobs=1,
+                      limits=None,
+                      recursive_stream=False,
+                      retention=None,
+                      src_catalog=None,
+                      dest_catalogs=None):
+    """Replicate SRC_FILESYSTEM's tree to each of TARGETS ((dest_host, dest_filesystem) pairs).
+
+    Each dataset is first sent to all the destinations it can be with
+    one teed 'zfs send' (see fanout_dataset), so the source reads and
+    sends it once rather than once per destination. Then each target is
+    replicated as usual (see replicate_snapshots_recursively), which
+    finds those datasets up to date and deals with anything else on its
+    own. SRC_CATALOG and DEST_CATALOGS (one per target), if given, are
+    the trees' catalogs, already listed. Print how each target fared,
+    and return the total number of filesystems that could not be
+    replicated."""
+    if limits is None:
+        limits = ConcurrencyLimits()
+    say("Copying ZFS snapshots from {}:{} to {} destinations".format(src_host, src_filesystem, len(targets)))
+    if src_catalog is None or dest_catalogs is None:
+        catalogs = executor.gather(lambda: probe_send_features(src_host, *[host for (host, _) in targets]),
+                                   lambda: fetch_catalog(src_filesystem, src_host),
+                                   *[(lambda dest_host=dest_host, dest_filesystem=dest_filesystem:
+                                      fetch_dest_catalog(dest_filesystem, dest_host))
+                                     for (dest_host, dest_filesystem) in targets])
+        (src_catalog, dest_catalogs) = (catalogs[1], catalogs[2:])
+
+    def fanout(filesystem):
+        src_dataset = "{}/{}".format(src_filesystem, filesystem) if filesystem else src_filesystem
+        dest_datasets = ["{}/{}".format(dest_filesystem, filesystem) if filesystem else dest_filesystem
+                         for (_, dest_filesystem) in targets]
+        try:
+            fanout_dataset(src_host, src_dataset, dest_datasets, targets, src_catalog, dest_catalogs,
+                           dry_run=dry_run, limits=limits)
+        except Exception as e:
+            print_replication_error(e, src_host, src_dataset)
+
+    fanout("")
+    run_parents_first(dependent_zfs_filesystems(src_filesystem, src_host, src_catalog), fanout, jobs)
+
+    failures = []
+    for ((dest_host, dest_filesystem), dest_catalog) in zip(targets, dest_catalogs):
+        failures.append(replicate_snapshots_recursively(src_host, src_filesystem,
+                                                        dest_host, dest_filesystem,
+                                                        dry_run=dry_run,
+                                                        delete_snapshots_not_in_src=delete_snapshots_not_in_src,
+                                                        jobs=jobs,
+                                                        limits=limits,
+                                                        recursive_stream=recursive_stream,
+                                                        retention=retention,
+                                                        src_catalog=src_catalog,
+                                                        dest_catalog=dest_catalog))
+    lines = ["Replicated {}:{} to:".format(src_host, src_filesystem)]
+    for ((dest_host, dest_filesystem), failed) in zip(targets, failures):
+        lines.append("  {}:{}: {}".format(dest_host, dest_filesystem,
+                                          "{} filesystem(s) failed".format(failed) if failed else "OK"))
+    say("\n".join(lines))
+    return sum(failures)
+
+def lock_destinations(targets, wait=None):
+    """Lock the destination trees TARGETS ((host, filesystem) pairs) against other runs and jobs.
+
+    Return a token for locks.release. Raise dataset_locks.LockBusy if
+    one of them is still held by another run (or by another job of this
+    one) after WAIT seconds (default: --lock-wait)."""
+    token = locks.acquire(targets, lock_wait if wait is None else wait)
+    while locks.stale:
+        say("Reusing stale lock left by a run that died: {}".format(locks.stale.pop(0)), sys.stderr)
+    return token
+
+def subtree(catalogs, filesystem):
+    """Return the part of CATALOGS (dataset -> SnapshotCatalog) for FILESYSTEM and its descendants."""
+    return dict((dataset, catalog) for (dataset, catalog) in catalogs.iteritems()
+                if catalog_cache.in_tree(dataset, filesystem))
+
+def run_config_jobs(config_jobs, dry_run=True, max_jobs=1, limits=None):
+    """Run CONFIG_JOBS (replication_config.ReplicationJobs) in this one process, up to MAX_JOBS at once.
+
+    Each pool involved is listed once, up front, rather than once per
+    job, and every job works from its part of that listing; destination
+    pools are left to each job when --catalog-cache is in use, since
+    the cache is kept per destination tree. All the jobs share the ssh
+    connections and the LIMITS on concurrent replications per source
+    host and destination pool. Each job locks its destination trees
+    while it runs, so jobs (here or in other runs) writing to the same
+    datasets take turns, for up to --lock-wait seconds. Print how each
+    job fared, and return the total number of filesystems that could
+    not be replicated, counting each job skipped for want of its locks
+    as one."""
+    if limits is None:
+        limits = ConcurrencyLimits()
+    src_pools = set((job.src_host, send_features.pool_of(job.src_filesystem)) for job in config_jobs)
+    pools = set(src_pools)
+    for job in config_jobs:
+        if saved_catalogs is None:
+            pools.update((dest_host, send_features.pool_of(dest_filesystem))
+                         for (dest_host, dest_filesystem) in job.targets)
+    pools = sorted(pools)
+    if not quiet:
+        say("Listing {} pool(s) for {} job(s)".format(len(pools), len(config_jobs)))
+    hosts = set([job.src_host for job in config_jobs] + [host for job in config_jobs for (host, _) in job.targets])
+
+    def list_pool(host, pool):
+        try:
+            return fetch_catalog(pool, host, bookmarks=(host, pool) in src_pools)
+        except ZfsReplicationListingFailed:
+            ## Each job using it lists its own tree instead, and fails if that fails too
+            return None
+
+    listings = executor.gather(lambda: probe_send_features(*hosts),
+                               *[(lambda host=host, pool=pool: list_pool(host, pool)) for (host, pool) in pools])
+    pool_catalogs = dict((key, listing) for (key, listing) in zip(pools, listings[1:]) if listing is not None)
+
+    def catalogs_for(host, filesystem, destination=False):
+        if (host, send_features.pool_of(filesystem)) not in pool_catalogs:
+            return fetch_dest_catalog(filesystem, host) if destination else fetch_catalog(filesystem, host)
+        return subtree(pool_catalogs[(host, send_features.pool_of(filesystem))], filesystem)
+
+    pending = Queue.Queue()
+    for (index, job) in enumerate(config_jobs):
+        pending.put((index, job))
+    failures = {}
+    skipped = {}
+
+    def worker():
+        while True:
+            try:
+                (index, job) = pending.get_nowait()
+            except Queue.Empty:
+                return
+            (token, fresh) = (None, False)
+            try:
+                if not dry_run:
+                    try:
+                        token = lock_destinations(job.targets, wait=0)
+                    except dataset_locks.LockBusy as e:
+                        if not quiet:
+                            say("Waiting for {} to release {}".format(e[1], e[0]))
+                        token = lock_destinations(job.targets)
+                        ## Someone else has written to these trees since they were listed
+                        fresh = True
+                src_catalog = catalogs_for(job.src_host, job.src_filesystem)
+                dest_catalogs = [fetch_dest_catalog(dest_filesystem, dest_host) if fresh
+                                 else catalogs_for(dest_host, dest_filesystem, destination=True)
+                                 for (dest_host, dest_filesystem) in job.targets]
+                if len(job.targets) > 1:
+                    failures[index] = replicate_to_many(
+                        job.src_host, job.src_filesystem, job.targets, dry_run=dry_run,
+                        delete_snapshots_not_in_src=job.delete, jobs=job.jobs, limits=limits,
+                        recursive_stream=job.recursive_stream, retention=job.retention,
+                        src_catalog=src_catalog, dest_catalogs=dest_catalogs)
+                else:
+                    ((dest_host, dest_filesystem),) = job.targets
+                    failures[index] = replicate_snapshots_recursively(
+                        job.src_host, job.src_filesystem, dest_host, dest_filesystem, dry_run=dry_run,
+                        delete_snapshots_not_in_src=job.delete, jobs=job.jobs, limits=limits,
+                        recursive_stream=job.recursive_stream, retention=job.retention,
+                        src_catalog=src_catalog, dest_catalog=dest_catalogs[0])
+            except dataset_locks.LockBusy as e:
+                skipped[index] = "{} is locked by {}".format(e[0], e[1])
+            except Exception as e:
+                failures[index] = 1
+                print_replication_error(e, job.src_host, job.src_filesystem)
+            finally:
+                if token is not None:
+                    locks.release(token)
+
+    executor.gather(*[worker] * max(1, min(max_jobs, len(config_jobs))))
+    lines = ["Ran {} job(s):".format(len(config_jobs))]
+    for (index, job) in enumerate(config_jobs):
+        failed = failures.get(index, 1)
+        if index in skipped:
+            lines.append("  {}: skipped, {}".format(job.name, skipped[index]))
+        else:
+            lines.append("  {}: {}".format(job.name, "{} filesystem(s) failed".format(failed) if failed else "OK"))
+    say("\n".join(lines))
+    return sum(failures.itervalues()) + len(skipped)
+
+def audit_replica(src_host, src_filesystem, dest_host, dest_filesystem, max_lag=0, json_path=None):
+    """Compare DEST_FILESYSTEM's tree with SRC_FILESYSTEM's and print what differs.
+
+    Return 0 if the replica is in sync (allowing it to lag MAX_LAG
+    seconds behind), 1 if any dataset has a problem, and 2 if either
+    tree couldn't be listed."""
+    started = time.time()
+    try:
+        (src_catalogs, dest_catalogs) = executor.gather(lambda: fetch_catalog(src_filesystem, src_host),
+                                                        lambda: fetch_catalog(dest_filesystem, dest_host,
+                                                                              bookmarks=False))
+    except ZfsReplicationListingFailed as e:
+        say(e[0], sys.stderr)
+        return 2
+    for (host, filesystem, catalogs) in ((src_host, src_filesystem, src_catalogs),
+                                         (dest_host, dest_filesystem, dest_catalogs)):
+        if filesystem not in catalogs:
+            say("Couldn't list {}:{}".format(host, filesystem), sys.stderr)
+            return 2
+    audits = replication_audit.audit_tree(src_filesystem, dest_filesystem, src_catalogs, dest_catalogs)
+    failing = [audit for audit in audits if audit.problems(max_lag)]
+    for audit in audits:
+        (description, problems) = (audit.describe(), audit.problems(max_lag))
+        if problems or verbose or (not quiet and description != "in sync"):
+            say("  {}: {}{}".format(audit.filesystem or dest_filesystem, description,
+                                    " [{}]".format(", ".join(problems)) if problems and problems != [description] else ""))
+    if not quiet:
+        say("Audited {} dataset(s) of {}:{} against {}:{} in {:.1f}s: {}".format(
+            len(audits), src_host, src_filesystem, dest_host, dest_filesystem, time.time() - started,
+            "{} with problems".format(len(failing)) if failing else "in sync"))
+    if json_path:
+        replication_metrics.write_atomically(json_path, replication_audit.audit_to_json(
+            audits, max_lag, src_host=src_host, src_filesystem=src_filesystem,
+            dest_host=dest_host, dest_filesystem=dest_filesystem))
+    return 1 if failing else 0
+
+def write_metrics(json_path=None, prometheus_path=None):
+    """Write the run's metrics to whichever of the two files were asked for."""
+    if json_path:
+        metrics.write_json(json_path)
+    if prometheus_path:
+        metrics.write_prometheus(prometheus_path)
+
+DAEMON_RELIST_ALL = 16
+# When more source datasets than this changed between two polls, list
+# the whole source tree once rather than each of them in turn.
+
+DAEMON_MAX_RETRY_SECONDS = 3600
+
+class ReplicationDaemon(object):
+    """Keep replicating SRC_FILESYSTEM's tree to DEST_FILESYSTEM's as new snapshots appear.
+
+    Both trees are listed once at startup and their catalogs are kept
+    in memory from then on. Every INTERVAL seconds the source is polled
+    with fetch_fingerprints (no snapshots listed), and only the datasets
+    whose snapshots_changed moved are listed again; a source whose zfs
+    is too old to report snapshots_changed (see lists_snapshots_changed)
+    is listed in full instead. A dataset whose
+    newest snapshot the destination lacks is queued, and replicated
+    SETTLE seconds later by one of JOBS worker threads, longest waiting
+    first. Snapshots that turn up while a dataset is queued go in the
+    same incremental send, so a burst of them costs one transfer.
+
+    A failed dataset's destination is listed again before it is
+    retried, after INTERVAL seconds, then twice that, and so on up to
+    an hour. After a dataset is replicated its destination is pruned
+    as in prune_tree. AFTER_POLL, if given, is called after every poll."""
+
+    def __init__(self, src_host, src_filesystem, dest_host, dest_filesystem,
+                 dry_run=False, delete_snapshots_not_in_src=False, retention=None, jobs=1, limits=None,
+                 interval=60, settle=10, after_poll=None):
+        self.src_host = src_host
+        self.src_filesystem = src_filesystem
+        self.dest_host = dest_host
+        self.dest_filesystem = dest_filesystem
+        self.dry_run = dry_run
+        self.delete_snapshots_not_in_src = delete_snapshots_not_in_src
+        self.retention = retention
+        self.jobs = max(1, jobs)
+        self.limits = limits or ConcurrencyLimits()
+        self.interval = interval
+        self.settle = settle
+        self.after_poll = after_poll
+        self.src_catalog = {}
+        self.dest_catalog = {}
+        self.fingerprints = {}
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._queued = {}       # filesystem -> (waiting since, due)
+        self._running = set()
+        self._changed_while_running = set()
+        self._failures = {}     # filesystem -> consecutive failures
+        self._warned_missing = set()
+
+    ## Filesystems are named relative to the two roots, "" being the roots themselves
+
+    def src_name(self, filesystem):
+        return "{}/{}".format(self.src_filesystem, filesystem) if filesystem else self.src_filesystem
+
+    def dest_name(self, filesystem):
+        return "{}/{}".format(self.dest_filesystem, filesystem) if filesystem else self.dest_filesystem
+
+    def relative(self, src_dataset):
+        return src_dataset[len(self.src_filesystem) + 1:]
+
+    def run(self):
+        """Replicate until stop() is called (e.g. from a signal handler)."""
+        say("Replicating {}:{} to {}:{} continuously, checking for new snapshots every {}s".format(
+            self.src_host, self.src_filesystem, self.dest_host, self.dest_filesystem, self.interval))
+        ## Fingerprints first: a snapshot taken while the trees are being
+        ## listed then shows up as a change at the first poll
+        ((self.fingerprints, self.src_catalog), self.dest_catalog, _) = executor.gather(
+            lambda: (fetch_fingerprints(self.src_filesystem, self.src_host)
+                     if lists_snapshots_changed(self.src_host) else {},
+                     fetch_catalog(self.src_filesystem, self.src_host)),
+            lambda: fetch_dest_catalog(self.dest_filesystem, self.dest_host),
+            lambda: probe_send_features(self.src_host, self.dest_host))
+        for dataset in sorted(self.src_catalog):
+            filesystem = self.relative(dataset)
+            if self.needs_replication(filesystem):
+                self.schedule(filesystem, 0)
+
+        workers = [threading.Thread(target=self._worker) for _ in range(self.jobs)]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+        try:
+            while not self._stopping:
+                self._wake.wait(self.interval)
+                if self._stopping:
+                    break
+                self.poll()
+                if self.after_poll:
+                    self.after_poll()
+        finally:
+            self.stop()
+            for thread in workers:
+                ## join with a timeout so that Ctrl-C still gets through
+                while thread.is_alive():
+                    thread.join(1)
+            if not self.dry_run:
+                save_dest_catalog(self.dest_filesystem, self.dest_host, self.dest_catalog,
+                                  set(self.dest_name(filesystem) for filesystem in self._failures))
+
+    def stop(self):
+        """Let running transfers finish, then make run() return."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._wake.set()
+
+    def poll(self):
+        """List the source datasets that changed since the last poll and queue them."""
+        if lists_snapshots_changed(self.src_host):
+            found = self._changed_by_fingerprint()
+        else:
+            found = self._changed_by_listing()
+        if found is None:
+            ## A listing failed (and has said why), or the source tree is
+            ## gone: leave things be, and look again next time
+            return
+        (fingerprints, changed, listed) = found
+        for dataset in self.src_catalog.keys():
+            if dataset not in fingerprints:
+                del self.src_catalog[dataset]
+                self.fingerprints.pop(dataset, None)
+        for dataset in sorted(changed):
+            if dataset not in listed:
+                ## Not listed after all (destroyed meanwhile, or the listing
+                ## failed): leave its old fingerprint so we look again
+                continue
+            self.src_catalog[dataset] = listed[dataset]
+            if fingerprints[dataset] is not None:
+                self.fingerprints[dataset] = fingerprints[dataset]
+            filesystem = self.relative(dataset)
+            if self.dest_name(filesystem) not in self.dest_catalog:
+                ## It may have been created on the destination since we looked
+                try:
+                    self._refresh_dest(filesystem)
+                except ZfsReplicationListingFailed:
+                    continue
+            if self.needs_replication(filesystem):
+                self.schedule(filesystem, self.settle)
+
+    def _changed_by_fingerprint(self):
+        """Return (fingerprints, changed, listed) for poll, or None if the source couldn't be listed.
+
+        FINGERPRINTS are those of every source dataset, CHANGED the ones
+        whose snapshots_changed moved, and LISTED the catalogs of those."""
+        try:
+            fingerprints = fetch_fingerprints(self.src_filesystem, self.src_host)
+        except ZfsReplicationListingFailed:
+            return None
+        if not fingerprints:
+            return None
+        changed = []
+        for (dataset, fingerprint) in fingerprints.iteritems():
+            previous = self.fingerprints.get(dataset)
+            if (not fingerprint.usable() or previous is None or previous.guid != fingerprint.guid
+                    or previous.snapshots_changed != fingerprint.snapshots_changed):
+                changed.append(dataset)
+        if verbose:
+            say("  {} of {} source dataset(s) changed".format(len(changed), len(fingerprints)))
+        if len(changed) > DAEMON_RELIST_ALL:
+            try:
+                listed = fetch_catalog(self.src_filesystem, self.src_host)
+            except ZfsReplicationListingFailed:
+                return
+        else:
+            listed = {}
+            for dataset in changed:
+                try:
+                    ## '-d 1' also lists the children, with no snapshots: keep only DATASET
+                    catalog = fetch_catalog(dataset, self.src_host, recursive=False).get(dataset)
+                except ZfsReplicationListingFailed:
+                    continue
+                if catalog is not None:
+                    listed[dataset] = catalog
+        return (fingerprints, changed, listed)
+
+    def _changed_by_listing(self):
+        """Like _changed_by_fingerprint, for a source whose zfs can't list snapshots_changed.
+
+        The whole source tree is listed, and a dataset has changed if its
+        snapshots have. Its fingerprints are all None."""
+        try:
+            listed = fetch_catalog(self.src_filesystem, self.src_host)
+        except ZfsReplicationListingFailed:
+            return None
+        if not listed:
+            return None
+        changed = [dataset for (dataset, catalog) in listed.iteritems()
+                   if dataset not in self.src_catalog
+                   or [record.guid for record in catalog] != [record.guid for record in self.src_catalog[dataset]]]
+        if verbose:
+            say("  {} of {} source dataset(s) changed".format(len(changed), len(listed)))
+        return (dict.fromkeys(listed), changed, listed)
+
+    def needs_replication(self, filesystem):
+        src = self.src_catalog.get(self.src_name(filesystem))
+        if src is None or not len(src):
+            return False
+        dest = self.dest_catalog.get(self.dest_name(filesystem))
+        if dest is None:
+            if filesystem and filesystem not in self._warned_missing:
+                self._warned_missing.add(filesystem)
+                say("  destination filesystem {}:{} does not exist. Not replicating {}:{}".format(
+                    self.dest_host, self.dest_name(filesystem), self.src_host, self.src_name(filesystem)), sys.stderr)
+            return not filesystem
+        return src.latest().guid not in dest or dest.resume_token is not None
+
+    def schedule(self, filesystem, delay):
+        """Queue FILESYSTEM to be replicated in DELAY seconds, unless it already is."""
+        with self._cond:
+            if filesystem in self._running:
+                ## Whatever it is sending now may not include the new snapshots
+                self._changed_while_running.add(filesystem)
+                return
+            if filesystem in self._queued:
+                ## The send it is waiting for will pick the new snapshots up
+                return
+            now = time.time()
+            self._queued[filesystem] = (now, now + delay)
+            self._cond.notify()
+
+    def _next(self):
+        """Wait for a queued filesystem to fall due and return it, or None when stopping."""
+        with self._cond:
+            while not self._stopping:
+                now = time.time()
+                due = [(since, filesystem) for (filesystem, (since, when)) in self._queued.iteritems()
+                       if when <= now]
+                if due:
+                    filesystem = min(due)[1]
+                    del self._queued[filesystem]
+                    self._running.add(filesystem)
+                    return filesystem
+                wake = min([when for (_, when) in self._queued.itervalues()] or [now + self.interval])
+                self._cond.wait(max(wake - now, 0.1))
+            return None
+
+    def _worker(self):
+        while True:
+            filesystem = self._next()
+            if filesystem is None:
+                return
+            succeeded = False
+            try:
+                if filesystem in self._failures:
+                    ## We can't be sure what the failed attempt left behind
+                    self._refresh_dest(filesystem)
+                taken = self.limits.acquire(self.src_host, self.dest_host, self.dest_filesystem)
+                try:
+                    say("  Copying ZFS snapshots from {}:{} to {}:{}".format(
+                        self.src_host, self.src_name(filesystem), self.dest_host, self.dest_name(filesystem)))
+                    succeeded = replicate_snapshots(self.src_host, self.src_name(filesystem),
+                                                    self.dest_host, self.dest_name(filesystem),
+                                                    dry_run=self.dry_run,
+                                                    delete_snapshots_not_in_src=self.delete_snapshots_not_in_src,
+                                                    src_catalog=self.src_catalog,
+                                                    dest_catalog=self.dest_catalog)
+                    if succeeded:
+                        self._prune(filesystem)
+                        self._bookmark(filesystem)
+                finally:
+                    self.limits.release(taken)
+            except Exception as e:
+                print_replication_error(e, self.src_host, self.src_name(filesystem))
+            self._finished(filesystem, succeeded)
+
+    def _finished(self, filesystem, succeeded):
+        with self._cond:
+            self._running.discard(filesystem)
+            changed = filesystem in self._changed_while_running
+            self._changed_while_running.discard(filesystem)
+            if succeeded:
+                self._failures.pop(filesystem, None)
+            else:
+                self._failures[filesystem] = self._failures.get(filesystem, 0) + 1
+        if not succeeded:
+            delay = min(self.interval * 2 ** (self._failures[filesystem] - 1), DAEMON_MAX_RETRY_SECONDS)
+            say("  Will retry {}:{} in {}s".format(self.src_host, self.src_name(filesystem), delay), sys.stderr)
+            self.schedule(filesystem, delay)
+        elif changed and not self.dry_run and self.needs_replication(filesystem):
+            self.schedule(filesystem, self.settle)
+
+    def _prune(self, filesystem):
+        if not self.delete_snapshots_not_in_src and not self.retention:
+            return
+        dataset = self.dest_name(filesystem)
+        policy = self.retention.policy_for(dataset) if self.retention else None
+        doomed = snapshots_to_prune(self.src_catalog.get(self.src_name(filesystem)), self.dest_catalog[dataset],
+                                    self.delete_snapshots_not_in_src, policy)
+        prune_snapshots(self.dest_host, self.dest_catalog, {dataset: doomed}, self.dry_run)
+
+    def _bookmark(self, filesystem):
+        src = self.src_catalog.get(self.src_name(filesystem))
+        tag = bookmark_tag(self.dest_host, self.dest_filesystem)
+        record = bookmark_wanted(src, self.dest_catalog[self.dest_name(filesystem)], tag)
+        if record is not None:
+            create_bookmarks(self.src_host, self.src_catalog, {src.dataset: record}, tag, self.dry_run)
+
+    def _refresh_dest(self, filesystem):
+        dataset = self.dest_name(filesystem)
+        catalog = fetch_catalog(dataset, self.dest_host, recursive=False, bookmarks=False).get(dataset)
+        if catalog is not None:
+            self.dest_catalog[dataset] = catalog
+            self._warned_missing.discard(filesystem)
 
 if __name__ == '__main__':
     arguments=docopt(__doc__)
@@ -302,37 +2366,170 @@ if __name__ == '__main__':
     if arguments['--quiet']:
         verbose = False
         quiet = True
+    buffer_size = int(arguments['--buffer-size']) << 20
+    if arguments['--catalog-cache']:
+        saved_catalogs = catalog_cache.CatalogCache(arguments['--catalog-cache'])
+    progress_interval = int(arguments['--progress'])
+    split_after = float(arguments['--split-after'])
+    try:
+        if arguments['--config']:
+            config_jobs = replication_config.load(arguments['--config'])
+            targets = []
+        else:
+            targets = [(arguments['<dest-host>'], arguments['<dest-filesystem>'])]
+            targets.extend(replication_config.parse_target(target) for target in arguments['--also-to'])
+    except replication_config.BadConfig as e:
+        print >> sys.stderr, "{}: {}".format(e[0], e[1])
+        sys.exit(1)
+    except (IOError, OSError) as e:
+        print >> sys.stderr, "Can't read config: {}".format(e)
+        sys.exit(1)
+    if len(targets) > 1 and arguments['--daemon']:
+        print >> sys.stderr, "--also-to can't be used with --daemon"
+        sys.exit(1)
+    if len(targets) > 1 and arguments['--plan-json']:
+        print >> sys.stderr, "--plan-json can't be used with --also-to"
+        sys.exit(1)
+    executor.timeout = float(arguments['--timeout']) or None
+    locks.directory = arguments['--lock-dir']
+    make_bookmarks = not arguments['--no-bookmarks']
+    use_send_flags = not arguments['--no-send-flags']
+    lock_wait = float(arguments['--lock-wait'])
+    if arguments['--config']:
+        metrics.labels = {'config': arguments['--config']}
+    else:
+        metrics.labels = {'src_host': arguments['<src-host>'], 'src_filesystem': arguments['<src-filesystem>'],
+                          'dest_host': arguments['<dest-host>'], 'dest_filesystem': arguments['<dest-filesystem>']}
+    try:
+        compression = stream_compression.parse_codec(arguments['--compress'])
+    except stream_compression.UnknownCodec as e:
+        print >> sys.stderr, "{}: {}".format(e[0], e[1])
+        sys.exit(1)
+    ssh_sessions.compression = compression.uses_ssh_compression()
+    try:
+        retention = retention_policy.parse_rules(arguments['--retain'])
+    except retention_policy.BadRetentionRule as e:
+        print >> sys.stderr, "{}: {}".format(e[0], e[1])
+        sys.exit(1)
+
+    if arguments['audit']:
+        ## Read-only, so it takes no lock and may run alongside a replication
+        signal.signal(signal.SIGTERM, lambda signum, frame: executor.cancel_all())
+        sys.exit(executor.gather(lambda: audit_replica(
+            arguments['<src-host>'], arguments['<src-filesystem>'],
+            arguments['<dest-host>'], arguments['<dest-filesystem>'],
+            max_lag=float(arguments['--max-lag']),
+            json_path=arguments['--audit-json']))[0])
 
     program_name = 'replicate_zfs_snapshots.py'
 
+    lock_token = None
+    exit_status = 0
     try:
         if not quiet:
             print "{}".format(program_name)
-            print "  src-host:       ", arguments['<src-host>']
-            print "  src-filesystem: ", arguments['<src-filesystem>']
-            print "  dest-host:      ", arguments['<dest-host>']
-            print "  dest-filesystem:", arguments['<dest-filesystem>']
+            if arguments['--config']:
+                print "  config:         ", arguments['--config']
+                for job in config_jobs:
+                    print "  job:            ", "{}: {}:{} to {}".format(
+                        job.name, job.src_host, job.src_filesystem,
+                        ", ".join("{}:{}".format(dest_host, dest_filesystem)
+                                  for (dest_host, dest_filesystem) in job.targets))
+            else:
+                print "  src-host:       ", arguments['<src-host>']
+                print "  src-filesystem: ", arguments['<src-filesystem>']
+                print "  dest-host:      ", arguments['<dest-host>']
+                print "  dest-filesystem:", arguments['<dest-filesystem>']
+            for (dest_host, dest_filesystem) in targets[1:]:
+                print "  also to:        ", "{}:{}".format(dest_host, dest_filesystem)
             print "  dry-run:        ", arguments['--dry-run']
-            print "  delete:         ", arguments['--delete']
+            if not arguments['--config']:
+                print "  delete:         ", arguments['--delete']
+                for (pattern, policy) in retention.rules:
+                    print "  retain:         ", "{}: {}".format(pattern, policy)
+            print "  jobs:           ", arguments['--jobs']
+            print "  compress:       ", compression
+            print "  daemon:         ", arguments['--daemon']
 
-            ## Check we're the only copy running
-            ## http://stackoverflow.com/questions/380870/python-single-instance-of-program/1265445#1265445
-            pid_file = '/tmp/{}.pid'.format(program_name)
-            fp = open(pid_file, 'w')
+        ## Keep other runs off the destination trees (a config's jobs lock their own)
+        if not arguments['--config'] and not arguments['--dry-run']:
             try:
-                fcntl.lockf(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            except IOError:
-                # another instance is running
-                print >> sys.stderr, "Another instance of {} is running. Exiting.".format(program_name)
-                sys.exit(0)
-
-        replicate_snapshots_recursively(arguments['<src-host>'], arguments['<src-filesystem>'],
-                                        arguments['<dest-host>'], arguments['<dest-filesystem>'],
-                                        dry_run=arguments['--dry-run'],
-                                        delete_snapshots_not_in_src=arguments['--delete'])
-    except Exception as e:
+                lock_token = lock_destinations(targets)
+            except dataset_locks.LockBusy as e:
+                print >> sys.stderr, "Another run is replicating to {} ({}). Exiting.".format(e[0], e[1])
+                sys.exit(1)
 
+        limits = ConcurrencyLimits(max_per_src_host=int(arguments['--max-per-src-host']),
+                                   max_per_dest_pool=int(arguments['--max-per-dest-pool']))
+        if arguments['--daemon']:
+            daemon = ReplicationDaemon(arguments['<src-host>'], arguments['<src-filesystem>'],
+                                       arguments['<dest-host>'], arguments['<dest-filesystem>'],
+                                       dry_run=arguments['--dry-run'],
+                                       delete_snapshots_not_in_src=arguments['--delete'],
+                                       retention=retention,
+                                       jobs=int(arguments['--jobs']),
+                                       limits=limits,
+                                       interval=float(arguments['--interval']),
+                                       settle=float(arguments['--settle']),
+                                       after_poll=lambda: write_metrics(arguments['--metrics-json'],
+                                                                        arguments['--prometheus-textfile']))
+            signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+            daemon.run()
+        elif arguments['--config']:
+            signal.signal(signal.SIGTERM, lambda signum, frame: executor.cancel_all())
+            (failed,) = executor.gather(lambda: run_config_jobs(config_jobs,
+                                                                dry_run=arguments['--dry-run'],
+                                                                max_jobs=int(arguments['--jobs']),
+                                                                limits=limits))
+            exit_status = 1 if failed else 0
+        elif len(targets) > 1:
+            signal.signal(signal.SIGTERM, lambda signum, frame: executor.cancel_all())
+            (failed,) = executor.gather(lambda: replicate_to_many(
+                arguments['<src-host>'], arguments['<src-filesystem>'], targets,
+                dry_run=arguments['--dry-run'],
+                delete_snapshots_not_in_src=arguments['--delete'],
+                jobs=int(arguments['--jobs']),
+                limits=limits,
+                recursive_stream=arguments['--recursive-stream'],
+                retention=retention))
+            exit_status = 1 if failed else 0
+        else:
+            ## Fail whatever is running, so the run winds down and saves what it can
+            signal.signal(signal.SIGTERM, lambda signum, frame: executor.cancel_all())
+            ## Off the main thread, which must stay free to handle signals
+            (failed,) = executor.gather(lambda: replicate_snapshots_recursively(
+                arguments['<src-host>'], arguments['<src-filesystem>'],
+                arguments['<dest-host>'], arguments['<dest-filesystem>'],
+                dry_run=arguments['--dry-run'],
+                delete_snapshots_not_in_src=arguments['--delete'],
+                jobs=int(arguments['--jobs']),
+                limits=limits,
+                recursive_stream=arguments['--recursive-stream'],
+                retention=retention,
+                plan_json=arguments['--plan-json']))
+            exit_status = 1 if failed else 0
+    except ZfsReplicationListingFailed as e:
+        ## Nothing was planned, sent or pruned from the partial listing
+        print >> sys.stderr, "{}: {}. Nothing replicated.".format(e[0], e[1])
+        exit_status = 1
+    except Exception as e:
         print >> sys.stderr, "Unhandled exception: {}: {}".format(type(e), e)
+        exit_status = 1
+    if lock_token is not None:
+        locks.release(lock_token)
+
+    metrics.finish()
+    write_metrics(arguments['--metrics-json'], arguments['--prometheus-textfile'])
+    if not quiet:
+        summary = metrics.summary()
+        print "Sent {} in {} transfer(s) ({} failed), {:.1f}s in total.".format(
+            replication_metrics.format_bytes(summary['bytes']), summary['transfers'],
+            summary['failed_transfers'], summary['seconds'])
+        if summary['saved_bytes']:
+            print "Send flags {} about {} over plain streams.".format(
+                "would save" if arguments['--dry-run'] else "saved",
+                replication_metrics.format_bytes(summary['saved_bytes']))
 
     if not quiet:
         print "Finished."
+    sys.exit(exit_status)
@@ -0,0 +1,155 @@
+"""On-disk cache of destination snapshot catalogs, kept in SQLite.
+
+A destination normally only changes when we write to it, so listing
+all its snapshots on every run is mostly wasted work. After a
+successful run the destination's catalog is saved here together with a
+fingerprint of each dataset: its guid, and its snapshots_changed
+property (the time a snapshot was last created or destroyed in it,
+OpenZFS 2.2 and later). On the next run a single cheap
+'zfs list -t filesystem' of those properties tells us whether the
+saved catalog still holds; only if it does not is the destination
+listed in full.
+
+This assumes nothing but this script creates or destroys snapshots on
+the destination between the end of one run and the start of the next
+(anything that does will change snapshots_changed, but a change made
+while we are saving the catalog could be missed).
+
+Example:
+    cache = CatalogCache('/var/lib/replicate_zfs_snapshots/catalog.sqlite')
+    catalogs = cache.load('backup-host', 'tank/replica', fingerprints)
+    if catalogs is None:
+        catalogs = ...list the destination...
+    cache.store('backup-host', 'tank/replica', catalogs, fingerprints)"""
+
+import sqlite3, threading, os
+
+from snapshot_catalog import SnapshotCatalog, SnapshotRecord
+
+DEFAULT_PATH = '/var/lib/replicate_zfs_snapshots/catalog.sqlite'
+
+SNAPSHOTS_CHANGED_VERSION = (2, 2)
+# The first OpenZFS with the snapshots_changed property; older zfs
+# rejects it ('bad property list: invalid property'), so a host
+# running it can't be fingerprinted at all.
+
+SCHEMA_VERSION = 2
+# Caches written with another schema are thrown away and started again.
+
+class Fingerprint(object):
+    """What must be unchanged for a dataset's saved catalog to still be right."""
+
+    __slots__ = ('guid', 'snapshots_changed', 'resume_token')
+
+    def __init__(self, guid, snapshots_changed, resume_token=None):
+        self.guid = guid
+        self.snapshots_changed = snapshots_changed
+        self.resume_token = resume_token
+
+    def usable(self):
+        """False if snapshots_changed wasn't reported (e.g. zfs 2.2 on an older kernel module)."""
+        return self.snapshots_changed not in (None, '', '-')
+
+def fingerprints_from_listing(lines):
+    """Parse 'zfs list -H -p -t filesystem,volume -o name,guid,snapshots_changed,receive_resume_token'."""
+    fingerprints = {}
+    for line in lines:
+        fields = line.split('\t')
+        if len(fields) != 4:
+            continue
+        (name, guid, snapshots_changed, resume_token) = fields
+        fingerprints[name] = Fingerprint(int(guid), snapshots_changed,
+                                         resume_token if resume_token != '-' else None)
+    return fingerprints
+
+def in_tree(dataset, root):
+    return dataset == root or dataset.startswith(root + "/")
+
+class CatalogCache(object):
+    """Saved catalogs, keyed by host and dataset. Safe to use from several threads."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        ## dataset names are case sensitive
+        self._db.execute("PRAGMA case_sensitive_like = ON")
+        with self._db:
+            if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._db.execute("DROP TABLE IF EXISTS datasets")
+                self._db.execute("DROP TABLE IF EXISTS snapshots")
+                self._db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+            self._db.execute("CREATE TABLE IF NOT EXISTS datasets ("
+                             " host TEXT, dataset TEXT, guid INTEGER, snapshots_changed TEXT,"
+                             " PRIMARY KEY (host, dataset))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS snapshots ("
+                             " host TEXT, dataset TEXT, name TEXT, guid INTEGER, createtxg INTEGER, creation INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS snapshots_by_dataset ON snapshots (host, dataset)")
+
+    def load(self, host, root, fingerprints):
+        """Return the saved catalogs (dataset -> SnapshotCatalog) of ROOT's tree on HOST.
+
+        FINGERPRINTS are the tree's current fingerprints. Return None
+        unless every dataset in them was saved with the same
+        fingerprint, and no saved dataset has since disappeared."""
+        current = dict((dataset, fingerprint) for (dataset, fingerprint) in fingerprints.iteritems()
+                       if in_tree(dataset, root))
+        if not current or not all(fingerprint.usable() for fingerprint in current.itervalues()):
+            return None
+        with self._lock:
+            saved = {}
+            for (dataset, guid, snapshots_changed) in self._select_tree("dataset, guid, snapshots_changed",
+                                                                        "datasets", host, root):
+                saved[dataset] = (guid, snapshots_changed)
+            if set(saved) != set(current):
+                return None
+            for (dataset, fingerprint) in current.iteritems():
+                if saved[dataset] != (fingerprint.guid, fingerprint.snapshots_changed):
+                    return None
+            records = dict((dataset, []) for dataset in current)
+            for (dataset, name, guid, createtxg, creation) in self._select_tree(
+                    "dataset, name, guid, createtxg, creation", "snapshots", host, root):
+                records[dataset].append(SnapshotRecord(name, guid, createtxg, creation))
+        return dict((dataset, SnapshotCatalog(dataset, snapshots, current[dataset].resume_token))
+                    for (dataset, snapshots) in records.iteritems())
+
+    def store(self, host, root, catalogs, fingerprints, exclude=()):
+        """Save CATALOGS of ROOT's tree on HOST, with the FINGERPRINTS they were valid for.
+
+        Datasets in EXCLUDE (e.g. ones whose replication failed, so we
+        can't be sure what is on them) are not saved, which makes the
+        next load() miss and list the destination in full."""
+        with self._lock:
+            with self._db:
+                self._delete_tree(host, root)
+                for (dataset, fingerprint) in fingerprints.iteritems():
+                    if not in_tree(dataset, root) or dataset in exclude or dataset not in catalogs:
+                        continue
+                    self._db.execute("INSERT INTO datasets VALUES (?, ?, ?, ?)",
+                                     (host, dataset, fingerprint.guid, fingerprint.snapshots_changed))
+                    self._db.executemany("INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?)",
+                                         ((host, dataset, record.name, record.guid, record.createtxg,
+                                           record.creation)
+                                          for record in catalogs[dataset]))
+
+    def forget(self, host, root):
+        """Drop everything saved for ROOT's tree on HOST."""
+        with self._lock:
+            with self._db:
+                self._delete_tree(host, root)
+
+    def _select_tree(self, columns, table, host, root):
+        return self._db.execute("SELECT {} FROM {} WHERE host = ? AND (dataset = ? OR dataset LIKE ? ESCAPE '\\')".format(
+            columns, table), (host, root, like_prefix(root + "/"))).fetchall()
+
+    def _delete_tree(self, host, root):
+        for table in ('datasets', 'snapshots'):
+            self._db.execute("DELETE FROM {} WHERE host = ? AND (dataset = ? OR dataset LIKE ? ESCAPE '\\')".format(
+                table), (host, root, like_prefix(root + "/")))
+
+def like_prefix(prefix):
+    """SQL LIKE pattern matching anything starting with PREFIX."""
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
@@ -0,0 +1,183 @@
+"""Running zfs and ssh commands with timeouts, cancellation and streamed output.
+
+Every command is started in a process group of its own, so a timeout
+or a cancellation kills the whole pipeline (the shell, ssh, sudo,
+compressors...) and not just the shell at the top of it. Commands that
+run for a long time without a fixed limit, like the two halves of a
+transfer, are started with start() so they can still be cancelled.
+
+Python 2 has no asyncio, so commands that should run at the same time
+(e.g. listing the source and the destination) are run on threads by
+gather(); each thread spends its time blocked on a pipe, not the GIL.
+
+Example:
+    executor = CommandExecutor(timeout=600)
+    for line in executor.stream("ssh host sudo zfs list -H"):
+        ...
+    (src, dest) = executor.gather(lambda: list_tree(src_host), lambda: list_tree(dest_host))
+    executor.cancel_all()    # e.g. on SIGTERM"""
+
+import subprocess, threading, tempfile, signal, os, errno
+
+KILL_GRACE_SECONDS = 5.0
+# How long a timed-out or cancelled command gets to exit after SIGTERM
+# before it is sent SIGKILL.
+
+STREAM_BUFFER_SIZE = 1 << 16
+
+class CommandFailed(Exception):
+    """A command exited non-zero, timed out or was cancelled.
+
+    Arguments: the command, its exit status, its error output, and
+    why it was stopped ('timed out', 'cancelled') or None."""
+    pass
+
+class CommandExecutor(object):
+    """Starts commands, and keeps track of them so they can be timed out or cancelled.
+
+    TIMEOUT (in seconds; None or 0 for no limit) is the default limit
+    for run() and stream(). Safe to use from several threads."""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or None
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._running = set()
+
+    def start(self, cmd, preexec_fn=None, **kwargs):
+        """Start CMD like subprocess.Popen, in a new process group.
+
+        CMD is a shell command, or a list of arguments to run without
+        a shell. PREEXEC_FN, if given, also runs in the child. The
+        caller must call finished() once the process has been waited
+        for."""
+        def setup():
+            os.setpgrp()
+            if preexec_fn is not None:
+                preexec_fn()
+        with self._lock:
+            if self.cancelled:
+                raise CommandFailed(cmd, None, "", 'cancelled')
+            try:
+                proc = subprocess.Popen(cmd, shell=isinstance(cmd, basestring), preexec_fn=setup, **kwargs)
+            except OSError as e:
+                ## Without a shell, a missing program fails here rather than with status 127
+                raise CommandFailed(cmd, None, str(e), None)
+            proc.stopped_because = None
+            proc.escalation = None
+            self._running.add(proc)
+        return proc
+
+    def finished(self, proc):
+        with self._lock:
+            self._running.discard(proc)
+        if proc.escalation is not None:
+            proc.escalation.cancel()
+
+    def stop(self, proc, reason):
+        """Kill PROC's process group: SIGTERM, then SIGKILL if it hasn't been waited for a little later."""
+        if proc.stopped_because is None:
+            proc.stopped_because = reason
+        kill_group(proc, signal.SIGTERM)
+        if proc.escalation is None:
+            proc.escalation = threading.Timer(KILL_GRACE_SECONDS, kill_group, (proc, signal.SIGKILL))
+            proc.escalation.start()
+
+    def cancel_all(self):
+        """Stop every running command, and refuse to start any more."""
+        with self._lock:
+            self.cancelled = True
+            running = list(self._running)
+        for proc in running:
+            self.stop(proc, 'cancelled')
+
+    def _watchdog(self, proc, timeout):
+        timeout = self.timeout if timeout is None else timeout
+        if not timeout:
+            return None
+        timer = threading.Timer(timeout, self.stop, (proc, 'timed out'))
+        timer.start()
+        return timer
+
+    def stream(self, cmd, timeout=None):
+        """Run CMD, yielding its output a line at a time (without newlines).
+
+        The output is never held in memory all at once. Raise
+        CommandFailed after the last line if CMD failed, timed out
+        (after TIMEOUT seconds, default self.timeout) or was cancelled."""
+        errors = tempfile.TemporaryFile()
+        ## Buffered: Popen's default (unbuffered) pipe makes readline read
+        ## a byte at a time, which dominates listing a big tree
+        proc = self.start(cmd, stdout=subprocess.PIPE, stderr=errors, close_fds=True, bufsize=STREAM_BUFFER_SIZE)
+        timer = self._watchdog(proc, timeout)
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                yield line.rstrip('\n')
+            status = proc.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if proc.poll() is None:
+                ## The caller stopped reading early
+                self.stop(proc, 'abandoned')
+                proc.wait()
+            proc.stdout.close()
+            self.finished(proc)
+        if status != 0 or proc.stopped_because is not None:
+            errors.seek(0)
+            raise CommandFailed(cmd, status, errors.read(), proc.stopped_because)
+
+    def run(self, cmd, timeout=None):
+        """Run CMD and return its output (stdout and stderr together) as a list of lines.
+
+        Raise CommandFailed, carrying the output, like stream()."""
+        output = tempfile.TemporaryFile()
+        proc = self.start(cmd, stdout=output, stderr=subprocess.STDOUT, close_fds=True)
+        timer = self._watchdog(proc, timeout)
+        try:
+            status = proc.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self.finished(proc)
+        output.seek(0)
+        text = output.read()
+        if status != 0 or proc.stopped_because is not None:
+            raise CommandFailed(cmd, status, text, proc.stopped_because)
+        return text.split('\n')
+
+    def gather(self, *functions):
+        """Call each of FUNCTIONS on its own thread, and return their results in order.
+
+        If any of them raised, the first such exception is raised once
+        all have finished."""
+        results = [None] * len(functions)
+        errors = [None] * len(functions)
+
+        def call(index):
+            try:
+                results[index] = functions[index]()
+            except Exception as e:
+                errors[index] = e
+
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(len(functions))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            ## join with a timeout so that Ctrl-C still gets through
+            while thread.is_alive():
+                thread.join(1)
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+def kill_group(proc, signum):
+    ## Not proc.poll(): that could reap the process under another
+    ## thread's proc.wait()
+    try:
+        os.killpg(proc.pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
@@ -0,0 +1,190 @@
+"""Locks on destination trees, so that runs writing to the same datasets take turns.
+
+A run locks each destination tree it writes to, keyed by host and
+dataset, for as long as it runs. Two runs (or two jobs in one run)
+whose trees overlap, because one tree is inside the other, can't hold
+their locks at once; runs writing to unrelated trees, even on the same
+pool, don't get in each other's way.
+
+Each lock is a file in a lock directory, locked with lockf. Locking
+a tree means an exclusive lock on its own file and a shared one on the
+file of each of its ancestors: an exclusive lock on 'backup/data' then
+conflicts both with one on 'backup' (which holds 'backup/data' shared)
+and with one on 'backup/data/x' (which holds 'backup/data' shared).
+The kernel drops lockf locks when their process exits, however it
+exits, so a lock can't outlive its run. A tree's lock file says which
+process holds it (pid, host, since when) for the messages of runs
+waiting on it, and is removed when the lock is released; a lock file
+still holding those details when its lock is taken was left behind
+by a run that died, and is reported as stale and reused.
+
+lockf locks belong to a process, not a thread, so locks taken by
+threads of the same process are also tracked in memory here.
+
+Example:
+    locks = DatasetLocks('/tmp/locks')
+    token = locks.acquire([('backup-host', 'tank/replica')], wait=60)
+    try:
+        ...replicate...
+    finally:
+        locks.release(token)"""
+
+import os, fcntl, errno, socket, threading, time, urllib
+
+DEFAULT_DIRECTORY = '/tmp/replicate_zfs_snapshots.locks'
+
+POLL_SECONDS = 0.5
+# How often a lock that is wanted but busy is tried again.
+
+class LockBusy(Exception):
+    """A lock could not be had in time: (host:dataset, who holds it)."""
+    pass
+
+class _HeldLock(object):
+    __slots__ = ('exclusive', 'count', 'fd')
+
+    def __init__(self, exclusive, fd):
+        self.exclusive = exclusive
+        self.count = 1
+        self.fd = fd
+
+def lock_names(host, dataset):
+    """Return (name, exclusive) for every lock file locking DATASET's tree on HOST, top-down."""
+    parts = dataset.split("/")
+    return [("{}:{}".format(host, "/".join(parts[:depth])), depth == len(parts))
+            for depth in range(1, len(parts) + 1)]
+
+class DatasetLocks(object):
+    """The locks on destination trees held by this process, in lock files in DIRECTORY."""
+
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+        self.stale = []
+        # Descriptions of stale lock files found (and reused) so far
+        self._mutex = threading.Lock()
+        self._held = {}
+        # lock name -> _HeldLock
+
+    def _path(self, name):
+        return os.path.join(self.directory, urllib.quote(name, safe='') + ".lock")
+
+    def acquire(self, trees, wait=0):
+        """Lock every (host, dataset) tree in TREES, waiting up to WAIT seconds; return a token for release.
+
+        Either all the trees are locked or none are: raise LockBusy,
+        naming one of the locks that was in the way, if they could not
+        all be had within WAIT seconds."""
+        wanted = {}
+        for (host, dataset) in trees:
+            for (name, exclusive) in lock_names(host, dataset):
+                wanted[name] = wanted.get(name, False) or exclusive
+        ## Always in the same order, so two waiting runs can't each hold what the other wants
+        wanted = sorted(wanted.iteritems())
+        deadline = time.time() + wait
+        while True:
+            taken = []
+            for (name, exclusive) in wanted:
+                if not self._try(name, exclusive):
+                    break
+                taken.append(name)
+            else:
+                return taken
+            self.release(taken)
+            if time.time() >= deadline:
+                raise LockBusy(name, self.holder(name, exclusive))
+            time.sleep(min(POLL_SECONDS, max(deadline - time.time(), 0)))
+
+    def release(self, token):
+        """Release the locks ACQUIRE returned TOKEN for."""
+        with self._mutex:
+            for name in reversed(token):
+                held = self._held[name]
+                held.count -= 1
+                if held.count == 0:
+                    del self._held[name]
+                    self._unlock(name, held)
+
+    def holder(self, name, exclusive=True):
+        """Describe who holds lock NAME (or, for an exclusive lock, the tree below it)."""
+        with self._mutex:
+            if name in self._held:
+                return "this run (another job)"
+            ## Under the mutex: closing any descriptor of a file drops
+            ## every lockf lock this process has on it, so it must not be
+            ## read while another thread could be locking it
+            details = read_details(self._path(name))
+        if details:
+            return details
+        return "a run replicating below it" if exclusive else "a run replicating a tree containing it"
+
+    def _try(self, name, exclusive):
+        """Take lock NAME now if it is free, and return True; return False if it is not."""
+        with self._mutex:
+            held = self._held.get(name)
+            if held is not None:
+                if held.exclusive or exclusive:
+                    return False
+                held.count += 1
+                return True
+            fd = self._lock_file(name, exclusive)
+            if fd is None:
+                return False
+            self._held[name] = _HeldLock(exclusive, fd)
+            return True
+
+    def _lock_file(self, name, exclusive):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        path = self._path(name)
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+            try:
+                fcntl.lockf(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+            except IOError as e:
+                os.close(fd)
+                if e.errno in (errno.EACCES, errno.EAGAIN):
+                    return None
+                raise
+            ## The file may have been removed (by the holder we were waiting
+            ## for) between our opening and locking it; then lock the new one
+            try:
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    break
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            os.close(fd)
+        if exclusive:
+            ## Read through FD: closing another descriptor would drop the lock
+            left_behind = os.read(fd, 4096).strip()
+            if left_behind:
+                self.stale.append("{} ({})".format(name, left_behind))
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, "pid {} on {} since {}\n".format(os.getpid(), socket.gethostname(),
+                                                          time.strftime("%Y-%m-%d %H:%M:%S")))
+        return fd
+
+    def _unlock(self, name, held):
+        ## Remove the file only if no other process has it locked (it
+        ## may be shared), so no one is left holding a lock on a file
+        ## that is gone while someone else locks a new one
+        try:
+            fcntl.lockf(held.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.unlink(self._path(name))
+        except (IOError, OSError):
+            pass
+        fcntl.lockf(held.fd, fcntl.LOCK_UN)
+        os.close(held.fd)
+
+def read_details(path):
+    """Return what lock file PATH says about its holder, or '' if nothing."""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return ''
@@ -0,0 +1,568 @@
+#!/usr/bin/env python
+"""A stand-in for zfs (and zpool, ssh and sudo), for benchmarks and for trying
+the replication script out without real pools.
+
+Each simulated host keeps its datasets under a directory of its own,
+<state-dir>/<host>/, one JSON file per dataset (guid, snapshots,
+receive resume token...), so that commands touching one dataset don't
+read or rewrite the whole host. <state-dir>/<host>/host.json holds the
+host's settings:
+
+  list_latency    seconds every 'zfs list' waits before answering
+  send_rate       bytes per second 'zfs send' produces (0: no limit)
+  receive_rate    bytes per second 'zfs receive' consumes (0: no limit)
+  features        {feature: state} of every pool, for 'zpool get'
+  compressratio   how many times smaller a compressed (-c) or raw (-w)
+                  stream is than a plain one
+
+and the host's txg counter. The state directory is taken from
+$FAKE_ZFS_STATE and the host from $FAKE_ZFS_HOST (default localhost).
+
+Run as ssh (see make_bin_dir), this runs its command locally with
+$FAKE_ZFS_HOST set to the host it was given, so 'ssh host sudo zfs ...'
+reaches the fake zfs of that host. Control master options are
+accepted and ignored. Run as sudo, it just runs its command.
+
+A send stream is a JSON header line saying which snapshots it carries,
+followed by padding standing in for their data (each snapshot's
+'size' bytes). 'zfs receive' reads all of it before adding the
+snapshots, with the same guids, to the receiving side; a stream cut
+short leaves a resume token with 'zfs receive -s', as real zfs would.
+
+Supported: list (-H -p -r -d -t -o -s -S), send (-I -i -R -X -t, -n -v -P,
+-c -w; other flags are ignored; -i may name a bookmark), receive (-s -F
+-u -A), destroy (of snapshots, including 'a%b' ranges and comma lists,
+and of bookmarks), bookmark, set (of user properties, which list can
+show) and version; and 'zpool get' (of every property, feature flags
+only). A dataset whose 'encryption' is not 'off' is encrypted: sent
+raw (-w), it is received as an encrypted dataset, and a raw stream
+can't be received into an unencrypted one, or a plain one into a
+dataset received raw.
+
+Example:
+    host = FakeHost('/tmp/state', 'src')
+    host.save(make_dataset('tank/data', 100, [('snap-1', 1001, 101, 1500000000, 1 << 20)]))
+    make_bin_dir('/tmp/bin')    # then put /tmp/bin first on $PATH"""
+
+import sys, os, json, fcntl, time, base64, urllib, contextlib, stat
+
+DEFAULT_SETTINGS = {'txg': 1000, 'list_latency': 0, 'send_rate': 0, 'receive_rate': 0, 'compressratio': 1.0,
+                    'features': {'async_destroy': 'enabled', 'embedded_data': 'active', 'large_blocks': 'enabled',
+                                 'lz4_compress': 'active', 'encryption': 'enabled', 'zstd_compress': 'enabled'}}
+# The features of a pool made by OpenZFS 2.2 with its defaults.
+
+BLOCK_SIZE = 1 << 16
+
+class FakeZfsError(Exception):
+    pass
+
+def make_dataset(name, createtxg, snapshots=(), guid=None, encryption='off'):
+    """Return a dataset, as saved by FakeHost.save.
+
+    SNAPSHOTS are (name, guid, createtxg, creation, size) in creation
+    order."""
+    return {'name': name,
+            'encryption': encryption,
+            'guid': createtxg if guid is None else guid,
+            'createtxg': createtxg,
+            'resume_token': None,
+            'snapshots_changed': None,
+            'snapshots': [list(snapshot) for snapshot in snapshots],
+            'bookmarks': []}
+
+## Fields of a snapshot (a bookmark has the same, with size 0)
+NAME, GUID, CREATETXG, CREATION, SIZE = range(5)
+
+class FakeHost(object):
+    """The saved state of one simulated host."""
+
+    def __init__(self, state_dir, host):
+        self.directory = os.path.join(state_dir, host)
+        if not os.path.isdir(os.path.join(self.directory, "datasets")):
+            os.makedirs(os.path.join(self.directory, "datasets"))
+
+    def _path(self, name):
+        return os.path.join(self.directory, "datasets", urllib.quote(name, safe='') + ".json")
+
+    def settings(self):
+        settings = dict(DEFAULT_SETTINGS)
+        try:
+            with open(os.path.join(self.directory, "host.json")) as f:
+                settings.update(json.load(f))
+        except IOError:
+            pass
+        return settings
+
+    def save_settings(self, settings):
+        write_json(os.path.join(self.directory, "host.json"), settings)
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Hold the host's lock; every change to the host is made under it."""
+        with open(os.path.join(self.directory, "host.lock"), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def next_txg(self):
+        """Return a new txg number (call with the lock held)."""
+        settings = self.settings()
+        settings['txg'] += 1
+        self.save_settings(settings)
+        return settings['txg']
+
+    def names(self):
+        """Return every dataset name, parents before their children."""
+        names = [urllib.unquote(entry[:-len(".json")])
+                 for entry in os.listdir(os.path.join(self.directory, "datasets")) if entry.endswith(".json")]
+        return sorted(names, key=lambda name: name.split("/"))
+
+    def load(self, name):
+        """Return dataset NAME, or None if there is no such dataset."""
+        try:
+            with open(self._path(name)) as f:
+                return json.load(f)
+        except IOError:
+            return None
+
+    def save(self, dataset, changed=False):
+        """Save DATASET; if CHANGED, its snapshots were just created or destroyed."""
+        if changed:
+            dataset['snapshots_changed'] = int(time.time() * 1e9)
+        write_json(self._path(dataset['name']), dataset)
+
+def write_json(path, value):
+    with open(path + ".tmp", 'w') as f:
+        json.dump(value, f)
+    os.rename(path + ".tmp", path)
+
+def make_bin_dir(directory, python=None):
+    """Put zfs, zpool, ssh and sudo commands running this fake into DIRECTORY."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for role in ('zfs', 'zpool', 'ssh', 'sudo'):
+        path = os.path.join(directory, role)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec {} {} {} "$@"\n'.format(python or sys.executable,
+                                                             os.path.abspath(__file__.replace(".pyc", ".py")),
+                                                             role))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+def current_host():
+    return FakeHost(os.environ['FAKE_ZFS_STATE'], os.environ.get('FAKE_ZFS_HOST', 'localhost'))
+
+def split_snapshot(spec):
+    (name, at, snapshot) = spec.partition("@")
+    if not at or not snapshot:
+        raise FakeZfsError("invalid snapshot name '{}'".format(spec))
+    return (name, snapshot)
+
+def find_snapshot(dataset, name):
+    for (index, snapshot) in enumerate(dataset['snapshots']):
+        if snapshot[NAME] == name:
+            return index
+    raise FakeZfsError("cannot open '{}@{}': dataset does not exist".format(dataset['name'], name))
+
+def find_bookmark(dataset, name):
+    for bookmark in dataset.get('bookmarks', []):
+        if bookmark[NAME] == name:
+            return bookmark
+    raise FakeZfsError("cannot open '{}#{}': bookmark does not exist".format(dataset['name'], name))
+
+def parse_flags(args, with_values):
+    """Split ARGS into ({flag: value or True}, operands); WITH_VALUES are flags taking a value."""
+    flags = {}
+    operands = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if not arg.startswith("-") or arg == "-":
+            operands.append(arg)
+            continue
+        for (index, flag) in enumerate(arg[1:]):
+            if flag in with_values:
+                rest = arg[index + 2:]
+                flags[flag] = rest if rest else args.pop(0)
+                break
+            flags[flag] = True
+    return (flags, operands)
+
+def zfs_list(host, args):
+    (flags, roots) = parse_flags(args, "dtosS")
+    settings = host.settings()
+    if settings['list_latency']:
+        time.sleep(settings['list_latency'])
+    types = set(flags.get('t', 'filesystem').split(","))
+    if 'all' in types:
+        types = set(['filesystem', 'volume', 'snapshot', 'bookmark'])
+    columns = flags.get('o', 'name,used,avail,refer,mountpoint').split(",")
+    if 'r' in flags:
+        depth = None
+    elif 'd' in flags:
+        depth = int(flags['d'])
+    else:
+        depth = 1 if types <= set(['snapshot', 'bookmark']) else 0
+    names = host.names()
+    if not roots:
+        roots = [name for name in names if "/" not in name]
+        depth = None if depth == 0 and 'd' not in flags else depth
+    rows = []
+    for root in roots:
+        if "@" in root:
+            (name, snapshot) = split_snapshot(root)
+            dataset = host.load(name)
+            if dataset is None:
+                raise FakeZfsError("cannot open '{}': dataset does not exist".format(root))
+            rows.append((dataset, dataset['snapshots'][find_snapshot(dataset, snapshot)], "@"))
+            continue
+        if host.load(root) is None:
+            raise FakeZfsError("cannot open '{}': dataset does not exist".format(root))
+        for name in names:
+            if name != root and not name.startswith(root + "/"):
+                continue
+            level = name.count("/") - root.count("/")
+            if depth is not None and level > depth:
+                continue
+            dataset = host.load(name)
+            if types & set(['filesystem', 'volume']):
+                rows.append((dataset, None, None))
+            if depth is None or level + 1 <= depth:
+                if 'snapshot' in types:
+                    rows.extend((dataset, snapshot, "@") for snapshot in dataset['snapshots'])
+                if 'bookmark' in types:
+                    rows.extend((dataset, bookmark, "#") for bookmark in dataset.get('bookmarks', []))
+    if 's' in flags or 'S' in flags:
+        key = flags.get('s') or flags.get('S')
+        rows.sort(key=lambda row: property_value(row, key), reverse='S' in flags)
+    output = []
+    if 'H' not in flags:
+        output.append("\t".join(column.upper() for column in columns))
+    for row in rows:
+        output.append("\t".join(str(property_value(row, column)) for column in columns))
+    sys.stdout.write("".join(line + "\n" for line in output))
+
+def property_value(row, column):
+    (dataset, snapshot, separator) = row
+    if snapshot is None:
+        values = {'name': dataset['name'], 'guid': dataset['guid'], 'createtxg': dataset['createtxg'],
+                  'creation': 0, 'type': 'filesystem', 'used': 0,
+                  'receive_resume_token': dataset['resume_token'] or '-',
+                  'snapshots_changed': dataset['snapshots_changed'] or '-',
+                  'encryption': dataset.get('encryption', 'off')}
+        values.update(dataset.get('properties', {}))
+    else:
+        values = {'name': "{}{}{}".format(dataset['name'], separator, snapshot[NAME]), 'guid': snapshot[GUID],
+                  'createtxg': snapshot[CREATETXG], 'creation': snapshot[CREATION],
+                  'type': 'snapshot' if separator == "@" else 'bookmark', 'used': snapshot[SIZE]}
+    return values.get(column, '-')
+
+def plan_send(host, flags, target):
+    """Return the header of the stream 'zfs send FLAGS TARGET' would produce."""
+    (name, snapshot) = split_snapshot(target)
+    base = flags.get('I') or flags.get('i')
+    raw = 'w' in flags
+    ratio = host.settings()['compressratio'] if raw or 'c' in flags else 1.0
+    names = [name]
+    if 'R' in flags:
+        excluded = flags.get('X', "").split(",") if flags.get('X') else []
+        names = [other for other in host.names()
+                 if (other == name or other.startswith(name + "/"))
+                 and not any(other == x or other.startswith(x + "/") for x in excluded)]
+    streams = []
+    for other in names:
+        dataset = host.load(other)
+        if dataset is None:
+            raise FakeZfsError("cannot open '{}': dataset does not exist".format(other))
+        end = find_snapshot(dataset, snapshot)
+        start = None
+        if base is not None and "#" in base:
+            ## From a bookmark: just the one snapshot, and only for the dataset itself
+            bookmark = find_bookmark(dataset, base.rpartition("#")[2])
+            if bookmark[CREATETXG] >= dataset['snapshots'][end][CREATETXG]:
+                raise FakeZfsError("incremental source {} must be earlier than {}".format(base, target))
+            streams.append({'relative': '', 'base': bookmark[GUID], 'snapshots': dataset['snapshots'][end:end + 1],
+                            'encryption': dataset.get('encryption', 'off') if raw else None})
+            continue
+        if base is not None:
+            base_name = base.rpartition("@")[2]
+            try:
+                start = find_snapshot(dataset, base_name)
+            except FakeZfsError:
+                if other == name:
+                    raise FakeZfsError("incremental source {}@{} does not exist".format(other, base_name))
+        if start is None:
+            ## A full stream; with -R, a child created since BASE is sent whole
+            snapshots = dataset['snapshots'][:end + 1] if 'R' in flags else dataset['snapshots'][end:end + 1]
+            base_guid = None
+        else:
+            snapshots = dataset['snapshots'][start + 1:end + 1] if 'I' in flags else dataset['snapshots'][end:end + 1]
+            base_guid = dataset['snapshots'][start][GUID]
+        streams.append({'relative': other[len(name):], 'base': base_guid, 'snapshots': snapshots,
+                        'encryption': dataset.get('encryption', 'off') if raw else None})
+    return {'dataset': name, 'streams': streams,
+            'size': int(sum(s[SIZE] for stream in streams for s in stream['snapshots']) / ratio)}
+
+def zfs_send(host, args):
+    (flags, operands) = parse_flags(args, "IiXt")
+    if 't' in flags:
+        state = json.loads(base64.b64decode(flags['t']))
+        (header, offset) = (state['header'], state['offset'])
+        check_resumable(host, header)
+    else:
+        if not operands:
+            raise FakeZfsError("missing snapshot argument")
+        (header, offset) = (plan_send(host, flags, operands[0]), 0)
+    remaining = header['size'] - offset
+    if 'n' in flags:
+        if 'v' in flags or 'P' in flags:
+            sys.stdout.write("full\t{}\t{}\nsize\t{}\n".format(operands[0] if operands else 'resume',
+                                                               remaining, remaining))
+        return
+    rate = host.settings()['send_rate']
+    out = os.fdopen(sys.stdout.fileno(), 'wb', 0)
+    out.write(json.dumps({'header': header, 'offset': offset}) + "\n")
+    write_padding(out, remaining, rate)
+
+def check_resumable(host, header):
+    """Refuse to resume a send whose snapshots are no longer on HOST, as zfs does."""
+    for stream in header['streams']:
+        name = header.get('dataset', '') + stream['relative']
+        dataset = host.load(name)
+        guids = set(snapshot[GUID] for snapshot in dataset['snapshots']) if dataset is not None else set()
+        for snapshot in stream['snapshots']:
+            if snapshot[GUID] not in guids:
+                raise FakeZfsError("cannot resume send: '{}@{}' used in the initial send no longer exists".format(
+                    name, snapshot[NAME]))
+
+def write_padding(out, count, rate):
+    block = "\0" * BLOCK_SIZE
+    started = time.time()
+    sent = 0
+    while sent < count:
+        size = min(count - sent, BLOCK_SIZE)
+        out.write(block[:size])
+        sent += size
+        if rate:
+            ahead = sent / float(rate) - (time.time() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+def zfs_receive(host, args):
+    (flags, operands) = parse_flags(args, "oxd")
+    target = operands[0]
+    if 'A' in flags:
+        with host.lock():
+            dataset = host.load(target)
+            if dataset is None or not dataset['resume_token']:
+                raise FakeZfsError("'{}' does not have any resumable receive state to abort".format(target))
+            dataset['resume_token'] = None
+            host.save(dataset)
+        return
+    stream = os.fdopen(sys.stdin.fileno(), 'rb', 0)
+    line = stream.readline()
+    if not line:
+        raise FakeZfsError("cannot receive: failed to read from stream")
+    state = json.loads(line)
+    (header, offset) = (state['header'], state['offset'])
+    received = read_padding(stream, header['size'] - offset, host.settings()['receive_rate'])
+    if offset + received < header['size']:
+        if 's' in flags:
+            with host.lock():
+                dataset = host.load(target)
+                if dataset is not None:
+                    dataset['resume_token'] = base64.b64encode(json.dumps({'header': header,
+                                                                           'offset': offset + received}))
+                    host.save(dataset)
+        raise FakeZfsError("cannot receive incremental stream: checksum mismatch or incomplete stream.\n"
+                           "Partially received snapshot is saved.")
+    with host.lock():
+        for stream_header in header['streams']:
+            receive_stream(host, target + stream_header['relative'], stream_header, 'F' in flags)
+
+def read_padding(stream, count, rate):
+    received = 0
+    started = time.time()
+    while received < count:
+        chunk = stream.read(min(count - received, BLOCK_SIZE))
+        if not chunk:
+            break
+        received += len(chunk)
+        if rate:
+            ahead = received / float(rate) - (time.time() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+    return received
+
+def receive_stream(host, name, stream, force):
+    dataset = host.load(name)
+    ## The encryption of the dataset sent, if the stream is raw
+    raw = stream.get('encryption')
+    if dataset is not None and raw is not None and raw != 'off' and dataset.get('encryption', 'off') == 'off':
+        raise FakeZfsError("cannot receive raw stream into unencrypted dataset '{}'".format(name))
+    if dataset is not None and raw is None and dataset.get('encryption', 'off') != 'off':
+        raise FakeZfsError("cannot receive non-raw stream into encrypted dataset '{}'".format(name))
+    if dataset is None:
+        if stream['base'] is not None:
+            raise FakeZfsError("cannot receive incremental stream: destination '{}' does not exist".format(name))
+        parent = name.rpartition("/")[0]
+        if not parent or host.load(parent) is None:
+            raise FakeZfsError("cannot receive new filesystem stream: parent of '{}' does not exist".format(name))
+        dataset = make_dataset(name, host.next_txg(), encryption=raw or 'off')
+    elif stream['base'] is not None:
+        guids = [snapshot[GUID] for snapshot in dataset['snapshots']]
+        if stream['base'] not in guids:
+            raise FakeZfsError("cannot receive incremental stream: most recent snapshot of {}"
+                               " does not match incremental source".format(name))
+        if guids.index(stream['base']) != len(guids) - 1:
+            if not force:
+                raise FakeZfsError("cannot receive incremental stream: destination {}"
+                                   " has been modified since most recent snapshot".format(name))
+            del dataset['snapshots'][guids.index(stream['base']) + 1:]
+    elif dataset['snapshots'] and not force:
+        raise FakeZfsError("cannot receive new filesystem stream: destination '{}' exists".format(name))
+    for snapshot in stream['snapshots']:
+        if any(other[NAME] == snapshot[NAME] for other in dataset['snapshots']):
+            raise FakeZfsError("cannot receive: snapshot {}@{} already exists".format(name, snapshot[NAME]))
+        dataset['snapshots'].append([snapshot[NAME], snapshot[GUID], host.next_txg(),
+                                     snapshot[CREATION], snapshot[SIZE]])
+    dataset['resume_token'] = None
+    host.save(dataset, changed=True)
+
+def zfs_destroy(host, args):
+    (flags, operands) = parse_flags(args, "")
+    with host.lock():
+        for spec in operands:
+            if "#" in spec:
+                (name, _, bookmark) = spec.partition("#")
+                dataset = host.load(name)
+                if dataset is None:
+                    raise FakeZfsError("cannot open '{}': dataset does not exist".format(name))
+                doomed = find_bookmark(dataset, bookmark)
+                if 'n' not in flags:
+                    dataset['bookmarks'].remove(doomed)
+                    host.save(dataset)
+                continue
+            (name, snapshots) = split_snapshot(spec)
+            dataset = host.load(name)
+            if dataset is None:
+                raise FakeZfsError("cannot open '{}': dataset does not exist".format(name))
+            names = [snapshot[NAME] for snapshot in dataset['snapshots']]
+            doomed = set()
+            for part in snapshots.split(","):
+                if "%" in part:
+                    (first, _, last) = part.partition("%")
+                    start = names.index(first) if first else 0
+                    end = names.index(last) if last else len(names) - 1
+                    doomed.update(names[start:end + 1])
+                elif part in names:
+                    doomed.add(part)
+                else:
+                    raise FakeZfsError("could not find any snapshots to destroy; check snapshot names.")
+            if 'n' not in flags:
+                dataset['snapshots'] = [snapshot for snapshot in dataset['snapshots']
+                                        if snapshot[NAME] not in doomed]
+                host.save(dataset, changed=True)
+
+def zfs_bookmark(host, args):
+    (flags, operands) = parse_flags(args, "")
+    if len(operands) != 2:
+        raise FakeZfsError("usage: zfs bookmark <snapshot|bookmark> <newbookmark>")
+    (name, snapshot) = split_snapshot(operands[0])
+    (bookmark_dataset, _, bookmark) = operands[1].partition("#")
+    if bookmark_dataset != name or not bookmark:
+        raise FakeZfsError("invalid bookmark name '{}'".format(operands[1]))
+    with host.lock():
+        dataset = host.load(name)
+        if dataset is None:
+            raise FakeZfsError("cannot open '{}': dataset does not exist".format(name))
+        source = dataset['snapshots'][find_snapshot(dataset, snapshot)]
+        bookmarks = dataset.setdefault('bookmarks', [])
+        if any(other[NAME] == bookmark for other in bookmarks):
+            raise FakeZfsError("cannot create bookmark '{}': bookmark exists".format(operands[1]))
+        bookmarks.append([bookmark, source[GUID], source[CREATETXG], source[CREATION], 0])
+        host.save(dataset)
+
+def zfs_set(host, args):
+    (flags, operands) = parse_flags(args, "")
+    if len(operands) < 2 or "=" not in operands[0]:
+        raise FakeZfsError("usage: zfs set <property=value> ... <filesystem|volume|snapshot> ...")
+    (name, _, value) = operands[0].partition("=")
+    if ":" not in name:
+        raise FakeZfsError("cannot set property '{}': only user properties are supported".format(name))
+    with host.lock():
+        for target in operands[1:]:
+            dataset = host.load(target)
+            if dataset is None:
+                raise FakeZfsError("cannot open '{}': dataset does not exist".format(target))
+            dataset.setdefault('properties', {})[name] = value
+            host.save(dataset)
+
+def zpool(args):
+    host = current_host()
+    if not args or args[0] != 'get':
+        raise FakeZfsError("unsupported zpool command")
+    (flags, operands) = parse_flags(args[1:], "o")
+    pools = operands[1:] or [name for name in host.names() if "/" not in name]
+    columns = flags.get('o', 'name,property,value,source').split(",")
+    rows = []
+    for pool in pools:
+        if host.load(pool) is None:
+            raise FakeZfsError("cannot open '{}': no such pool".format(pool))
+        rows.append({'name': pool, 'property': 'health', 'value': 'ONLINE', 'source': '-'})
+        for (feature, state) in sorted(host.settings()['features'].items()):
+            rows.append({'name': pool, 'property': 'feature@' + feature, 'value': state, 'source': 'local'})
+    sys.stdout.write("".join("\t".join(row[column] for column in columns) + "\n" for row in rows))
+
+def zfs(args):
+    host = current_host()
+    if not args:
+        raise FakeZfsError("missing command")
+    if args[0] == 'version':
+        sys.stdout.write("zfs-2.2.0-1\nzfs-kmod-2.2.0-1\n")
+        return
+    commands = {'list': zfs_list, 'send': zfs_send, 'receive': zfs_receive, 'recv': zfs_receive,
+                'destroy': zfs_destroy, 'bookmark': zfs_bookmark, 'set': zfs_set}
+    if args[0] not in commands:
+        raise FakeZfsError("unrecognized command '{}'".format(args[0]))
+    commands[args[0]](host, args[1:])
+
+def ssh(args):
+    args = list(args)
+    while args and args[0].startswith("-"):
+        option = args.pop(0)
+        if option == "-O":
+            ## Control commands ('-O exit', '-O check') always succeed
+            sys.exit(0)
+        if option in ("-o", "-S", "-p", "-l", "-i", "-c", "-F", "-E"):
+            args.pop(0)
+    if not args:
+        raise FakeZfsError("usage: ssh [options] host [command]")
+    host = args.pop(0)
+    if not args:
+        ## e.g. a control master started with -N
+        return
+    os.environ['FAKE_ZFS_HOST'] = host
+    os.execv("/bin/sh", ["sh", "-c", " ".join(args)])
+
+def sudo(args):
+    os.execvp(args[0], args)
+
+def main(argv):
+    roles = {'zfs': zfs, 'zpool': zpool, 'ssh': ssh, 'sudo': sudo}
+    if len(argv) < 2 or argv[1] not in roles:
+        print >> sys.stderr, "Usage: fake_zfs.py zfs|zpool|ssh|sudo ARGS..."
+        sys.exit(2)
+    try:
+        roles[argv[1]](argv[2:])
+    except FakeZfsError as e:
+        print >> sys.stderr, e
+        sys.exit(1)
+    except IOError as e:
+        ## The other end of a pipe went away
+        print >> sys.stderr, e
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main(sys.argv)
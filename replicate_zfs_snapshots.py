@@ -11,7 +11,9 @@ Example:
 
 This script synchronizes ZFS snapshots between filesystems on a local and remote linux box.
 
-All logging output generated by this script is written to syslog.
+All logging output generated by this script is written to syslog,
+from a background thread (see simple_syslog), with lists of snapshots
+sent as a few multi-line messages rather than one per snapshot.
 
 We assume that:
 * passwordless ssh is set up between host running this script
@@ -84,9 +86,7 @@ def execute_shell_command(cmd, dry_run=True):
         if not text:
             logger.debug(" no output")
         else:
-            logger.debug(" output:")
-            for line in text:
-                logger.debug(" {}".format(line))
+            logger.lines(logger.DEBUG, " output", text)
 
 def replicate_snapshots(remote_host, remote_filesystem, local_filesystem, dry_run=True):
     """Synchronise ZFS snapshots from remote filesystem to a local filesystem."""
@@ -111,20 +111,14 @@ def replicate_snapshots(remote_host, remote_filesystem, local_filesystem, dry_ru
     snapshots_missing_in_remote = [s for s in local_snapshots if not strip_filesystem_name(s) in remote_set]
     last_remote_snapshot = remote_snapshots[-1]
 
-    logger.debug("Local snapshots:")
-    for snapshot in local_snapshots:
-        logger.debug(" {}".format(snapshot))
-    logger.debug("Remote snapshots:")
-    for snapshot in remote_snapshots:
-        logger.debug(" {}".format(snapshot))
+    logger.lines(logger.DEBUG, "Local snapshots", local_snapshots)
+    logger.lines(logger.DEBUG, "Remote snapshots", remote_snapshots)
 
     logger.debug("Last common snapshot: {}".format(last_common_snapshot))
     logger.debug("Last remote snapshot: {}".format(last_remote_snapshot))
 
     if snapshots_missing_in_remote:
-        logger.debug("Present locally, but not in remote:")
-        for snapshot in snapshots_missing_in_remote:
-            logger.debug(" {}".format(snapshot))
+        logger.lines(logger.DEBUG, "Present locally, but not in remote", snapshots_missing_in_remote)
     if not last_common_snapshot:
         raise ZfsReplicationNoRemoteSnapshots("No remote snapshots",
                                               "host: {}".format(remote_host),
@@ -0,0 +1,143 @@
+"""Checking that a replica is in sync with its source, dataset by dataset.
+
+An audit compares the snapshot catalogs of a source tree and its
+replica (listed once each, in bulk) without sending anything. For each
+dataset it finds:
+
+  missing     source snapshots newer than the last snapshot in common,
+              i.e. not replicated yet
+  extra       destination snapshots the source doesn't have (by guid),
+              e.g. ones pruned on the source; normal with --retain
+  mismatched  snapshots with the same name on both sides but different
+              guids: they aren't the same snapshot, and can't be used
+              as the base of an incremental
+
+and how far the replica lags behind: the time between the creation of
+the last common snapshot and of the source's newest one, and the
+number of source txgs between them. A destination snapshot the source
+only has a bookmark of still counts as in common, since the next
+incremental can be sent from the bookmark.
+
+A dataset has a problem if it is missing on the destination, has no
+snapshot in common with the source, has mismatched snapshots, or lags
+by more than the allowed number of seconds. Datasets the source no
+longer has are reported, but are not a problem.
+
+Example:
+    audits = audit_tree('tank/data', 'backup/data', src_catalogs, dest_catalogs)
+    problems = [audit for audit in audits if audit.problems(max_lag=3600)]"""
+
+import json
+
+import catalog_cache
+
+class DatasetAudit(object):
+    """How one dataset's replica compares with its source.
+
+    FILESYSTEM is its name relative to the top of the tree ('' for the
+    top itself). SRC and DEST are its SnapshotCatalogs, either of which
+    may be None if the dataset only exists on one side. LAG_SECONDS and
+    LAG_TXGS are None when there is no snapshot in common."""
+
+    def __init__(self, filesystem, src, dest):
+        self.filesystem = filesystem
+        self.src = src
+        self.dest = dest
+        self.missing = []
+        self.extra = []
+        self.mismatched = []
+        self.common = None
+        self.lag_seconds = None
+        self.lag_txgs = None
+        if src is None or dest is None:
+            return
+        self.mismatched = src.name_collisions(dest)
+        mismatched_names = set(record.name for (record, _) in self.mismatched)
+        self.extra = [record for record in dest.not_in(src) if record.name not in mismatched_names]
+        self.common = src.last_common_base(dest)
+        if self.common is None:
+            self.missing = list(src)
+            return
+        self.missing = src.after(self.common)
+        latest = src.latest()
+        self.lag_txgs = latest.createtxg - self.common.createtxg
+        if latest.creation is not None and self.common.creation is not None:
+            self.lag_seconds = latest.creation - self.common.creation
+
+    def problems(self, max_lag=0):
+        """Return what is wrong with the replica, as a list of strings (empty if nothing)."""
+        if self.src is None:
+            return []
+        if self.dest is None:
+            return ["missing on destination"]
+        problems = []
+        if len(self.src) and self.common is None:
+            problems.append("no snapshot in common" if len(self.dest) else "no snapshots on destination")
+        elif self.missing and self.lag_seconds is not None and self.lag_seconds > max_lag:
+            problems.append("lagging")
+        if self.mismatched:
+            problems.append("mismatched guids")
+        return problems
+
+    def describe(self):
+        """Return a one-line summary of the differences, e.g. for printing after the dataset's name."""
+        if self.src is None:
+            return "not on source"
+        if self.dest is None:
+            return "missing on destination"
+        parts = []
+        if self.missing:
+            parts.append("{} snapshot(s) missing".format(len(self.missing)))
+        if self.lag_seconds:
+            parts.append("{} behind ({} txgs)".format(format_lag(self.lag_seconds), self.lag_txgs))
+        if self.extra:
+            parts.append("{} extra".format(len(self.extra)))
+        for (ours, theirs) in self.mismatched:
+            parts.append("'{}' has guid {} on source, {} on destination".format(ours.name, ours.guid, theirs.guid))
+        if self.dest.resume_token:
+            parts.append("interrupted receive")
+        return ", ".join(parts) if parts else "in sync"
+
+    def to_dict(self, max_lag=0):
+        return {'filesystem': self.filesystem,
+                'missing': [record.name for record in self.missing],
+                'extra': [record.name for record in self.extra],
+                'mismatched': [record.name for (record, _) in self.mismatched],
+                'lag_seconds': self.lag_seconds, 'lag_txgs': self.lag_txgs,
+                'problems': self.problems(max_lag)}
+
+def format_lag(seconds):
+    """Return SECONDS as e.g. '3d 4h', '2h 10m' or '45s'."""
+    (days, seconds) = divmod(int(seconds), 86400)
+    (hours, seconds) = divmod(seconds, 3600)
+    (minutes, seconds) = divmod(seconds, 60)
+    if days:
+        return "{}d {}h".format(days, hours)
+    if hours:
+        return "{}h {}m".format(hours, minutes)
+    if minutes:
+        return "{}m {}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+def relative_names(catalogs, filesystem):
+    """Return a dict of name relative to FILESYSTEM ('' for itself) -> SnapshotCatalog, for its tree in CATALOGS."""
+    return dict((dataset[len(filesystem) + 1:], catalog) for (dataset, catalog) in catalogs.iteritems()
+                if catalog_cache.in_tree(dataset, filesystem))
+
+def audit_tree(src_filesystem, dest_filesystem, src_catalogs, dest_catalogs):
+    """Return a DatasetAudit for every dataset in either tree, parents before children.
+
+    SRC_CATALOGS and DEST_CATALOGS map full dataset names to
+    SnapshotCatalogs, as fetch_catalog returns them."""
+    src = relative_names(src_catalogs, src_filesystem)
+    dest = relative_names(dest_catalogs, dest_filesystem)
+    return [DatasetAudit(filesystem, src.get(filesystem), dest.get(filesystem))
+            for filesystem in sorted(set(src) | set(dest), key=lambda name: name.split("/") if name else [])]
+
+def audit_to_json(audits, max_lag=0, **labels):
+    """Return AUDITS as JSON text, with LABELS (e.g. hosts) at the top level."""
+    document = dict(labels)
+    document['max_lag'] = max_lag
+    document['problems'] = sum(1 for audit in audits if audit.problems(max_lag))
+    document['datasets'] = [audit.to_dict(max_lag) for audit in audits]
+    return json.dumps(document, indent=2, sort_keys=True, separators=(',', ': ')) + "\n"
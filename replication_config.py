@@ -0,0 +1,119 @@
+"""Config files listing many replication jobs, for running them all in one process.
+
+The file is YAML (read with PyYAML, which is only imported when a
+config file is used). Without PyYAML, a config written as JSON (which
+is also YAML) can still be read, if its name ends in '.json'.
+
+  defaults:                  # optional; applies to every job
+    retain: ['backup/*:hourly=24,daily=7']
+  jobs:
+    - src: sydney:tank/share
+      dest: localhost:backup/sydney/share
+    - name: vms              # optional; used in messages
+      src: localhost:fast/vms
+      dest:                  # several destinations: see --also-to
+        - localhost:slow/vms
+        - nas:backup/vms
+      delete: true
+      recursive_stream: true
+      jobs: 4
+
+Each job takes the same settings as a single run of the script: 'src'
+and 'dest' are host:filesystem ('dest' may be a list), 'delete' and
+'recursive_stream' are true or false, 'retain' is a rule or a list of
+rules (see retention_policy) and 'jobs' is how many of the job's child
+filesystems are replicated at once.
+
+Example:
+    for job in load('/etc/replicate_zfs_snapshots.yaml'):
+        print job.name, job.src_host, job.src_filesystem, job.targets"""
+
+import json
+
+import retention_policy
+
+JOB_SETTINGS = ('delete', 'retain', 'recursive_stream', 'jobs')
+# What 'defaults' may set, and each job may override.
+
+class BadConfig(Exception):
+    pass
+
+class ReplicationJob(object):
+    """One tree to replicate: SRC_FILESYSTEM on SRC_HOST to each of TARGETS ((host, filesystem) pairs)."""
+
+    def __init__(self, name, src_host, src_filesystem, targets, delete=False, retention=None,
+                 recursive_stream=False, jobs=1):
+        self.name = name
+        self.src_host = src_host
+        self.src_filesystem = src_filesystem
+        self.targets = targets
+        self.delete = delete
+        self.retention = retention if retention is not None else retention_policy.RetentionRules()
+        self.recursive_stream = recursive_stream
+        self.jobs = jobs
+
+def parse_target(text):
+    """Return (host, filesystem) for TEXT, 'host:filesystem'."""
+    (host, colon, filesystem) = str(text).partition(":")
+    if not colon or not host or not filesystem:
+        raise BadConfig("Must look like host:filesystem", text)
+    return (host, filesystem)
+
+def read_file(path):
+    with open(path) as f:
+        text = f.read()
+    try:
+        import yaml
+    except ImportError:
+        if not path.endswith(".json"):
+            raise BadConfig("PyYAML is needed to read a YAML config (or write it as JSON, named *.json)", path)
+        try:
+            return json.loads(text)
+        except ValueError as e:
+            raise BadConfig("Not valid JSON: {}".format(e), path)
+    try:
+        return yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        raise BadConfig("Not valid YAML: {}".format(e), path)
+
+def parse_job(entry, defaults, index):
+    if not isinstance(entry, dict):
+        raise BadConfig("Job must be a mapping", "job {}".format(index + 1))
+    unknown = set(entry) - set(('name', 'src', 'dest') + JOB_SETTINGS)
+    name = str(entry.get('name') or entry.get('src') or "job {}".format(index + 1))
+    if unknown:
+        raise BadConfig("Unknown setting(s): {}".format(", ".join(sorted(unknown))), name)
+    if 'src' not in entry or 'dest' not in entry:
+        raise BadConfig("Job needs both 'src' and 'dest'", name)
+    settings = dict(defaults)
+    settings.update((key, entry[key]) for key in JOB_SETTINGS if key in entry)
+    (src_host, src_filesystem) = parse_target(entry['src'])
+    dests = entry['dest'] if isinstance(entry['dest'], list) else [entry['dest']]
+    if not dests:
+        raise BadConfig("Job needs at least one 'dest'", name)
+    retain = settings.get('retain') or []
+    if not isinstance(retain, list):
+        retain = [retain]
+    try:
+        retention = retention_policy.parse_rules(str(rule) for rule in retain)
+    except retention_policy.BadRetentionRule as e:
+        raise BadConfig("{}: {}".format(e[0], e[1]), name)
+    jobs = settings.get('jobs', 1)
+    if not isinstance(jobs, int) or jobs < 1:
+        raise BadConfig("'jobs' must be a whole number, at least 1", name)
+    return ReplicationJob(name, src_host, src_filesystem, [parse_target(dest) for dest in dests],
+                          delete=bool(settings.get('delete', False)), retention=retention,
+                          recursive_stream=bool(settings.get('recursive_stream', False)), jobs=jobs)
+
+def load(path):
+    """Return the ReplicationJobs in the config file PATH, in order; raise BadConfig if it is wrong."""
+    document = read_file(path)
+    if not isinstance(document, dict) or not isinstance(document.get('jobs'), list):
+        raise BadConfig("Config must have a list of 'jobs'", path)
+    unknown = set(document) - set(('defaults', 'jobs'))
+    if unknown:
+        raise BadConfig("Unknown section(s): {}".format(", ".join(sorted(unknown))), path)
+    defaults = document.get('defaults') or {}
+    if not isinstance(defaults, dict) or set(defaults) - set(JOB_SETTINGS):
+        raise BadConfig("'defaults' may only set: {}".format(", ".join(JOB_SETTINGS)), path)
+    return [parse_job(entry, defaults, index) for (index, entry) in enumerate(document['jobs'])]
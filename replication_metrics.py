@@ -0,0 +1,208 @@
+"""Timing and throughput figures for a replication run.
+
+Every phase of the run (listing, planning, transfer, destroy) is
+timed, overall and per dataset, and every transfer records how many
+bytes it moved and how long it took. A phase's seconds are wall-clock
+time: while several threads are in it at once, it is counted once. Its
+thread seconds add up each thread's time in it, so several transfers
+at once count several times over. At the end of the run the figures
+can be written out as a JSON summary, and as a Prometheus
+textfile-collector file (for node_exporter's --collector.textfile) so
+replication throughput can be graphed and regressions spotted.
+
+Example:
+    metrics = RunMetrics()
+    with metrics.phase('listing'):
+        ...
+    metrics.record_transfer('tank/home', 123456789, 12.5, succeeded=True)
+    metrics.write_json('/var/lib/replicate/last-run.json')"""
+
+import threading, time, json, os, contextlib
+
+PHASES = ('listing', 'planning', 'transfer', 'destroy')
+
+class RunMetrics(object):
+    """Counters and timers for one run. Safe to use from several threads."""
+
+    def __init__(self, labels=None):
+        """LABELS (e.g. source and destination) are attached to every exported metric."""
+        self.labels = dict(labels or {})
+        self.started = time.time()
+        self.finished = None
+        self.phase_thread_seconds = dict((phase, 0.0) for phase in PHASES)
+        self._phase_intervals = dict((phase, []) for phase in PHASES)
+        self.datasets = {}
+        self._lock = threading.Lock()
+
+    def _dataset(self, dataset):
+        if dataset not in self.datasets:
+            self.datasets[dataset] = {'phase_intervals': {},
+                                      'bytes': 0,
+                                      'estimated_bytes': None,
+                                      'saved_bytes': 0,
+                                      'transfer_seconds': 0.0,
+                                      'transfers': 0,
+                                      'failed_transfers': 0}
+        return self.datasets[dataset]
+
+    @contextlib.contextmanager
+    def phase(self, name, dataset=None):
+        """Time the enclosed block as part of phase NAME (and of DATASET, if given).
+
+        Time spent in nested phases counts towards each of them."""
+        started = time.time()
+        try:
+            yield
+        finally:
+            interval = (started, time.time())
+            with self._lock:
+                self.phase_thread_seconds[name] = (self.phase_thread_seconds.get(name, 0.0)
+                                                   + interval[1] - interval[0])
+                self._phase_intervals.setdefault(name, []).append(interval)
+                if dataset is not None:
+                    self._dataset(dataset)['phase_intervals'].setdefault(name, []).append(interval)
+
+    def record_estimate(self, dataset, estimated_bytes, plain_bytes=None):
+        """Count a transfer of ESTIMATED_BYTES, which would have been PLAIN_BYTES without its send flags."""
+        with self._lock:
+            entry = self._dataset(dataset)
+            entry['estimated_bytes'] = (entry['estimated_bytes'] or 0) + estimated_bytes
+            if plain_bytes is not None:
+                entry['saved_bytes'] += max(plain_bytes - estimated_bytes, 0)
+
+    def record_transfer(self, dataset, transferred_bytes, seconds, succeeded=True):
+        with self._lock:
+            entry = self._dataset(dataset)
+            entry['bytes'] += transferred_bytes
+            entry['transfer_seconds'] += seconds
+            entry['transfers'] += 1
+            if not succeeded:
+                entry['failed_transfers'] += 1
+
+    def finish(self):
+        self.finished = time.time()
+
+    def summary(self):
+        """Return the run's figures as a dict (what write_json writes)."""
+        with self._lock:
+            finished = self.finished or time.time()
+            total_bytes = sum(entry['bytes'] for entry in self.datasets.itervalues())
+            transfer_seconds = sum(entry['transfer_seconds'] for entry in self.datasets.itervalues())
+            datasets = {}
+            for (name, entry) in self.datasets.iteritems():
+                datasets[name] = dict(entry)
+                del datasets[name]['phase_intervals']
+                datasets[name]['phase_seconds'] = dict((phase, union_seconds(intervals))
+                                                       for (phase, intervals) in entry['phase_intervals'].iteritems())
+                datasets[name]['bytes_per_second'] = rate(entry['bytes'], entry['transfer_seconds'])
+            return {'labels': dict(self.labels),
+                    'started': self.started,
+                    'finished': finished,
+                    'seconds': finished - self.started,
+                    'phase_seconds': dict((phase, union_seconds(intervals))
+                                          for (phase, intervals) in self._phase_intervals.iteritems()),
+                    'phase_thread_seconds': dict(self.phase_thread_seconds),
+                    'bytes': total_bytes,
+                    'bytes_per_second': rate(total_bytes, transfer_seconds),
+                    'saved_bytes': sum(entry['saved_bytes'] for entry in self.datasets.itervalues()),
+                    'transfers': sum(entry['transfers'] for entry in self.datasets.itervalues()),
+                    'failed_transfers': sum(entry['failed_transfers'] for entry in self.datasets.itervalues()),
+                    'datasets': datasets}
+
+    def write_json(self, path):
+        write_atomically(path, json.dumps(self.summary(), indent=2, sort_keys=True) + "\n")
+
+    def write_prometheus(self, path):
+        """Write the figures in Prometheus text exposition format, for the textfile collector."""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, help_text, kind, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for (labels, value) in samples:
+                lines.append("{}{} {}".format(name, format_labels(dict(self.labels, **labels)), value))
+
+        metric("zfs_replication_last_run_timestamp_seconds", "When the last replication run finished.", "gauge",
+               [({}, summary['finished'])])
+        metric("zfs_replication_run_seconds", "Wall-clock duration of the last replication run.", "gauge",
+               [({}, summary['seconds'])])
+        metric("zfs_replication_phase_seconds", "Wall-clock time spent in each phase of the last run.", "gauge",
+               [({'phase': phase}, seconds) for (phase, seconds) in sorted(summary['phase_seconds'].items())])
+        metric("zfs_replication_phase_thread_seconds",
+               "Time each thread spent in each phase of the last run, added up over the threads.", "gauge",
+               [({'phase': phase}, seconds) for (phase, seconds) in sorted(summary['phase_thread_seconds'].items())])
+        metric("zfs_replication_bytes", "Bytes sent by the last run.", "gauge",
+               [({}, summary['bytes'])])
+        metric("zfs_replication_bytes_per_second", "Average transfer rate of the last run.", "gauge",
+               [({}, summary['bytes_per_second'])])
+        metric("zfs_replication_saved_bytes",
+               "Bytes the last run's send flags (-c, -w) saved over plain streams, by estimate.", "gauge",
+               [({}, summary['saved_bytes'])])
+        metric("zfs_replication_failed_transfers", "Transfers that failed in the last run.", "gauge",
+               [({}, summary['failed_transfers'])])
+        datasets = sorted(summary['datasets'].items())
+        metric("zfs_replication_dataset_bytes", "Bytes sent for each dataset by the last run.", "gauge",
+               [({'dataset': name}, entry['bytes']) for (name, entry) in datasets])
+        metric("zfs_replication_dataset_transfer_seconds", "Time spent sending each dataset in the last run.", "gauge",
+               [({'dataset': name}, entry['transfer_seconds']) for (name, entry) in datasets])
+        metric("zfs_replication_dataset_failed_transfers", "Failed transfers for each dataset in the last run.", "gauge",
+               [({'dataset': name}, entry['failed_transfers']) for (name, entry) in datasets])
+        write_atomically(path, "\n".join(lines) + "\n")
+
+def rate(count, seconds):
+    if seconds <= 0:
+        return 0.0
+    return count / seconds
+
+def union_seconds(intervals):
+    """Return how many seconds the (start, end) INTERVALS cover between them, overlaps counted once."""
+    seconds = 0.0
+    covered_to = float('-inf')
+    for (start, end) in sorted(intervals):
+        start = max(start, covered_to)
+        if end > start:
+            seconds += end - start
+        covered_to = max(covered_to, end)
+    return seconds
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = []
+    for (name, value) in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(escaped) + "}"
+
+def write_atomically(path, text):
+    """Write TEXT to PATH so that readers (e.g. node_exporter) never see half a file."""
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(text)
+    os.rename(temporary, path)
+
+def format_bytes(count):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(count) < 1024 or unit == 'TiB':
+            return "{:.1f} {}".format(count, unit)
+        count /= 1024.0
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+def progress_line(dataset, transferred, estimated, elapsed):
+    """Describe a transfer in progress, e.g. for printing every minute.
+
+    When the stream is compressed TRANSFERRED counts compressed bytes,
+    while ESTIMATED (from 'zfs send -nvP') is uncompressed, so the ETA
+    is then an upper bound."""
+    speed = rate(transferred, elapsed)
+    if estimated:
+        remaining = max(estimated - transferred, 0)
+        eta = format_seconds(remaining / speed) if speed else "?"
+        return "    {}: {} of {} ({:.0f}%) at {}/s, ETA {}".format(
+            dataset, format_bytes(transferred), format_bytes(estimated),
+            100.0 * transferred / estimated, format_bytes(speed), eta)
+    return "    {}: {} at {}/s".format(dataset, format_bytes(transferred), format_bytes(speed))
@@ -0,0 +1,133 @@
+"""A replication plan: what will be sent and destroyed, dataset by dataset, with sizes.
+
+The plan for a tree is worked out from the source and destination
+catalogs before anything runs: for each dataset, the transfers that
+would bring it up to date (resuming an interrupted receive, seeding
+it with a full send of its oldest snapshot and then an incremental, or
+just an incremental), the snapshots that would then be pruned, or why
+it can't be replicated. Each transfer carries the size 'zfs send -nvP'
+estimates for it, when known.
+
+Datasets are replicated largest subtree first: a dataset's weight is
+its own estimated bytes plus those of all its descendants, since a
+child can't start before its parent. Starting the heaviest work first
+keeps a big dataset from starting last and stretching the whole run
+out, while the small ones fill in around it.
+
+Example:
+    plans = [DatasetPlan('', 'tank/a', 'backup/a'), DatasetPlan('x', 'tank/a/x', 'backup/a/x')]
+    plans[1].transfers.append(PlannedTransfer('incremental', 'zfs send -I ...', ['snap-2'], 1234, 1 << 30))
+    weights = subtree_bytes(plans)
+    order = execution_order([plan.filesystem for plan in plans], weights)"""
+
+import heapq, json
+
+class PlannedTransfer(object):
+    """One send/receive: KIND is 'resume', 'full' or 'incremental'.
+
+    SEND_CMD is the (local) 'zfs send' command, SNAPSHOTS the names of
+    the snapshots it carries (empty for a resumed receive, which doesn't
+    say), BASE_GUID the guid of the snapshot or bookmark an incremental
+    is sent from (None otherwise), and ESTIMATED_BYTES its size or None
+    if not known."""
+
+    __slots__ = ('kind', 'send_cmd', 'snapshots', 'base_guid', 'estimated_bytes')
+
+    def __init__(self, kind, send_cmd, snapshots=(), base_guid=None, estimated_bytes=None):
+        self.kind = kind
+        self.send_cmd = send_cmd
+        self.snapshots = list(snapshots)
+        self.base_guid = base_guid
+        self.estimated_bytes = estimated_bytes
+
+    def to_dict(self):
+        return {'kind': self.kind, 'send_cmd': self.send_cmd, 'snapshots': self.snapshots,
+                'base_guid': self.base_guid, 'estimated_bytes': self.estimated_bytes}
+
+class DatasetPlan(object):
+    """What is to be done for one dataset.
+
+    FILESYSTEM is its name relative to the top of the tree ('' for the
+    top itself). FLAGS are the send flags its transfers use (e.g.
+    'Lce'). DOOMED are the names of the destination snapshots to be
+    pruned afterwards. PROBLEM says why the dataset can't be
+    replicated, or is None; ERROR, if set, is the exception carrying
+    the plan out raises for it."""
+
+    def __init__(self, filesystem, src_dataset, dest_dataset, flags=""):
+        self.filesystem = filesystem
+        self.src_dataset = src_dataset
+        self.dest_dataset = dest_dataset
+        self.flags = flags
+        self.transfers = []
+        self.doomed = []
+        self.problem = None
+        self.error = None
+
+    def estimated_bytes(self):
+        """Bytes to be sent for this dataset, counting unknown estimates as 0."""
+        return sum(transfer.estimated_bytes or 0 for transfer in self.transfers)
+
+    def to_dict(self):
+        return {'filesystem': self.filesystem, 'src_dataset': self.src_dataset,
+                'dest_dataset': self.dest_dataset, 'send_flags': self.flags,
+                'transfers': [transfer.to_dict() for transfer in self.transfers],
+                'estimated_bytes': self.estimated_bytes(),
+                'destroy': self.doomed, 'problem': self.problem}
+
+def parent_of(filesystem, filesystems):
+    """Return the nearest ancestor of FILESYSTEM in FILESYSTEMS (a set), '' for the top, or None."""
+    parts = filesystem.split("/")
+    for depth in range(len(parts) - 1, 0, -1):
+        candidate = "/".join(parts[:depth])
+        if candidate in filesystems:
+            return candidate
+    return '' if filesystem and '' in filesystems else None
+
+def subtree_bytes(plans):
+    """Return a dict of filesystem -> bytes to send for it and all its descendants in PLANS."""
+    names = set(plan.filesystem for plan in plans)
+    totals = dict((plan.filesystem, plan.estimated_bytes()) for plan in plans)
+    ## Deepest first, so each total is complete before it is added to its parent's
+    for filesystem in sorted(names, key=lambda name: (-name.count("/"), name == '')):
+        parent = parent_of(filesystem, names)
+        if parent is not None:
+            totals[parent] += totals[filesystem]
+    return totals
+
+def execution_order(filesystems, weights):
+    """Return FILESYSTEMS in the order one worker would replicate them.
+
+    Parents come before their children; among the filesystems that are
+    ready, the heaviest (by WEIGHTS) goes first, then the first listed."""
+    names = set(filesystems)
+    index = dict((filesystem, position) for (position, filesystem) in enumerate(filesystems))
+    children = {}
+    ready = []
+    for filesystem in filesystems:
+        parent = parent_of(filesystem, names)
+        if parent is None:
+            heapq.heappush(ready, (-weights.get(filesystem, 0), index[filesystem], filesystem))
+        else:
+            children.setdefault(parent, []).append(filesystem)
+    order = []
+    while ready:
+        (_, _, filesystem) = heapq.heappop(ready)
+        order.append(filesystem)
+        for child in children.get(filesystem, []):
+            heapq.heappush(ready, (-weights.get(child, 0), index[child], child))
+    return order
+
+def plan_to_json(plans, **labels):
+    """Return PLANS (in execution order) as JSON text, with LABELS (e.g. hosts) at the top level."""
+    weights = subtree_bytes(plans)
+    by_name = dict((plan.filesystem, plan) for plan in plans)
+    datasets = []
+    for filesystem in execution_order([plan.filesystem for plan in plans], weights):
+        entry = by_name[filesystem].to_dict()
+        entry['subtree_bytes'] = weights[filesystem]
+        datasets.append(entry)
+    document = dict(labels)
+    document['estimated_bytes'] = sum(plan.estimated_bytes() for plan in plans)
+    document['datasets'] = datasets
+    return json.dumps(document, indent=2, sort_keys=True, separators=(',', ': ')) + "\n"
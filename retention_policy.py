@@ -0,0 +1,107 @@
+"""Retention policies for automatic snapshots on the destination.
+
+A policy says how many hourly, daily, weekly and monthly snapshots to
+keep. For each of those periods it keeps the newest snapshot in each
+of the N most recent hours (days, ISO weeks, months) that have a
+snapshot at all, so a gap in snapshotting doesn't eat into what is
+kept. A snapshot is kept if any period keeps it. Periods are taken
+from each snapshot's creation time (in local time), not from its name.
+
+Policies are given per destination dataset by rules such as
+
+  backup/home/*:hourly=24,daily=7,weekly=4,monthly=12
+
+where the part before the last ':' is an fnmatch pattern for the
+dataset's full name ('*' matches across '/' too). The first rule whose
+pattern matches a dataset applies to it; datasets no rule matches are
+not pruned. Periods left out of a rule keep nothing.
+
+Example:
+    rules = parse_rules(['backup/*:daily=7,weekly=4'])
+    policy = rules.policy_for('backup/home')
+    kept = policy.keep(snapshot_records)"""
+
+import fnmatch, time, datetime
+
+PERIODS = ('hourly', 'daily', 'weekly', 'monthly')
+
+class BadRetentionRule(Exception):
+    pass
+
+def period_of(period, creation):
+    """Return a key that is the same for snapshots created in the same PERIOD."""
+    local = time.localtime(creation)
+    if period == 'hourly':
+        return (local.tm_year, local.tm_yday, local.tm_hour)
+    if period == 'daily':
+        return (local.tm_year, local.tm_yday)
+    if period == 'weekly':
+        return datetime.date(local.tm_year, local.tm_mon, local.tm_mday).isocalendar()[:2]
+    return (local.tm_year, local.tm_mon)
+
+class RetentionPolicy(object):
+    """How many snapshots to keep for each period (see module docstring)."""
+
+    def __init__(self, hourly=0, daily=0, weekly=0, monthly=0):
+        self.counts = {'hourly': hourly, 'daily': daily, 'weekly': weekly, 'monthly': monthly}
+
+    def __str__(self):
+        return ",".join("{}={}".format(period, self.counts[period]) for period in PERIODS
+                        if self.counts[period])
+
+    def keep(self, records):
+        """Return the guids of the RECORDS (SnapshotRecords) this policy keeps.
+
+        Records whose creation time is not known are always kept."""
+        kept = set(record.guid for record in records if record.creation is None)
+        newest_first = sorted((record for record in records if record.creation is not None),
+                              key=lambda record: record.creation, reverse=True)
+        for period in PERIODS:
+            remaining = self.counts[period]
+            last = None
+            for record in newest_first:
+                if remaining <= 0:
+                    break
+                key = period_of(period, record.creation)
+                if key != last:
+                    kept.add(record.guid)
+                    last = key
+                    remaining -= 1
+        return kept
+
+class RetentionRules(object):
+    """A list of (pattern, RetentionPolicy) rules; the first that matches a dataset wins."""
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    def __nonzero__(self):
+        return bool(self.rules)
+
+    def policy_for(self, dataset):
+        """Return the RetentionPolicy for DATASET, or None if it is not to be pruned."""
+        for (pattern, policy) in self.rules:
+            if fnmatch.fnmatchcase(dataset, pattern):
+                return policy
+        return None
+
+def parse_rule(text):
+    """Return (pattern, RetentionPolicy) for TEXT, e.g. 'tank/*:daily=7,weekly=4'."""
+    (pattern, colon, counts) = text.rpartition(":")
+    if not colon or not pattern:
+        raise BadRetentionRule("Retention rule must look like PATTERN:daily=N,...", text)
+    kwargs = {}
+    for item in counts.split(","):
+        (period, equals, count) = item.partition("=")
+        if period not in PERIODS or not equals:
+            raise BadRetentionRule("Unknown retention period '{}'".format(item), text)
+        try:
+            kwargs[period] = int(count)
+        except ValueError:
+            raise BadRetentionRule("Bad count for '{}'".format(period), text)
+        if kwargs[period] < 0:
+            raise BadRetentionRule("Negative count for '{}'".format(period), text)
+    return (pattern, RetentionPolicy(**kwargs))
+
+def parse_rules(texts):
+    return RetentionRules(parse_rule(text) for text in texts)
@@ -0,0 +1,215 @@
+"""Which 'zfs send' flags a source and a destination can both handle.
+
+A plain 'zfs send' stream is what any receiver can take, but it costs:
+blocks compressed on disk are decompressed by the sender, sent at
+their logical size and compressed again by the receiver, records over
+128K are split up, and encrypted datasets are sent decrypted. These
+flags avoid that, when both ends support them:
+
+  -L  large blocks: records over 128K are sent whole. Used if the
+      source pool has large_blocks active and the destination pool has
+      it enabled, and the destination dataset either doesn't exist yet
+      or was received with -L before: turning -L on or off partway
+      through a chain of incrementals can corrupt or be refused by the
+      receiver. A dataset seeded with -L is marked with the user
+      property LARGE_BLOCKS_PROPERTY, so later runs keep sending it -L.
+  -c  compressed: blocks are sent as they are compressed on disk.
+      Needs OpenZFS 0.7 on both hosts, and every compression feature
+      active on the source pool (lz4_compress, zstd_compress) enabled
+      on the destination pool.
+  -e  embedded: blocks small enough to live in their block pointer
+      stay there. Needs embedded_data on both pools, and the same
+      compression features as -c.
+  -w  raw, for encrypted datasets only: blocks are sent exactly as
+      they are on disk, still encrypted (and compressed), so the
+      source's key needn't be loaded and the destination never sees
+      the data in the clear. Needs OpenZFS 0.8 on both hosts and the
+      encryption feature on the destination pool, and the destination
+      dataset must be encrypted too (one received raw before) or not
+      exist yet: a raw stream can't be received into an unencrypted
+      dataset, such as one replicated without -w.
+
+An encrypted dataset that can't be sent raw is sent decrypted, as
+before, and then only with -L.
+
+Each host is probed once ('zfs version', and the feature flags of all
+its pools with 'zpool get', plus which datasets are encrypted where
+encryption is active, and which were received with -L where
+large_blocks is). A host whose zfs is too old to answer 'zfs
+version' gets no -c or -w.
+
+Example:
+    src = parse_probe(run(PROBE_COMMAND))
+    dest = parse_probe(run_on_dest(PROBE_COMMAND))
+    (flags, reasons) = choose_flags(src, 'tank/data', dest, 'backup/data')
+    send_cmd = "sudo zfs send {}-I tank/data@a tank/data@b".format(flag_argument(flags))"""
+
+import re
+
+PROBE_COMMAND = "sudo zfs version 2>/dev/null; sudo zpool get -H -p -o name,property,value all"
+# Without 'zfs version' (before OpenZFS 0.8) only the pool features are listed.
+
+COMPRESSED_SEND_VERSION = (0, 7)
+RAW_SEND_VERSION = (0, 8)
+EXCLUDE_VERSION = (2, 1)
+# 'zfs send -R -X', leaving datasets out of a replication stream.
+
+LARGE_BLOCKS_PROPERTY = 'replicate_zfs_snapshots:large_blocks'
+# Set to 'on' on a destination dataset seeded with -L.
+
+COMPRESSION_FEATURES = ('lz4_compress', 'zstd_compress')
+# Blocks compressed with these can only be received as they are by a pool that has them.
+
+FLAG_NAMES = (('L', "large blocks"), ('c', "compressed"), ('e', "embedded"), ('w', "raw"))
+# In the order they are given to 'zfs send'.
+
+class HostFeatures(object):
+    """What one host's zfs can send and receive.
+
+    VERSION is its OpenZFS (major, minor), or None if it is too old to
+    say. POOLS maps each pool to {feature: 'disabled', 'enabled' or
+    'active'}, ENCRYPTED is the set of its encrypted datasets, and
+    LARGE_BLOCKS the set of its datasets received with -L."""
+
+    def __init__(self, version=None, pools=None, encrypted=(), large_blocks=()):
+        self.version = version
+        self.pools = pools if pools is not None else {}
+        self.encrypted = set(encrypted)
+        self.large_blocks = set(large_blocks)
+
+    def has(self, pool, feature):
+        """Can POOL hold blocks that need FEATURE?"""
+        return self.pools.get(pool, {}).get(feature) in ('enabled', 'active')
+
+    def uses(self, pool, feature):
+        """Does POOL already hold blocks that need FEATURE?"""
+        return self.pools.get(pool, {}).get(feature) == 'active'
+
+    def pools_using(self, feature):
+        return sorted(pool for pool in self.pools if self.uses(pool, feature))
+
+    def at_least(self, version):
+        return self.version is not None and self.version >= version
+
+    def describe(self):
+        """Return a one-line summary, e.g. for verbose output."""
+        parts = ["OpenZFS {}.{}".format(*self.version) if self.version else "zfs version unknown"]
+        for pool in sorted(self.pools):
+            active = sorted(feature for (feature, state) in self.pools[pool].iteritems() if state == 'active')
+            parts.append("{} ({} features, active: {})".format(pool, len(self.pools[pool]),
+                                                               ", ".join(active) or "none"))
+        return "; ".join(parts)
+
+def parse_version(line):
+    """Return (major, minor) from a line of 'zfs version' output, e.g. 'zfs-kmod-2.1.5-1', or None."""
+    match = re.match(r'zfs-(?:kmod-)?(\d+)\.(\d+)', line)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+def parse_probe(lines):
+    """Return the HostFeatures described by the output of PROBE_COMMAND.
+
+    The version is the older of the userland and the kernel module's:
+    the module does the receiving, the userland builds the command."""
+    versions = []
+    pools = {}
+    for line in lines:
+        fields = line.split('\t')
+        if len(fields) == 3 and fields[1].startswith('feature@'):
+            pools.setdefault(fields[0], {})[fields[1][len('feature@'):]] = fields[2]
+        elif len(fields) == 1 and parse_version(line):
+            versions.append(parse_version(line))
+    return HostFeatures(min(versions) if versions else None, pools)
+
+def encryption_command(pools):
+    """Return the command listing the encryption of every dataset in POOLS, for parse_encrypted."""
+    return "sudo zfs list -H -o name,encryption -t filesystem,volume -r {}".format(" ".join(pools))
+
+def parse_encrypted(lines):
+    """Return the set of datasets the output of encryption_command says are encrypted."""
+    encrypted = set()
+    for line in lines:
+        fields = line.split('\t')
+        if len(fields) == 2 and fields[1] not in ('off', '-'):
+            encrypted.add(fields[0])
+    return encrypted
+
+def large_blocks_command(pools):
+    """Return the command listing which datasets in POOLS were received with -L, for parse_large_blocks."""
+    return "sudo zfs list -H -o name,{} -t filesystem,volume -r {}".format(LARGE_BLOCKS_PROPERTY, " ".join(pools))
+
+def parse_large_blocks(lines):
+    """Return the set of datasets the output of large_blocks_command says were received with -L."""
+    received = set()
+    for line in lines:
+        fields = line.split('\t')
+        if len(fields) == 2 and fields[1] == 'on':
+            received.add(fields[0])
+    return received
+
+def pool_of(dataset):
+    return dataset.split("/")[0]
+
+def choose_flags(src, src_dataset, dest, dest_dataset, dest_exists=True):
+    """Return (flags, reasons) for sending SRC_DATASET on the host SRC describes to DEST_DATASET on DEST.
+
+    SRC and DEST are HostFeatures. FLAGS are the letters of the send
+    flags to use, e.g. 'Lce' or 'w'; REASONS say why any that might
+    have been used weren't. DEST_EXISTS is whether DEST_DATASET exists
+    yet (if not, it will be created by a full send); if it does, it
+    only gets -L if it was received with -L before."""
+    (src_pool, dest_pool) = (pool_of(src_dataset), pool_of(dest_dataset))
+    reasons = []
+    if src_dataset in src.encrypted:
+        if not (src.at_least(RAW_SEND_VERSION) and dest.at_least(RAW_SEND_VERSION)):
+            reasons.append("not raw: needs OpenZFS {}.{} on both hosts".format(*RAW_SEND_VERSION))
+        elif not dest.has(dest_pool, 'encryption'):
+            reasons.append("not raw: encryption not enabled on {}".format(dest_pool))
+        elif dest_exists and dest_dataset not in dest.encrypted:
+            reasons.append("not raw: {} is not encrypted".format(dest_dataset))
+        else:
+            return ('w', reasons)
+    flags = ""
+    if src.uses(src_pool, 'large_blocks'):
+        if not dest.has(dest_pool, 'large_blocks'):
+            reasons.append("no -L: large_blocks not enabled on {}".format(dest_pool))
+        elif dest_exists and dest_dataset not in dest.large_blocks:
+            reasons.append("no -L: existing replica not received with -L")
+        else:
+            flags += 'L'
+    if src_dataset in src.encrypted:
+        ## Sent decrypted: the blocks on disk are no use to the receiver
+        return (flags, reasons)
+    missing = [feature for feature in COMPRESSION_FEATURES
+               if src.uses(src_pool, feature) and not dest.has(dest_pool, feature)]
+    if missing:
+        reasons.append("no -c or -e: {} not enabled on {}".format(", ".join(missing), dest_pool))
+    elif not (src.at_least(COMPRESSED_SEND_VERSION) and dest.at_least(COMPRESSED_SEND_VERSION)):
+        reasons.append("no -c: needs OpenZFS {}.{} on both hosts".format(*COMPRESSED_SEND_VERSION))
+    else:
+        flags += 'c'
+    if not missing and src.uses(src_pool, 'embedded_data'):
+        if dest.has(dest_pool, 'embedded_data'):
+            flags += 'e'
+        else:
+            reasons.append("no -e: embedded_data not enabled on {}".format(dest_pool))
+    return (flags, reasons)
+
+def flag_argument(flags):
+    """Return FLAGS as 'zfs send' arguments, followed by a space ('' if there are none)."""
+    return "-{} ".format(flags) if flags else ""
+
+def describe_flags(flags):
+    """Return e.g. '-Lce (large blocks, compressed, embedded)', or 'no flags'."""
+    if not flags:
+        return "no flags"
+    return "-{} ({})".format(flags, ", ".join(name for (letter, name) in FLAG_NAMES if letter in flags))
+
+def plain_command(send_cmd):
+    """Return SEND_CMD without the flags flag_argument put in, if they make its stream smaller; else None.
+
+    Only -c and -w change how many bytes are sent (-L and -e change how
+    they are laid out), so only then is the plain stream worth sizing."""
+    match = re.search(r'zfs send -([Lcew]+) ', send_cmd)
+    if match is None or not set(match.group(1)) & set('cw'):
+        return None
+    return send_cmd[:match.start()] + "zfs send " + send_cmd[match.end():]
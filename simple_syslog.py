@@ -1,10 +1,27 @@
 """Simplified interface to syslog via logging module.
 
 Not proud of this, but at least it enforces consistent
-formatting?!?!"""
+formatting?!?!
+
+Records are sent to syslog by a background thread, so a backlogged
+syslog never stalls the caller. At most max_queued records wait to be
+sent; what happens to more is up to the overflow policy (see init),
+and how many were dropped is logged once there is room again. Whatever
+is still queued is sent when the program exits (for at most
+FLUSH_SECONDS, so a stuck syslog can't hold the exit up), and anything
+logged after that (e.g. by another atexit function) is sent directly.
+
+lines() logs a header followed by a list of items (e.g. snapshot
+names) as a few multi-line records rather than one record per item.
+
+Example:
+    simple_syslog.init("ZfsReplicate", simple_syslog.INFO)
+    simple_syslog.info("Started")
+    simple_syslog.lines(simple_syslog.DEBUG, "Local snapshots", snapshots)"""
 
 import logging
 import logging.handlers
+import threading, collections, atexit, time
 
 ## Severity levels
 
@@ -28,27 +45,191 @@ CRITICAL = logging.CRITICAL
 # A serious error, indicating that the program itself may be unable to
 # continue running.
 
+## Overflow policies: what to do with a record when the queue is full
+
+DROP_OLDEST = 'drop-oldest'
+# Throw away the oldest queued record to make room.
+
+DROP_NEWEST = 'drop-newest'
+# Throw away the record being logged.
+
+BLOCK = 'block'
+# Wait for room, as an unqueued handler would.
+
+MAX_QUEUED = 10000
+# Default for the most records waiting to be sent.
+
+MAX_MESSAGE_BYTES = 2048
+# Most bytes of items lines() puts in one record. Many syslog daemons
+# truncate messages much longer than this.
+
+FLUSH_SECONDS = 5.0
+# How long to wait at exit for queued records to be sent.
+
+class BackgroundHandler(logging.Handler):
+    """Hands records on to TARGET (another handler) from a background thread.
+
+    At most MAX_QUEUED records wait; when there are that many, OVERFLOW
+    (DROP_OLDEST, DROP_NEWEST or BLOCK) says what to do with another."""
+
+    def __init__(self, target, max_queued=MAX_QUEUED, overflow=DROP_OLDEST):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._sending = False
+        self._closed = False
+        self._abandoned = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='simple_syslog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        with self._cond:
+            if self._closed:
+                self.target.handle(record)
+                return
+            while len(self._queue) >= self.max_queued:
+                if self.overflow == BLOCK:
+                    self._cond.wait()
+                    continue
+                self.dropped += 1
+                if self.overflow == DROP_NEWEST:
+                    return
+                self._queue.popleft()
+            self._queue.append(record)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                records = list(self._queue)
+                self._queue.clear()
+                (dropped, self.dropped) = (self.dropped, 0)
+                self._sending = True
+                self._cond.notify_all()
+            if dropped:
+                self.target.handle(logging.LogRecord(records[0].name, WARNING, __file__, 0,
+                                                     "%d log records dropped: queue full", (dropped,), None))
+            for record in records:
+                if self._abandoned:
+                    return
+                self.target.handle(record)
+            with self._cond:
+                self._sending = False
+                self._cond.notify_all()
+
+    def flush(self, timeout=FLUSH_SECONDS):
+        """Wait (for at most TIMEOUT seconds; None for no limit) for the queued records to be sent.
+
+        Once stopped, return at once: stop() has already waited as long
+        as it should. (logging.shutdown() calls this at exit, with no
+        arguments.)"""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            while (self._queue or self._sending) and self._thread.is_alive() and not self._closed:
+                if deadline is None:
+                    self._cond.wait()
+                elif time.time() >= deadline:
+                    break
+                else:
+                    self._cond.wait(deadline - time.time())
+        self.target.flush()
+
+    def stop(self, timeout=FLUSH_SECONDS):
+        """Send what is queued (waiting at most TIMEOUT seconds), then stop the thread.
+
+        Whatever is still unsent after TIMEOUT is dropped. Records
+        emitted after this go straight to the target. Stopping again
+        (e.g. close() from logging.shutdown()) doesn't wait again."""
+        with self._cond:
+            stopped = self._closed
+            self._closed = True
+            self._cond.notify_all()
+        if stopped:
+            return
+        self._thread.join(timeout)
+        self._abandoned = True
+
+    def close(self, timeout=FLUSH_SECONDS):
+        """Stop (see stop), and close the target."""
+        self.stop(timeout)
+        self.target.close()
+        logging.Handler.close(self)
+
 _logger = None
+_background_handler = None
 
-def init(log_name, threshold):
+def init(log_name, threshold, max_queued=MAX_QUEUED, overflow=DROP_OLDEST):
     """Create logger sending messages meeting threshold to syslog.
 
+    Messages are sent from a background thread, with at most
+    MAX_QUEUED waiting; OVERFLOW (DROP_OLDEST, DROP_NEWEST or BLOCK)
+    says what happens to more.
+
     Example call: simple_syslog.init("ZfsReplicate", INFO)"""
     global _logger
     global _syslog_handler
+    global _background_handler
     _logger = logging.getLogger(log_name)
     _logger.setLevel(threshold)# Create syslog handler, set level to threshold
     _syslog_handler = logging.handlers.SysLogHandler(address = '/dev/log')
     _syslog_handler.setLevel(threshold)
     formatter = logging.Formatter('%(levelname)s:%(name)s: %(asctime)s %(message)s')
     _syslog_handler.setFormatter(formatter)
-    _logger.addHandler(_syslog_handler)
+    _background_handler = BackgroundHandler(_syslog_handler, max_queued, overflow)
+    _background_handler.setLevel(threshold)
+    _logger.addHandler(_background_handler)
+    atexit.register(shutdown)
 
 def setLevel(threshold):
     global _logger
     assert _logger
     _logger.setLevel(threshold)
     _syslog_handler.setLevel(threshold)
+    _background_handler.setLevel(threshold)
+
+def flush(timeout=None):
+    """Wait until everything logged so far has been sent to syslog."""
+    assert _logger
+    _background_handler.flush(timeout)
+
+def shutdown():
+    """Send whatever is still queued, and stop the background thread (done at exit).
+
+    Anything logged afterwards is sent to syslog directly."""
+    if _background_handler is not None:
+        _background_handler.stop()
+
+def lines(level, header, items):
+    """Log HEADER followed by ITEMS, one per line, in as few records as will do.
+
+    Each record carries as many items as fit in MAX_MESSAGE_BYTES, so
+    a list of 10,000 snapshots goes out as a handful of syslog messages
+    rather than 10,000. Nothing is formatted if LEVEL isn't logged."""
+    global _logger
+    assert _logger
+    if not _logger.isEnabledFor(level):
+        return
+    chunks = [[]]
+    size = 0
+    for item in items:
+        line = " {}".format(item)
+        if chunks[-1] and size + len(line) + 1 > MAX_MESSAGE_BYTES:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(line)
+        size += len(line) + 1
+    for (index, chunk) in enumerate(chunks):
+        part = " ({}/{})".format(index + 1, len(chunks)) if len(chunks) > 1 else ""
+        _logger.log(level, "\n".join(["{}{}:".format(header, part)] + chunk))
 
 def debug(msg):
     global _logger
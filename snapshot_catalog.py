@@ -0,0 +1,229 @@
+"""In-memory catalog of the snapshots of ZFS datasets.
+
+Snapshots are identified by guid rather than by name: a snapshot
+received by 'zfs receive' keeps the guid it had on the sending side,
+while a snapshot that was destroyed and re-created under the same name
+(or created independently on both sides) gets a new one. Matching by
+guid means we never plan an incremental from a snapshot that merely has
+the right name, and lets us point out such name collisions.
+
+Each dataset's snapshots are kept sorted by createtxg (i.e. creation
+order) and indexed by guid and by name, so membership tests are O(1),
+and finding the snapshots after a given one is O(log n).
+
+A bookmark ('dataset#name') keeps the guid and createtxg of the
+snapshot it was made from, and can stand in for it as the base of an
+incremental send once the snapshot itself has been destroyed. A
+catalog's bookmarks are kept apart from its snapshots: iterating over
+a catalog, counting it, and everything else but last_common_base and
+the bookmark methods see only the snapshots.
+
+Example:
+    catalogs = catalogs_from_listing(lines_of_zfs_list_output)
+    src = catalogs['tank/home']
+    common = src.last_common(dest)
+    to_send = src.after(common)
+    base = src.last_common_base(dest)    # may be a BookmarkRecord"""
+
+import bisect
+
+class SnapshotRecord(object):
+    """One snapshot: NAME is the part after the '@'.
+
+    CREATION is its creation time (seconds since the epoch), or None if
+    not known. Unlike createtxg it is kept by 'zfs receive'."""
+
+    __slots__ = ('name', 'guid', 'createtxg', 'creation')
+
+    def __init__(self, name, guid, createtxg, creation=None):
+        self.name = name
+        self.guid = guid
+        self.createtxg = createtxg
+        self.creation = creation
+
+    def __repr__(self):
+        return "SnapshotRecord({!r}, {!r}, {!r}, {!r})".format(self.name, self.guid, self.createtxg, self.creation)
+
+class BookmarkRecord(SnapshotRecord):
+    """One bookmark: NAME is the part after the '#'."""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return "BookmarkRecord({!r}, {!r}, {!r}, {!r})".format(self.name, self.guid, self.createtxg, self.creation)
+
+class SnapshotCatalog(object):
+    """The snapshots of one dataset, in creation order.
+
+    RESUME_TOKEN is the dataset's receive_resume_token, or None if it
+    has no interrupted receive. BOOKMARKS are its BookmarkRecords."""
+
+    __slots__ = ('dataset', 'resume_token', '_records', '_txgs', '_by_guid', '_by_name', '_bookmarks',
+                 '_bookmarks_by_name')
+
+    def __init__(self, dataset, records=(), resume_token=None, bookmarks=()):
+        self.dataset = dataset
+        self.resume_token = resume_token
+        self._records = sorted(records, key=lambda record: record.createtxg)
+        self._bookmarks_by_name = dict((bookmark.name, bookmark) for bookmark in bookmarks)
+        self._reindex()
+        self._reindex_bookmarks()
+
+    def _reindex(self):
+        self._txgs = [record.createtxg for record in self._records]
+        self._by_guid = dict((record.guid, record) for record in self._records)
+        self._by_name = dict((record.name, record) for record in self._records)
+
+    def _reindex_bookmarks(self):
+        ## Several bookmarks (e.g. made by jobs to different destinations) can share a guid; any will do as a base
+        self._bookmarks = dict((bookmark.guid, bookmark) for bookmark in self._bookmarks_by_name.itervalues())
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __contains__(self, guid):
+        return guid in self._by_guid
+
+    def full_name(self, record):
+        """Return 'dataset@snapshot' for RECORD, or 'dataset#bookmark' if it is a BookmarkRecord."""
+        return "{}{}{}".format(self.dataset, "#" if isinstance(record, BookmarkRecord) else "@", record.name)
+
+    def oldest(self):
+        return self._records[0] if self._records else None
+
+    def latest(self):
+        return self._records[-1] if self._records else None
+
+    def find_guid(self, guid):
+        return self._by_guid.get(guid)
+
+    def find_name(self, name):
+        return self._by_name.get(name)
+
+    def add(self, record):
+        """Add RECORD, keeping creation order."""
+        index = bisect.bisect_right(self._txgs, record.createtxg)
+        self._records.insert(index, record)
+        self._txgs.insert(index, record.createtxg)
+        self._by_guid[record.guid] = record
+        self._by_name[record.name] = record
+
+    def after(self, record):
+        """Return the snapshots created after RECORD (which need not be in this catalog)."""
+        return self._records[bisect.bisect_right(self._txgs, record.createtxg):]
+
+    def last_common(self, other):
+        """Return our newest snapshot that is also (by guid) in OTHER, or None.
+
+        OTHER is scanned back from its newest snapshot, so normally only
+        the few snapshots it has that we don't are looked at."""
+        for record in reversed(other._records):
+            if record.guid in self._by_guid:
+                return self._by_guid[record.guid]
+        return None
+
+    def last_common_base(self, other):
+        """Return our newest snapshot or bookmark whose guid is one of OTHER's snapshots, or None.
+
+        Like last_common, but a snapshot we have destroyed still counts
+        if we kept a bookmark of it; a snapshot is preferred to a
+        bookmark of it."""
+        for record in reversed(other._records):
+            if record.guid in self._by_guid:
+                return self._by_guid[record.guid]
+            if record.guid in self._bookmarks:
+                return self._bookmarks[record.guid]
+        return None
+
+    def bookmarks(self):
+        """Return our bookmarks, oldest first."""
+        return sorted(self._bookmarks_by_name.itervalues(), key=lambda bookmark: bookmark.createtxg)
+
+    def find_bookmark(self, guid):
+        return self._bookmarks.get(guid)
+
+    def find_bookmark_name(self, name):
+        return self._bookmarks_by_name.get(name)
+
+    def add_bookmark(self, bookmark):
+        self._bookmarks_by_name[bookmark.name] = bookmark
+        self._bookmarks[bookmark.guid] = bookmark
+
+    def remove_bookmarks(self, bookmarks):
+        """Forget BOOKMARKS (e.g. because they have been destroyed)."""
+        for bookmark in bookmarks:
+            self._bookmarks_by_name.pop(bookmark.name, None)
+        self._reindex_bookmarks()
+
+    def not_in(self, other):
+        """Return our snapshots (oldest first) whose guid is not in OTHER."""
+        return [record for record in self._records if record.guid not in other._by_guid]
+
+    def name_collisions(self, other):
+        """Return (ours, theirs) pairs of snapshots with the same name but different guids."""
+        collisions = []
+        for record in self._records:
+            theirs = other._by_name.get(record.name)
+            if theirs is not None and theirs.guid != record.guid:
+                collisions.append((record, theirs))
+        return collisions
+
+    def remove(self, records):
+        """Forget RECORDS (e.g. because they have been destroyed)."""
+        guids = set(record.guid for record in records)
+        self._records = [record for record in self._records if record.guid not in guids]
+        self._reindex()
+
+    def truncate_after(self, record):
+        """Forget every snapshot newer than RECORD (what 'zfs receive -F' rolls back)."""
+        del self._records[bisect.bisect_right(self._txgs, record.createtxg):]
+        self._reindex()
+
+    def received_incremental(self, base, records):
+        """Record a 'zfs receive -F' of an incremental stream from BASE (found by guid) adding RECORDS."""
+        self.truncate_after(self.find_guid(base.guid))
+        self.append_received(records)
+
+    def append_received(self, records):
+        """Add copies of RECORDS (from the sending side) as received after our newest snapshot.
+
+        The receiving side's createtxg is not known without listing it
+        again, so the copies are numbered on from our newest snapshot;
+        that keeps them in the right order."""
+        createtxg = self._txgs[-1] if self._txgs else 0
+        for record in records:
+            createtxg += 1
+            self.add(SnapshotRecord(record.name, record.guid, createtxg, record.creation))
+
+def catalogs_from_listing(lines):
+    """Build a dict of dataset name -> SnapshotCatalog from 'zfs list' output.
+
+    LINES come from 'zfs list -H -p -t filesystem,volume,snapshot,bookmark
+    -o name,guid,createtxg,creation,receive_resume_token', and may be an
+    iterator, so a huge listing never has to be held in memory as text.
+    Lines that don't have those five fields are skipped."""
+    records = {}
+    resume_tokens = {}
+    bookmarks = {}
+    for line in lines:
+        fields = line.split('\t')
+        if len(fields) != 5:
+            continue
+        (name, guid, createtxg, creation, resume_token) = fields
+        if "#" in name:
+            (dataset, bookmark) = name.split("#", 1)
+            bookmarks.setdefault(dataset, []).append(BookmarkRecord(bookmark, int(guid), int(createtxg),
+                                                                    int(creation)))
+        elif "@" in name:
+            (dataset, snapshot) = name.split("@", 1)
+            records.setdefault(dataset, []).append(SnapshotRecord(snapshot, int(guid), int(createtxg),
+                                                                  int(creation)))
+        else:
+            records.setdefault(name, [])
+            if resume_token != '-':
+                resume_tokens[name] = resume_token
+    return dict((dataset, SnapshotCatalog(dataset, snapshots, resume_tokens.get(dataset), bookmarks.get(dataset, ())))
+                for (dataset, snapshots) in records.iteritems())
@@ -0,0 +1,159 @@
+"""Compression of replication streams between hosts.
+
+The codec is given as a string:
+
+  ssh          compress with 'ssh -C' (zlib); the old behaviour
+  none         no compression at all
+  lz4          lz4 (fast, light compression)
+  zstd[:N]     zstd at level N (default 3)
+  zstdmt[:N]   zstd at level N using all cores on the sending host
+  auto         multi-threaded zstd, with the level adjusted from stream to stream
+
+Apart from 'ssh', the compressor runs next to 'zfs send' and the
+decompressor next to 'zfs receive', so the chosen tool must be
+installed on both hosts.
+
+In 'auto' mode the first few seconds of each stream are sampled at
+the relay (on the host running the script). When the link is after
+the relay (a local source, sent to a remote host), a buffer sitting
+empty means the sender and compressor can't keep up, so the level
+goes down, and one sitting full means the link (or the receiver) is
+the bottleneck, so it goes up. When the link is before the relay (a
+remote source, received here), a slow link empties the buffer too,
+so the signal is read the other way round: empty raises the level,
+unless the stream moved clearly less data per second than one sent
+a step lower, which means the compressor is what holds it back; full
+(the receiver is the bottleneck) lowers it.
+
+A stream's level is fixed when it starts, so only the streams after
+the sample use the new level: a single long stream, such as the seed
+of a big dataset, runs at the level it started with."""
+
+import threading
+
+DEFAULT_ZSTD_LEVEL = 3
+MIN_ZSTD_LEVEL = 1
+MAX_ZSTD_LEVEL = 19
+
+AUTO_SAMPLE_SECONDS = 5.0
+# How long into a stream 'auto' mode looks at the relay before judging it.
+
+AUTO_MIN_SAMPLE_SECONDS = 1.0
+# Streams shorter than this say too little to go on.
+
+AUTO_LEVEL_STEP = 2
+
+AUTO_RATE_DROP = 0.1
+# With the link before the relay, a stream moving this much less data
+# per second than the last one a step lower did is taken to be held
+# back by its compressor rather than by the link.
+
+class UnknownCodec(Exception):
+    pass
+
+class StreamCodec(object):
+    """A compression codec: NAME is 'ssh', 'none', 'lz4', 'zstd' or 'zstdmt'."""
+
+    def __init__(self, name, level=None):
+        self.name = name
+        self.level = level
+
+    def __str__(self):
+        if self.level is None:
+            return self.name
+        return "{}:{}".format(self.name, self.level)
+
+    def uses_ssh_compression(self):
+        return self.name == 'ssh'
+
+    def compress_command(self):
+        """Shell command compressing stdin to stdout, or None."""
+        if self.name == 'lz4':
+            return "lz4 -c"
+        if self.name == 'zstd':
+            return "zstd -q -c -{}".format(self.level)
+        if self.name == 'zstdmt':
+            return "zstd -q -c -T0 -{}".format(self.level)
+        return None
+
+    def decompress_command(self):
+        """Shell command decompressing stdin to stdout, or None."""
+        if self.name == 'lz4':
+            return "lz4 -d -c"
+        if self.name in ('zstd', 'zstdmt'):
+            return "zstd -q -d -c"
+        return None
+
+NO_COMPRESSION = StreamCodec('none')
+
+class AdaptiveCodec(object):
+    """Picks a multi-threaded zstd level for each stream, based on how the last ones went."""
+
+    def __init__(self, level=DEFAULT_ZSTD_LEVEL):
+        self.name = 'auto'
+        self.level = level
+        self._lock = threading.Lock()
+        ## level -> bytes per second of the last stream sampled at it, with the link before the relay
+        self._rates = {}
+
+    def __str__(self):
+        return "auto (zstdmt:{})".format(self.level)
+
+    def uses_ssh_compression(self):
+        return False
+
+    def codec(self):
+        """The codec to use for the next stream."""
+        with self._lock:
+            return StreamCodec('zstdmt', self.level)
+
+    def sample(self, elapsed, seconds_full, seconds_empty, bytes_moved=0, link_upstream=False):
+        """Adjust the level after ELAPSED seconds of a stream (see the module docstring).
+
+        SECONDS_FULL is how long the relay buffer was full (its input
+        was waiting for its output), SECONDS_EMPTY how long it was empty
+        (its output was waiting for its input), and BYTES_MOVED how many
+        (compressed) bytes it passed on. LINK_UPSTREAM says whether the
+        link between the hosts feeds the relay, rather than being fed by
+        it. Return the new level."""
+        with self._lock:
+            if elapsed < AUTO_MIN_SAMPLE_SECONDS:
+                return self.level
+            starved = seconds_empty / elapsed > 0.5
+            backed_up = seconds_full / elapsed > 0.5
+            step = 0
+            if not link_upstream:
+                if starved:
+                    step = -AUTO_LEVEL_STEP
+                elif backed_up:
+                    step = AUTO_LEVEL_STEP
+            else:
+                rate = bytes_moved / elapsed
+                lower = self._rates.get(self.level - AUTO_LEVEL_STEP)
+                self._rates[self.level] = rate
+                if starved and lower is not None and rate < lower * (1 - AUTO_RATE_DROP):
+                    ## Compressing harder slowed the stream down: the compressor is the limit
+                    step = -AUTO_LEVEL_STEP
+                elif starved:
+                    step = AUTO_LEVEL_STEP
+                elif backed_up:
+                    step = -AUTO_LEVEL_STEP
+            self.level = max(MIN_ZSTD_LEVEL, min(MAX_ZSTD_LEVEL, self.level + step))
+            return self.level
+
+def parse_codec(text):
+    """Return the codec named by TEXT (see module docstring)."""
+    (name, _, level) = text.partition(":")
+    if name == 'auto' and not level:
+        return AdaptiveCodec()
+    if name in ('ssh', 'none', 'lz4') and not level:
+        return StreamCodec(name)
+    if name in ('zstd', 'zstdmt'):
+        try:
+            level = int(level) if level else DEFAULT_ZSTD_LEVEL
+        except ValueError:
+            raise UnknownCodec("Bad zstd level", text)
+        if not MIN_ZSTD_LEVEL <= level <= MAX_ZSTD_LEVEL:
+            raise UnknownCodec("zstd level out of range", text)
+        return StreamCodec(name, level)
+    raise UnknownCodec("Unknown compression codec", text)
@@ -0,0 +1,416 @@
+"""Buffered relay between a 'zfs send' and a 'zfs receive' process.
+
+A plain shell pipe between the two only holds 64KiB, so a bursty
+sender and a receiver that stalls on txg syncs keep throttling each
+other. The relay sits between them with a large memory buffer (like
+mbuffer, but without needing it installed on either end): one thread
+reads large blocks from the sender into the buffer as fast as it can,
+while the caller's thread writes them out to the receiver. When the
+buffer is full the reader waits, so the sender sees backpressure rather
+than the buffer growing without bound.
+
+TeeRelay does the same for one sender and several receivers, each
+with a buffer of its own, so one stream can be sent to several
+destinations.
+
+SpliceRelay is for a sender and receiver on the machine running the
+script: it moves the stream straight from the sender's pipe to the
+receiver's with splice(2), so it is never copied through Python, and
+the buffering is done by the two pipes themselves, enlarged with
+F_SETPIPE_SZ. It needs Linux (see splice_available).
+
+Example:
+    relay = Relay(send.stdout.fileno(), receive.stdin.fileno(), buffer_size=256 << 20)
+    relay.run()
+    print relay.bytes_written"""
+
+import os, sys, errno, fcntl, select, threading, time, collections
+
+BLOCK_SIZE = 1 << 20
+# Size of each read from the sender and write to the receiver.
+
+DEFAULT_BUFFER_SIZE = 256 << 20
+# Bytes the relay may hold in memory between sender and receiver.
+
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+# From <linux/fcntl.h>; Python 2's fcntl module doesn't have them.
+
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+
+PIPE_MAX_SIZE_FILE = "/proc/sys/fs/pipe-max-size"
+
+class RelayError(Exception):
+    pass
+
+_splice = None
+
+def splice_available():
+    """Can SpliceRelay be used here? (Linux, with splice(2) reachable through ctypes.)"""
+    global _splice
+    if _splice is None:
+        _splice = False
+        if sys.platform.startswith('linux'):
+            try:
+                import ctypes
+                ## The C library python itself is linked against
+                function = ctypes.CDLL(None, use_errno=True).splice
+                function.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_size_t, ctypes.c_uint]
+                function.restype = ctypes.c_ssize_t
+                _splice = function
+            except (ImportError, OSError, AttributeError):
+                pass
+    return _splice is not False
+
+def pipe_max_size():
+    """Return the largest pipe buffer an unprivileged process may ask for."""
+    try:
+        with open(PIPE_MAX_SIZE_FILE) as f:
+            return int(f.read())
+    except (IOError, ValueError):
+        return 1 << 20
+
+def enlarge_pipe(fd, size):
+    """Make the buffer of pipe FD SIZE bytes, or as big as we are allowed; return its size."""
+    for attempt in (size, pipe_max_size()):
+        try:
+            return fcntl.fcntl(fd, F_SETPIPE_SZ, attempt)
+        except IOError as e:
+            ## EPERM: over the limit for non-root; EBUSY: it holds more than that already
+            if e.errno not in (errno.EPERM, errno.EINVAL, errno.EBUSY):
+                raise
+    return fcntl.fcntl(fd, F_GETPIPE_SZ)
+
+class RingBuffer(object):
+    """Bounded FIFO of byte blocks, shared by one reader and one writer thread.
+
+    put() blocks while the buffer is full, get() blocks while it is
+    empty. The time each side spends blocked is recorded, which tells
+    us which end of the transfer is the bottleneck."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.closed = False
+        self.aborted = False
+        self.seconds_full = 0.0
+        self.seconds_empty = 0.0
+        self._blocks = collections.deque()
+        self._cond = threading.Condition()
+
+    def put(self, block, timeout=None):
+        """Add BLOCK, waiting (up to TIMEOUT seconds, if given) for room.
+
+        Return False if the buffer was aborted, or if there was still no
+        room after TIMEOUT."""
+        with self._cond:
+            if self.size + len(block) > self.capacity and self._blocks:
+                started = time.time()
+                while self.size + len(block) > self.capacity and self._blocks and not self.aborted:
+                    if timeout is None:
+                        self._cond.wait()
+                        continue
+                    remaining = started + timeout - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                self.seconds_full += time.time() - started
+            if self.aborted or (self.size + len(block) > self.capacity and self._blocks):
+                return False
+            self._blocks.append(block)
+            self.size += len(block)
+            self._cond.notify_all()
+            return True
+
+    def get(self):
+        """Remove and return the oldest block, or None once closed and drained (or aborted)."""
+        with self._cond:
+            if not self._blocks and not self.closed:
+                started = time.time()
+                while not self._blocks and not self.closed and not self.aborted:
+                    self._cond.wait()
+                self.seconds_empty += time.time() - started
+            if self.aborted or not self._blocks:
+                return None
+            block = self._blocks.popleft()
+            self.size -= len(block)
+            self._cond.notify_all()
+            return block
+
+    def close(self):
+        """No more blocks will be added."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """Give up: wake and stop both sides, dropping anything still buffered."""
+        with self._cond:
+            self.aborted = True
+            self._blocks.clear()
+            self.size = 0
+            self._cond.notify_all()
+
+def write_all(fd, data):
+    """Write all of DATA to FD (os.write may write only part of it)."""
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+class Relay(object):
+    """Copy everything from SOURCE_FD to SINK_FD through a RingBuffer of BUFFER_SIZE bytes."""
+
+    def __init__(self, source_fd, sink_fd, buffer_size=DEFAULT_BUFFER_SIZE, block_size=BLOCK_SIZE,
+                 sample_after=None, on_sample=None):
+        """If ON_SAMPLE is given, it is called with the relay once SAMPLE_AFTER
+        seconds have passed (or at the end, if the stream is shorter)."""
+        self.source_fd = source_fd
+        self.sink_fd = sink_fd
+        self.block_size = block_size
+        self.sample_after = sample_after
+        self.on_sample = on_sample
+        self.buffer = RingBuffer(max(buffer_size, block_size))
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.started = None
+        self.finished = None
+        self._read_error = None
+
+    def _read(self):
+        try:
+            while True:
+                block = os.read(self.source_fd, self.block_size)
+                if not block:
+                    break
+                self.bytes_read += len(block)
+                if not self.buffer.put(block):
+                    break
+        except (OSError, IOError) as e:
+            self._read_error = e
+        finally:
+            self.buffer.close()
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def _sample(self):
+        on_sample = self.on_sample
+        self.on_sample = None
+        on_sample(self)
+
+    def run(self):
+        """Relay until the source reaches end of file. Return the number of bytes relayed.
+
+        Raises RelayError if reading or writing fails, e.g. because the
+        receiver exited early. The caller should then stop the sender,
+        which also lets the reader thread finish."""
+        self.started = time.time()
+        reader = threading.Thread(target=self._read)
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                block = self.buffer.get()
+                if block is None:
+                    break
+                write_all(self.sink_fd, block)
+                self.bytes_written += len(block)
+                if self.on_sample and time.time() - self.started >= self.sample_after:
+                    self._sample()
+        except (OSError, IOError) as e:
+            self.buffer.abort()
+            self.finished = time.time()
+            if e.errno == errno.EPIPE:
+                raise RelayError("receiver stopped reading after {} bytes".format(self.bytes_written))
+            raise RelayError("error writing to receiver: {}".format(e))
+        reader.join()
+        self.finished = time.time()
+        if self.on_sample:
+            self._sample()
+        if self._read_error is not None:
+            raise RelayError("error reading from sender: {}".format(self._read_error))
+        return self.bytes_written
+
+class SpliceRelay(object):
+    """Move everything from pipe SOURCE_FD to pipe SINK_FD with splice(2), without copying it.
+
+    Each pipe is enlarged to hold half of BUFFER_SIZE bytes (see
+    enlarge_pipe). Needs splice_available(). Has the same
+    counters as Relay, but no RingBuffer: a splice can't tell how long
+    it waited on either side."""
+
+    def __init__(self, source_fd, sink_fd, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.source_fd = source_fd
+        self.sink_fd = sink_fd
+        self.buffer_size = buffer_size
+        self.pipe_sizes = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.started = None
+        self.finished = None
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def run(self):
+        """Relay until the source reaches end of file. Return the number of bytes relayed.
+
+        Raises RelayError if splicing fails, e.g. because the receiver
+        exited early; the caller should then stop the sender."""
+        self.started = time.time()
+        if not splice_available():
+            raise RelayError("splice(2) is not available here")
+        try:
+            self.pipe_sizes = (enlarge_pipe(self.source_fd, self.buffer_size // 2),
+                               enlarge_pipe(self.sink_fd, self.buffer_size // 2))
+            from ctypes import get_errno
+            source = select.poll()
+            source.register(self.source_fd, select.POLLIN)
+            while True:
+                ## Wait for data (or end of file) first: a receiver that
+                ## exits once it has the whole stream, before the sender
+                ## does, would otherwise make the splice fail with EPIPE
+                try:
+                    events = source.poll()
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise OSError(*e.args)
+                if not any(event & select.POLLIN for (_, event) in events):
+                    ## Only POLLHUP: the sender has closed its end, and it's empty
+                    break
+                ## Blocks (without the GIL) until the receiver's pipe has room
+                moved = _splice(self.source_fd, None, self.sink_fd, None, self.pipe_sizes[0],
+                                SPLICE_F_MOVE | SPLICE_F_MORE)
+                if moved == 0:
+                    break
+                if moved < 0:
+                    error = get_errno()
+                    if error == errno.EINTR:
+                        continue
+                    raise OSError(error, os.strerror(error))
+                self.bytes_read += moved
+                self.bytes_written += moved
+        except (OSError, IOError) as e:
+            self.finished = time.time()
+            if e.errno == errno.EPIPE:
+                raise RelayError("receiver stopped reading after {} bytes".format(self.bytes_written))
+            raise RelayError("error splicing to receiver: {}".format(e))
+        self.finished = time.time()
+        return self.bytes_written
+
+class TeeSink(object):
+    """One receiver of a TeeRelay. ERROR says why it was detached, or is None."""
+
+    def __init__(self, fd, buffer):
+        self.fd = fd
+        self.buffer = buffer
+        self.bytes_written = 0
+        self.error = None
+
+class TeeRelay(object):
+    """Copy everything from SOURCE_FD to each of SINK_FDS, through a RingBuffer of BUFFER_SIZE bytes each.
+
+    The buffers hold the same blocks, so memory use is not multiplied
+    by the number of sinks. The sender is held back by the slowest
+    sink still attached. If SPLIT_AFTER is given, a sink that has kept
+    the sender waiting for that many seconds in all, while some other
+    sink had room, is detached so it no longer holds the others back;
+    what it received is then incomplete, and has to be finished some
+    other way (e.g. by resuming the receive)."""
+
+    def __init__(self, source_fd, sink_fds, buffer_size=DEFAULT_BUFFER_SIZE, block_size=BLOCK_SIZE,
+                 split_after=None):
+        self.source_fd = source_fd
+        self.block_size = block_size
+        self.split_after = split_after
+        self.sinks = [TeeSink(fd, RingBuffer(max(buffer_size, block_size))) for fd in sink_fds]
+        self.bytes_read = 0
+        self.started = None
+        self.finished = None
+        self._read_error = None
+
+    @property
+    def bytes_written(self):
+        """Bytes written to the sink that has had the most."""
+        return max(sink.bytes_written for sink in self.sinks)
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def _read(self):
+        try:
+            while True:
+                block = os.read(self.source_fd, self.block_size)
+                if not block:
+                    break
+                self.bytes_read += len(block)
+                attached = [sink for sink in self.sinks if sink.error is None]
+                for sink in attached:
+                    if not self._put(sink, block, attached):
+                        if sink.error is None:
+                            sink.error = "split off: held the others back for {}s".format(self.split_after)
+                        sink.buffer.abort()
+                if not any(sink.error is None for sink in self.sinks):
+                    break
+        except (OSError, IOError) as e:
+            self._read_error = e
+        finally:
+            for sink in self.sinks:
+                sink.buffer.close()
+
+    def _put(self, sink, block, attached):
+        """Put BLOCK into SINK's buffer; return False if SINK is to be detached."""
+        if self.split_after is None or len(attached) < 2:
+            return sink.buffer.put(block)
+        while True:
+            if sink.buffer.put(block, max(self.split_after - sink.buffer.seconds_full, 0)):
+                return True
+            if sink.buffer.aborted:
+                return False
+            ## Only split a sink off if some other one is ready for more;
+            ## if they are all full, they are all as slow as each other
+            if any(other.buffer.size + len(block) <= other.buffer.capacity
+                   for other in attached if other is not sink and other.error is None):
+                return False
+            if sink.buffer.put(block, 1.0):
+                return True
+            if sink.buffer.aborted:
+                return False
+
+    def _write(self, sink):
+        try:
+            while True:
+                block = sink.buffer.get()
+                if block is None:
+                    break
+                write_all(sink.fd, block)
+                sink.bytes_written += len(block)
+        except (OSError, IOError) as e:
+            if e.errno == errno.EPIPE:
+                sink.error = "receiver stopped reading after {} bytes".format(sink.bytes_written)
+            else:
+                sink.error = "error writing to receiver: {}".format(e)
+            sink.buffer.abort()
+
+    def run(self):
+        """Relay until the source reaches end of file, or no sink is left.
+
+        Return a list with, for each sink, None if it got the whole
+        stream or else why not. Raises RelayError if reading fails. If
+        every sink was detached the caller should stop the sender."""
+        self.started = time.time()
+        threads = [threading.Thread(target=self._read)]
+        threads.extend(threading.Thread(target=self._write, args=(sink,)) for sink in self.sinks)
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads[1:]:
+            thread.join()
+        self.finished = time.time()
+        if self._read_error is not None:
+            raise RelayError("error reading from sender: {}".format(self._read_error))
+        return [sink.error for sink in self.sinks]